@@ -0,0 +1,191 @@
+# Provides a command-line interface for maintaining the artefacts stored by
+# BugHunter, e.g.:
+#
+#   python3 -m bughunter migrate --to pack
+#   python3 -m bughunter failures
+#   python3 -m bughunter pending https://github.com/curl/curl
+#   python3 -m bughunter manifest --rebuild
+#   python3 -m bughunter gc --max-size 20G
+#   python3 -m bughunter submit https://github.com/curl/curl --timeout 600 --memory 4G
+#   python3 -m bughunter work --jobs 32
+#   python3 -m bughunter queue
+#
+# The location of the storage is determined by the BUGHUNTER environment
+# variable, as it is for the library.
+import argparse
+import collections
+import sys
+import bughunter.compression as compression
+import bughunter.distributed as distributed
+from bughunter.bughunter import BugHunter
+from bughunter.storage import Storage, TOOL_VERSIONS
+
+# Moves all artefacts into stores of a given backend, compressing them with a
+# given codec, if any
+def migrate(args):
+    source = [b for b in Storage.BACKENDS if b != args.to]
+    storage = BugHunter(backend=args.to, compress=args.compress).storage()
+    moved = sum(storage.migrate(b) for b in source)
+    print("migrated %d artefacts to backend: %s" % (moved, args.to))
+
+# Reports the number of recorded failures for each cause, where each cause is
+# given by the type of the error and the first line of its message
+def failures(args):
+    causes = collections.Counter()
+    durations = collections.Counter()
+    for (_, _, jsn) in BugHunter(backend=args.backend).storage().failures():
+        if not args.all and jsn.get('versions') != TOOL_VERSIONS:
+            continue
+        message = (jsn['error'].strip().splitlines() or [''])[0][:100]
+        cause = "%s: %s" % (jsn['type'], message)
+        causes[cause] += 1
+        durations[cause] += jsn.get('duration', 0)
+
+    for (cause, count) in causes.most_common():
+        print("%6d  %8.1fs  %s" % (count, durations[cause], cause))
+    print("%6d failures in total" % sum(causes.values()))
+
+# Reports the number of diffs that have yet to be prepared for each of a
+# given list of repositories
+def pending(args):
+    bh = BugHunter(backend=args.backend)
+    for address in args.addresses:
+        repo = bh.repository(address)
+        print("%s: %d diffs pending" % (address, len(bh.storage().pending(repo))))
+
+# Rebuilds the manifest for each store from its contents, or reports the
+# number and total size of the artefacts recorded by each manifest
+def manifest(args):
+    storage = BugHunter(backend=args.backend).storage()
+    for namespace in storage.namespaces():
+        store = storage.store(namespace).inner()
+        if args.rebuild:
+            store.rebuild()
+        sizes = store.sizes()
+        print("%s: %d artefacts, %d bytes" % (namespace, len(sizes), sum(sizes.values())))
+
+# The multipliers for the units that may be used to give sizes
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# Parses a size given in bytes, optionally followed by a unit (e.g., "20G")
+def parse_size(size):
+    size = size.strip().upper().rstrip('B')
+    unit = size[-1:] if size[-1:] in SIZE_UNITS else ''
+    try:
+        return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: %s" % size)
+
+# Evicts artefacts until the artefacts occupy no more than a given size
+def gc(args):
+    storage = BugHunter(backend=args.backend).storage()
+    storage.gc(args.max_size, policy=args.policy)
+
+# Submits a given list of repositories to a task queue. The parsing and
+# differencing jobs of the workers are subject to any given resource limits.
+def submit(args):
+    limits = {'wall': args.timeout, 'cpu': args.cpu_time, 'memory': args.memory}
+    limits = {k: v for (k, v) in limits.items() if v is not None} or None
+    bh = BugHunter(backend=args.backend, limits=limits)
+    counts = bh.submit(args.addresses, queue=args.queue, granularity=args.granularity)
+    print(", ".join("%d %s" % (n, state) for (state, n) in counts.items()))
+
+# Leases and executes tasks from a task queue until it's exhausted
+def work(args):
+    BugHunter().work(queue=args.queue, jobs=args.jobs, lease=args.lease, retry=args.retry)
+
+# Reports the number of tasks in each state within a task queue, and the
+# failed tasks, optionally returning the failed tasks to the queue
+def queue(args):
+    path = args.queue or distributed.default_queue(BugHunter())
+    tasks = distributed.TaskQueue(path)
+    for (key, error) in tasks.failures():
+        print("failed: %s (%s)" % (key, error))
+    if args.requeue:
+        print("requeued %d failed tasks" % tasks.requeue())
+    print(", ".join("%d %s" % (n, state) for (state, n) in tasks.counts().items()))
+    tasks.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="bughunter")
+    commands = parser.add_subparsers(dest="command")
+
+    cmd = commands.add_parser("migrate", help="move artefacts to another storage backend")
+    cmd.add_argument("--to", choices=Storage.BACKENDS, default='pack',\
+                     help="the backend to move artefacts into")
+    cmd.add_argument("--compress", choices=compression.CODECS, default=None,\
+                     help="the codec used to compress the moved artefacts")
+    cmd.set_defaults(func=migrate)
+
+    cmd = commands.add_parser("failures", help="report the causes of recorded failures")
+    cmd.add_argument("--backend", choices=Storage.BACKENDS, default='files',\
+                     help="the backend that holds the artefacts")
+    cmd.add_argument("--all", action="store_true",\
+                     help="include failures recorded by other versions of the tools")
+    cmd.set_defaults(func=failures)
+
+    cmd = commands.add_parser("pending", help="report the number of diffs left to prepare")
+    cmd.add_argument("addresses", nargs="+", help="the addresses of the repositories")
+    cmd.add_argument("--backend", choices=Storage.BACKENDS, default='files',\
+                     help="the backend that holds the artefacts")
+    cmd.set_defaults(func=pending)
+
+    cmd = commands.add_parser("manifest", help="report or rebuild the artefact manifests")
+    cmd.add_argument("--rebuild", action="store_true",\
+                     help="rebuild each manifest from the contents of its store")
+    cmd.add_argument("--backend", choices=Storage.BACKENDS, default='files',\
+                     help="the backend that holds the artefacts")
+    cmd.set_defaults(func=manifest)
+
+    cmd = commands.add_parser("gc", help="evict artefacts to fit within a given size")
+    cmd.add_argument("--max-size", type=parse_size, required=True,\
+                     help="the maximum total size of the artefacts (e.g., 500M or 20G)")
+    cmd.add_argument("--policy", choices=Storage.GC_POLICIES, default='lru',\
+                     help="the order in which artefacts are evicted")
+    cmd.add_argument("--backend", choices=Storage.BACKENDS, default='files',\
+                     help="the backend that holds the artefacts")
+    cmd.set_defaults(func=gc)
+
+    cmd = commands.add_parser("submit", help="submit repositories to a shared task queue")
+    cmd.add_argument("addresses", nargs="+", help="the addresses of the repositories")
+    cmd.add_argument("--queue", default=None,\
+                     help="the path to the task queue (by default, within the storage)")
+    cmd.add_argument("--granularity", choices=distributed.GRANULARITIES, default='diff',\
+                     help="whether each task prepares a single fix or a single diff")
+    cmd.add_argument("--backend", choices=Storage.BACKENDS, default='files',\
+                     help="the backend used by the workers to hold artefacts")
+    cmd.add_argument("--timeout", type=float, default=None,\
+                     help="the wall-clock limit for each parsing job, in seconds")
+    cmd.add_argument("--cpu-time", type=float, default=None,\
+                     help="the CPU time limit for each parsing job, in seconds")
+    cmd.add_argument("--memory", type=parse_size, default=None,\
+                     help="the memory limit for each parsing job (e.g., 4G)")
+    cmd.set_defaults(func=submit)
+
+    cmd = commands.add_parser("work", help="execute tasks from a shared task queue")
+    cmd.add_argument("--queue", default=None,\
+                     help="the path to the task queue (by default, within the storage)")
+    cmd.add_argument("--jobs", type=int, default=None,\
+                     help="the number of worker processes (by default, one per CPU)")
+    cmd.add_argument("--lease", type=int, default=300,\
+                     help="the number of seconds for which each task is leased")
+    cmd.add_argument("--retry", action="store_true",\
+                     help="retry diffs that failed to be prepared by an earlier run")
+    cmd.set_defaults(func=work)
+
+    cmd = commands.add_parser("queue", help="report the state of a shared task queue")
+    cmd.add_argument("--queue", default=None,\
+                     help="the path to the task queue (by default, within the storage)")
+    cmd.add_argument("--requeue", action="store_true",\
+                     help="return failed tasks to the queue")
+    cmd.set_defaults(func=queue)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 1
+    args.func(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
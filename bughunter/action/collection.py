@@ -79,33 +79,40 @@ class RepairActions(object):
         assert 'type' in jsn, "expected 'type' parameter in JSON repair action description"
         return RepairActions.ACTION_MAP[jsn['type']].from_json(jsn, before_ast, after_ast)
 
-    # Returns the location on disk of the repair actions cache file for
-    # a given diff
+    # Returns the key of the repair actions cache file for a given diff,
+    # within the artefact store for its repository
     @staticmethod
     def locator(diff):
-        storage = diff.fix().master().storage()
-        path = "%s.actions.json" % diff.clean_name()
-        path = os.path.join(diff.fix().repository().id(),\
-                            diff.fix().identifier(),\
-                            path)
-        path = os.path.join(storage.root(), "artefacts", path)
-        return path
+        return "%s/%s.actions.json" % (diff.fix().identifier(), diff.clean_name())
+
+    # Returns the artefact store that holds the repair actions for a given diff
+    @staticmethod
+    def store(diff):
+        return diff.fix().master().storage().artefacts(diff.fix().repository())
 
     # Determines whether the repair actions for a given diff are cached to disk
     @staticmethod
     def cached(diff):
-        return os.path.exists(RepairActions.locator(diff))
+        return RepairActions.store(diff).exists(RepairActions.locator(diff))
  
     # Extracts all repair actions within a given file (utilising the cache where
-    # possible)
+    # possible). The cache file is locked while the actions are mined, so
+    # that concurrent processes don't repeat or overwrite each other's work.
     @staticmethod
     def mine(diff):
-        # load any cached actions from disk
-        loc = RepairActions.locator(diff)
-        if os.path.exists(loc):
-            actions = RepairActions.__load(diff, loc)
-        else:
-            actions = {}
+        storage = diff.fix().master().storage()
+        with storage.lock(diff.fix().repository().id(), RepairActions.locator(diff)):
+            return RepairActions.__mine(diff)
+
+    @staticmethod
+    def __mine(diff):
+        # load any cached actions from the store
+        (store, key) = (RepairActions.store(diff), RepairActions.locator(diff))
+        try:
+            data = store.get(key)
+        except KeyError:
+            data = None
+        actions = {} if data is None else RepairActions.__load(diff, data)
 
         # get a list of the statements in each version of the program
         patch = diff.cgum()
@@ -125,20 +132,17 @@ class RepairActions(object):
 
         # if we added any new actions, overwrite the cache
         if modified:
-            RepairActions.__save(diff, actions, loc)
+            RepairActions.__save(diff, actions, store, key)
 
         # return a RepairActions object
         return RepairActions(actions)
 
-    # Loads the mined repair actions for a given diff from disk
-    # Responsibility of the callee to ensure the file exists
+    # Loads the mined repair actions for a given diff from the contents of its
+    # cache file
     @staticmethod
-    def __load(diff, loc):
+    def __load(diff, data):
         assert not diff is None
-        assert os.path.exists(loc), "given repair action file must exist"
-
-        with codecs.open(loc, 'r', 'utf-8') as f:
-            action_sets = json.load(f)
+        action_sets = json.loads(data.decode('utf-8'))
 
         before_ast = diff.before().ast()
         after_ast = diff.after().ast()
@@ -149,10 +153,9 @@ class RepairActions(object):
 
         return action_sets
     
-    # Saves the mined repair actions for a given diff to disk, overwriting
+    # Saves the mined repair actions for a given diff to the store, overwriting
     # any existing cache file
     @staticmethod
-    def __save(diff, actions, loc):
+    def __save(diff, actions, store, key):
         jsn = {tn: [a.to_json() for a in actions[tn]] for tn in actions}
-        with open(loc, "w") as f:
-            json.dump(jsn, f)
+        store.put(key, json.dumps(jsn).encode('utf-8'))
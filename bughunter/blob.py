@@ -0,0 +1,118 @@
+import subprocess
+import threading
+from bughunter.utility import LRUCache
+
+# Reads the contents of Git objects through a long-lived `git cat-file --batch`
+# process. Objects may be named by their hash, or by a revision and path (e.g.,
+# "HEAD~1:src/main.c").
+#
+# Readers are not thread-safe; use a BlobReaderPool to share readers between
+# threads.
+class BlobReader(object):
+    def __init__(self, git_dir):
+        self.__proc = subprocess.Popen(['git', '--git-dir', git_dir, 'cat-file', '--batch'],\
+                                       stdin=subprocess.PIPE,\
+                                       stdout=subprocess.PIPE)
+
+    # Returns the hash and contents of a named object, as a tuple. Raises a
+    # KeyError if no such object exists.
+    def read(self, name):
+        self.__proc.stdin.write(name.encode('utf-8') + b'\n')
+        self.__proc.stdin.flush()
+
+        # the header takes the form "<hash> <type> <size>", or
+        # "<name> missing" if the object doesn't exist
+        header = self.__proc.stdout.readline()
+        if not header:
+            raise Exception("cat-file process terminated unexpectedly")
+        header = header.decode('utf-8').rstrip('\n')
+        if header.endswith(' missing') or header.endswith(' ambiguous'):
+            raise KeyError(name)
+
+        (sha, _, size) = header.rsplit(' ', 2)
+        data = self.__proc.stdout.read(int(size))
+        self.__proc.stdout.read(1)
+        return (sha, data)
+
+    # Terminates the underlying process
+    def close(self):
+        self.__proc.kill()
+        self.__proc.wait()
+        self.__proc.stdin.close()
+        self.__proc.stdout.close()
+
+# Provides a fixed-size pool of blob readers for a single repository, which
+# may be shared by several threads, together with a cache of the most recently
+# decoded file contents.
+#
+# Contents are cached by their blob hash, so files that are shared by many
+# commits are only read once.
+class BlobReaderPool(object):
+    def __init__(self, git_dir, size=4, capacity=64 * 1024 * 1024):
+        self.__git_dir = git_dir
+        self.__slots = threading.BoundedSemaphore(size)
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__cache = LRUCache(capacity, len)
+
+    # Returns the decoded contents of a file at a given revision. If the hash
+    # of the blob for that file is known, it may be given, allowing the cache
+    # to be checked without reading from Git.
+    def contents(self, revision, path, blob=None):
+        if blob is not None:
+            contents = self.__cache.get(blob)
+            if contents is not None:
+                return contents
+            (sha, data) = self.read(blob)
+        else:
+            (sha, data) = self.read("%s:%s" % (revision, path))
+            contents = self.__cache.get(sha)
+            if contents is not None:
+                return contents
+
+        contents = data.decode()
+        self.__cache.put(sha, contents)
+        return contents
+
+    # Returns the hash and raw contents of a named object
+    def read(self, name):
+        reader = self.__acquire()
+        try:
+            result = reader.read(name)
+        except KeyError:
+            self.__release(reader)
+            raise
+        except:
+            # the state of the reader is unknown, so it's discarded
+            reader.close()
+            self.__release(None)
+            raise
+        self.__release(reader)
+        return result
+
+    # Returns an idle reader, or a new reader if there are none, waiting for
+    # another thread to release its reader if the pool is exhausted
+    def __acquire(self):
+        self.__slots.acquire()
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop()
+        try:
+            return BlobReader(self.__git_dir)
+        except:
+            self.__slots.release()
+            raise
+
+    # Returns a reader to the pool, or frees its slot if it was discarded
+    def __release(self, reader):
+        if reader is not None:
+            with self.__lock:
+                self.__idle.append(reader)
+        self.__slots.release()
+
+    # Terminates all idle readers within this pool
+    def close(self):
+        with self.__lock:
+            for reader in self.__idle:
+                reader.close()
+            self.__idle = []
@@ -3,19 +3,85 @@ import bughunter.scanner as scanner
 import bughunter.repository as repository
 import bughunter.preprocessor as preprocesor
 import bughunter.fix as fix
+import bughunter.runner as runner
+import bughunter.pipeline as pipeline
+import bughunter.distributed as distributed
 import os
 
 class BugHunter(object):
-    def __init__(self):
-        self.__storage = storage.Storage(self)
+    # The clone parameter determines how repositories are cloned to disk
+    # (see Storage.CLONE_MODES). If fetch is set, existing clones are fetched
+    # from their remotes before they're used. If a parser command is given,
+    # files are parsed and differenced by a long-lived service started with
+    # that command, which must implement the protocol in bughunter.service;
+    # otherwise, each job is executed on its own.
+    # The backend parameter determines how artefacts are held on disk (see
+    # Storage.BACKENDS). Loaded ASTs and diffs are cached in memory, up to a
+    # budget given by cache (in bytes). Artefacts are compressed using the
+    # codecs given by compress (see Storage). Each parsing and differencing
+    # job is subject to the resource limits given by limits, as a dictionary
+    # of its wall-clock and CPU time (in seconds) and memory (in bytes), e.g.,
+    # {'wall': 600, 'memory': 4 << 30} (see execution.Limits).
+    def __init__(self, clone='full', fetch=False, parser=None, backend='files',\
+                 cache=256 * 1024 * 1024, compress=None, limits=None):
+        self.__options = {'clone': clone, 'fetch': fetch, 'parser': parser,\
+                          'backend': backend, 'cache': cache, 'compress': compress,\
+                          'limits': limits}
+        self.__storage = storage.Storage(self, clone=clone, fetch=fetch, parser=parser,\
+                                         backend=backend, cache=cache, compress=compress,\
+                                         limits=limits)
         self.__scanner = scanner.Scanner(self)
 
+    # Returns the options that this BugHunter instance was constructed with,
+    # as a dictionary of keyword arguments.
+    def options(self):
+        return dict(self.__options)
+
     # We could have a shared pool of repository (and fix) instances, but
     # since we're writing to disk directly, and contents are lazily fetched,
     # there shouldn't be any synchronisation issues.
     def repository(self, address):
         return repository.Repository(self, address)
 
+    # Clones, scans and prepares the bug fixes for each of a given list of
+    # repositories, using a pool of worker processes shared by all
+    # repositories. If no number of jobs is specified, one job is used per
+    # CPU. Returns a dictionary describing the progress of each repository,
+    # indexed by address. Files that failed to be prepared by an earlier run
+    # are skipped, unless retry is set. If the path to a journal is given,
+    # an interrupted run may be resumed from the point at which it stopped
+    # (see bughunter.journal).
+    def run(self, addresses, jobs=None, prepare=True, retry=False, journal=None):
+        return runner.Runner(self, jobs).run(addresses, prepare=prepare, retry=retry,\
+                                             journal=journal)
+
+    # Prepares the bug fixes for each of a given list of repositories using a
+    # staged pipeline, with a separate pool of worker processes for each
+    # stage, whose sizes are given by a dictionary of jobs, indexed by stage
+    # (see bughunter.pipeline). If a Docker image is given, each version of
+    # each fix is also preprocessed; if actions is set, repair actions are
+    # also mined. Returns a runner.Throughput object. If the path to a
+    # journal is given, an interrupted run may be resumed from the point at
+    # which it stopped.
+    def pipeline(self, addresses, jobs=None, docker_image=None, actions=True, retry=False,\
+                 journal=None):
+        p = pipeline.Pipeline(self, jobs, docker_image=docker_image, actions=actions)
+        return p.run(addresses, retry=retry, journal=journal)
+
+    # Submits each of a given list of repositories to a task queue (by
+    # default, held within the storage root), from which workers on any
+    # machine that shares the storage root may lease its fixes or diffs
+    # (see bughunter.distributed). Returns the number of tasks in each state.
+    def submit(self, addresses, queue=None, granularity='diff'):
+        return distributed.submit(self, addresses, path=queue, granularity=granularity)
+
+    # Leases and executes tasks from a task queue (by default, held within
+    # the storage root) using a pool of worker processes, until the queue is
+    # exhausted. Returns a runner.Throughput object.
+    def work(self, queue=None, jobs=None, lease=300, retry=False):
+        path = queue or distributed.default_queue(self)
+        return distributed.Worker(path, jobs=jobs, lease=lease).run(retry=retry)
+
     def storage(self):
         return self.__storage
     def scanner(self):
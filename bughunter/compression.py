@@ -0,0 +1,42 @@
+# This module implements the codecs used to compress stored artefacts. The
+# codec used to compress an artefact is detected from its leading bytes, so
+# artefacts may be read regardless of the codec (if any) that they were
+# written with.
+#
+# The zstd codec requires the optional zstandard package.
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The names of the supported codecs
+CODECS = ['none', 'gzip', 'zstd']
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Ensures that a codec with a given name is supported and available
+def check(codec):
+    assert codec in CODECS, ("unrecognised compression codec: %s" % codec)
+    if codec == 'zstd' and zstandard is None:
+        raise Exception("zstd compression requires the zstandard package")
+
+# Compresses a sequence of bytes using a given codec
+def compress(data, codec):
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if codec == 'zstd':
+        check(codec)
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+# Decompresses a sequence of bytes, written using any codec
+def decompress(data):
+    if data[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    if data[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+        check('zstd')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
@@ -1,7 +1,9 @@
 import bughunter.source
+import bughunter.service as service
 from bughunter.action.collection import RepairActions
 from bughunter.pool import ConcreteDonorPoolSet, AbstractDonorPoolSet
 import os.path
+import time
 
 # Represents the difference between two files 
 class FileDiff(object):
@@ -11,14 +13,16 @@ class FileDiff(object):
         self.__name = name
         self.__cgum = None
 
-    # Returns the absolute path to this diff file on disk
+    # Returns the key of this diff file within the artefact store for its
+    # repository
+    def key(self):
+        return "%s/%s.diff.json" % (self.fix().identifier(), self.clean_name())
+
+    # Returns the absolute path to this diff file on disk, or None if the
+    # artefacts for its repository aren't held in individual files
     def location(self):
-        path = "%s.diff.json" % self.clean_name()
-        path = os.path.join(self.fix().repository().id(),\
-                            self.fix().identifier(),\
-                            path)
-        path = os.path.join(self.__master.storage().root(), "artefacts", path)
-        return path
+        store = self.__master.storage().artefacts(self.fix().repository())
+        return store.path(self.key())
     
     # Returns the name of the file
     def name(self):
@@ -55,22 +59,36 @@ class FileDiff(object):
     # Determines whether the CGum diff file for this file is cached
     # to disk
     def cached(self):
-        return os.path.exists(self.location())
+        return self.__master.storage().exists(self)
 
     # Ensures that the files for this diff are cached to disk, including its
-    # donor pool
+    # donor pool. Returns True if the diff was prepared, or False otherwise.
+    #
+    # Should the diff fail to be prepared because of its files (see
+    # service.DETERMINISTIC_ERRORS), the failure is recorded, and this diff
+    # is skipped by later calls, unless a retry is forced. Any other error
+    # is raised without being recorded, so that the diff is tried again.
     #
     # TODO: could be more efficient if we just didn't load existing donor pools from
     #       disk, but that involves a bit more refactoring; this is good enough for
     #       now
-    def prepare(self):
+    def prepare(self, force=False):
+        storage = self.__master.storage()
+        failure = storage.failure(self)
+        if failure is not None and not force:
+            return False
+
+        start = time.time()
         try:
             if not self.cached():
                 self.cgum()
             ConcreteDonorPoolSet.build(self)
             AbstractDonorPoolSet.build(self)
-        except:
-            pass 
+        except service.DETERMINISTIC_ERRORS as e:
+            storage.record_failure(self, e, time.time() - start)
+            return False
+        storage.clear_failure(self)
+        return True
 
     # Returns the PyCGum difference representation of this diff
     def cgum(self):
@@ -0,0 +1,439 @@
+# This module allows the preparation of a corpus to be distributed across
+# several machines that share a storage root (e.g., over NFS). A coordinator
+# submits repositories to a task queue, held by a SQLite database within the
+# storage root, and a worker on each machine leases tasks from the queue and
+# executes them using a local pool of worker processes. No other services are
+# required.
+#
+# Tasks come in three kinds:
+#   scan: clones and scans a repository, and submits a task for each of its
+#         fixes (or each of its outstanding diffs) to the queue.
+#   fix: prepares every diff of a single fix.
+#   diff: prepares a single diff.
+#
+# Each leased task is held by its worker for a limited time, which the worker
+# extends periodically (i.e., it sends a heartbeat) for as long as the task
+# is in progress. Should a worker die, its leases expire, and its tasks are
+# returned to the queue, to be leased by another worker. Tasks whose leases
+# expire too many times are assumed to bring down their workers, and are
+# marked as failed.
+#
+# Workers lease several tasks at once, and the queue is only touched to
+# lease, renew and complete tasks, so the queue is rarely contended, and
+# throughput grows with the number of machines. Since SQLite's write-ahead
+# log can't be shared across machines, the queue uses a rollback journal, and
+# relies on the locks provided by the shared filesystem.
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import bughunter.runner as runner
+import bughunter.utility as utility
+from bughunter.journal import fix_unit, diff_unit
+
+# The granularities at which the fixes of a repository may be distributed
+GRANULARITIES = ['fix', 'diff']
+
+# Executes a task, given by its kind, the address of its repository and its
+# JSON payload, within a worker process. Scan tasks submit their follow-up
+# tasks to the queue at a given path, and return the number of tasks that
+# they submitted; fix and diff tasks return True if they were prepared.
+def execute(options, path, kind, address, payload, retry=False):
+    if kind == 'fix':
+        return runner.prepare_fix(options, address, payload['fix'], retry)
+    if kind == 'diff':
+        return runner.prepare_diff(options, address, payload['fix'], payload['file'], retry)
+
+    master = runner.master(options)
+    repo = master.repository(address)
+    tasks = []
+    if payload['granularity'] == 'fix':
+        for fx in repo.iter_fixes():
+            (key, _) = fix_unit(repo, fx.identifier())
+            tasks.append(('fix', key, address, {'fix': fx.to_json()}))
+    else:
+        for df in master.storage().pending(repo, failed=retry):
+            (key, _) = diff_unit(df)
+            tasks.append(('diff', key, address, {'fix': df.fix().to_json(), 'file': df.name()}))
+    queue = TaskQueue(path)
+    try:
+        queue.submit(tasks)
+    finally:
+        queue.close()
+    return len(tasks)
+
+# A task leased from a TaskQueue
+class Task(object):
+    def __init__(self, ident, kind, key, address, payload):
+        self.__ident = ident
+        self.__kind = kind
+        self.__key = key
+        self.__address = address
+        self.__payload = payload
+
+    def ident(self):
+        return self.__ident
+    def kind(self):
+        return self.__kind
+    def key(self):
+        return self.__key
+    def address(self):
+        return self.__address
+    def payload(self):
+        return self.__payload
+
+# Provides access to a task queue, held by a SQLite database file at a given
+# path. Each task moves from queued, to leased, to either done or failed; a
+# leased task whose lease expires is returned to the queue. Each process
+# should open the queue separately.
+class TaskQueue(object):
+    # The states that a task may be in
+    STATES = ['queued', 'leased', 'done', 'failed']
+
+    # The number of times that a task may be leased before it's failed
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, path):
+        utility.ensure_dir(os.path.dirname(path))
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, timeout=120, isolation_level=None,\
+                                    check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS tasks "\
+                          "(id INTEGER PRIMARY KEY, kind TEXT, key TEXT UNIQUE, "\
+                          "address TEXT, payload TEXT, state TEXT, owner TEXT, "\
+                          "expires REAL, attempts INTEGER, error TEXT, updated REAL)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, id)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    # Returns the path to the database file for this queue
+    def location(self):
+        return self.__path
+
+    # Records the options used to construct the BugHunter instances that
+    # execute the tasks within this queue, so that every worker uses the
+    # same options
+    def set_options(self, options):
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('options', ?)",\
+                              (json.dumps(options),))
+
+    # Returns the options recorded for this queue, or None if there are none
+    def options(self):
+        with self.__lock:
+            row = self.__db.execute("SELECT value FROM meta WHERE name = 'options'").fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # Adds a number of tasks, given as (kind, key, address, payload) tuples,
+    # to the queue. Tasks whose keys are already in the queue are ignored.
+    def submit(self, tasks):
+        now = time.time()
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN IMMEDIATE")
+                self.__db.executemany("INSERT OR IGNORE INTO tasks "\
+                                      "(kind, key, address, payload, state, attempts, updated) "\
+                                      "VALUES (?, ?, ?, ?, 'queued', 0, ?)",\
+                                      ((k, key, a, json.dumps(p), now) for (k, key, a, p) in tasks))
+
+    # Leases up to a given number of queued tasks to a given owner, for a
+    # given number of seconds, and returns them as a list of Task objects.
+    # Any expired leases are returned to the queue (or failed) beforehand.
+    def lease(self, owner, n, duration):
+        now = time.time()
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN IMMEDIATE")
+                self.__db.execute("UPDATE tasks SET state = 'failed', owner = NULL, updated = ?, "\
+                                  "error = 'lease expired too many times' "\
+                                  "WHERE state = 'leased' AND expires < ? AND attempts >= ?",\
+                                  (now, now, TaskQueue.MAX_ATTEMPTS))
+                self.__db.execute("UPDATE tasks SET state = 'queued', owner = NULL, updated = ? "\
+                                  "WHERE state = 'leased' AND expires < ?", (now, now))
+                rows = self.__db.execute("SELECT id, kind, key, address, payload FROM tasks "\
+                                         "WHERE state = 'queued' ORDER BY id LIMIT ?",\
+                                         (n,)).fetchall()
+                self.__db.executemany("UPDATE tasks SET state = 'leased', owner = ?, expires = ?, "\
+                                      "attempts = attempts + 1, updated = ? WHERE id = ?",\
+                                      ((owner, now + duration, now, r[0]) for r in rows))
+        return [Task(i, k, key, a, json.loads(p)) for (i, k, key, a, p) in rows]
+
+    # Extends the leases held by a given owner on a number of tasks, given by
+    # their identifiers, for a given number of seconds, and returns the
+    # identifiers of those tasks whose leases are still held
+    def heartbeat(self, owner, idents, duration):
+        idents = list(idents)
+        if not idents:
+            return []
+        now = time.time()
+        marks = ",".join("?" * len(idents))
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN IMMEDIATE")
+                self.__db.execute("UPDATE tasks SET expires = ?, updated = ? "\
+                                  "WHERE owner = ? AND state = 'leased' AND id IN (%s)" % marks,\
+                                  [now + duration, now, owner] + idents)
+                rows = self.__db.execute("SELECT id FROM tasks WHERE owner = ? AND "\
+                                         "state = 'leased' AND id IN (%s)" % marks,\
+                                         [owner] + idents).fetchall()
+        return [r[0] for r in rows]
+
+    # Records that a task leased by a given owner has been completed. If an
+    # error is given, the task is recorded as having failed. Returns False,
+    # and leaves the task untouched, if the owner no longer holds its lease
+    # (e.g., because the lease expired, and the task was leased by another
+    # owner).
+    def complete(self, owner, ident, error=None):
+        state = 'done' if error is None else 'failed'
+        with self.__lock:
+            cursor = self.__db.execute("UPDATE tasks SET state = ?, owner = NULL, error = ?, "\
+                                       "updated = ? WHERE id = ? AND owner = ? AND "\
+                                       "state = 'leased'",\
+                                       (state, error, time.time(), ident, owner))
+        return cursor.rowcount > 0
+
+    # Returns a number of tasks leased by a given owner, given by their
+    # identifiers, to the queue, without counting their leases as attempts
+    def release(self, owner, idents):
+        idents = list(idents)
+        if not idents:
+            return
+        with self.__lock:
+            self.__db.execute("UPDATE tasks SET state = 'queued', owner = NULL, updated = ?, "\
+                              "attempts = MAX(attempts - 1, 0) WHERE owner = ? AND "\
+                              "state = 'leased' AND id IN (%s)" % ",".join("?" * len(idents)),\
+                              [time.time(), owner] + idents)
+
+    # Returns any failed tasks to the queue, and returns the number of tasks
+    # that were returned
+    def requeue(self):
+        with self.__lock:
+            cursor = self.__db.execute("UPDATE tasks SET state = 'queued', attempts = 0, "\
+                                       "error = NULL, updated = ? WHERE state = 'failed'",\
+                                       (time.time(),))
+        return cursor.rowcount
+
+    # Returns the number of tasks in each state
+    def counts(self):
+        counts = {s: 0 for s in TaskQueue.STATES}
+        with self.__lock:
+            rows = self.__db.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall()
+        counts.update(rows)
+        return counts
+
+    # Returns a list of (key, error) pairs for the failed tasks
+    def failures(self):
+        with self.__lock:
+            return self.__db.execute("SELECT key, error FROM tasks "\
+                                     "WHERE state = 'failed' ORDER BY id").fetchall()
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+# Returns the path to the default task queue within the storage used by a
+# given BugHunter instance
+def default_queue(master):
+    return os.path.join(master.storage().root(), "queue", "tasks.db")
+
+# Submits a scan task for each of a given list of repositories to the task
+# queue at a given path (or the default queue for a given BugHunter instance),
+# and records the options of that instance for use by the workers. Each scan
+# submits a task for each fix, or each outstanding diff, of its repository,
+# depending on a given granularity. Repositories that have already been
+# submitted are ignored.
+def submit(master, addresses, path=None, granularity='diff'):
+    assert granularity in GRANULARITIES, ("unrecognised granularity: %s" % granularity)
+    queue = TaskQueue(path or default_queue(master))
+    try:
+        queue.set_options(master.options())
+        queue.submit([('scan', "scan/%s" % a, a, {'granularity': granularity})\
+                      for a in addresses])
+        return queue.counts()
+    finally:
+        queue.close()
+
+# Leases tasks from a task queue and executes them using a local pool of
+# worker processes (one per CPU, unless a number of jobs is given), until the
+# queue has no tasks left that are either queued or leased. Each task is
+# leased for a given number of seconds, and its lease is renewed at a third
+# of that interval for as long as the task is in progress.
+class Worker(object):
+    # The number of seconds that an idle worker waits before checking the
+    # queue for new tasks
+    POLL = 1
+
+    def __init__(self, path, jobs=None, lease=300, interval=10):
+        self.__path = path
+        self.__jobs = jobs or multiprocessing.cpu_count()
+        self.__lease = lease
+        self.__interval = interval
+        self.__owner = "%s:%d" % (socket.gethostname(), os.getpid())
+
+    # Returns the name under which this worker leases tasks
+    def owner(self):
+        return self.__owner
+
+    # Executes tasks until the queue is exhausted, and returns a
+    # runner.Throughput object that records the number of fix and diff tasks
+    # that this worker completed and failed. Diffs that failed to be
+    # prepared by an earlier run are skipped, unless retry is set.
+    #
+    # Should a task kill the process that executes it (e.g., by crashing, or
+    # by being killed by the OOM killer), the pool of processes is broken,
+    # and every task in progress fails with it. Since the culprit isn't
+    # known, the pool is replaced, and the tasks that were in progress are
+    # executed again, one at a time, while their leases are kept: a task
+    # that breaks the pool on its own is failed, and the others are executed
+    # as usual. Tasks that are leased but not in progress when the worker
+    # stops are returned to the queue.
+    def run(self, retry=False):
+        queue = TaskQueue(self.__path)
+        options = queue.options()
+        assert options is not None, ("no tasks have been submitted to queue: %s" % self.__path)
+        throughput = runner.Throughput(0, unit="tasks")
+        inflight = {}
+        ready = []
+        quarantine = []
+        leased = set()
+        lock = threading.Lock()
+        stopped = threading.Event()
+
+        # renew the leases for the tasks in progress in the background, so
+        # that leases are kept alive while the main thread waits on tasks
+        def heartbeat():
+            while not stopped.wait(self.__lease / 3):
+                with lock:
+                    idents = list(leased)
+                held = queue.heartbeat(self.__owner, idents, self.__lease)
+                if len(held) < len(idents):
+                    print("warning: %d leases were lost by worker: %s" % \
+                          (len(idents) - len(held), self.__owner))
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+
+        pool = concurrent.futures.ProcessPoolExecutor(self.__jobs)
+        reported = time.time()
+        try:
+            while True:
+                if not quarantine and len(inflight) + len(ready) < self.__jobs:
+                    for task in queue.lease(self.__owner, self.__jobs - len(inflight) - len(ready),\
+                                            self.__lease):
+                        ready.append(task)
+                        with lock:
+                            leased.add(task.ident())
+                        if task.kind() != 'scan':
+                            throughput.expect(1)
+
+                # suspects are executed on their own, before any other task
+                if quarantine:
+                    (source, n) = (quarantine, 0 if inflight else 1)
+                else:
+                    (source, n) = (ready, self.__jobs - len(inflight))
+                pending = source[:n]
+                del source[:n]
+                for (i, task) in enumerate(pending):
+                    try:
+                        future = pool.submit(execute, options, self.__path, task.kind(),\
+                                             task.address(), task.payload(), retry)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        source[:0] = pending[i:]
+                        break
+                    inflight[future] = task
+
+                if not inflight:
+                    if ready or quarantine:
+                        pool = self.__replace(pool)
+                        continue
+                    counts = queue.counts()
+                    if counts['queued'] == 0 and counts['leased'] == 0:
+                        break
+                    time.sleep(Worker.POLL)
+                    continue
+
+                done, _ = concurrent.futures.wait(inflight, timeout=self.__interval,\
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if any(self.__broken(f) for f in done):
+                    # every task in progress fails with the pool
+                    concurrent.futures.wait(inflight)
+                    done = set(inflight)
+                broken = []
+                for future in done:
+                    task = inflight.pop(future)
+                    if self.__broken(future):
+                        broken.append(task)
+                        continue
+                    with lock:
+                        leased.discard(task.ident())
+                    self.__completed(queue, future, task, throughput)
+
+                if broken:
+                    pool = self.__replace(pool)
+                    if len(broken) == 1:
+                        task = broken[0]
+                        with lock:
+                            leased.discard(task.ident())
+                        print("Failed [%s]: worker process terminated abruptly" % task.key())
+                        self.__record(queue, task, "worker process terminated abruptly",\
+                                      throughput)
+                    else:
+                        print("warning: %d tasks were interrupted by a failed worker process; "\
+                              "retrying them one at a time" % len(broken))
+                        quarantine.extend(broken)
+
+                if time.time() - reported >= self.__interval:
+                    print("%s: %s" % (self.__owner, throughput))
+                    reported = time.time()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            stopped.set()
+            beat.join()
+            queue.release(self.__owner, [t.ident() for t in ready + quarantine])
+            queue.close()
+
+        print("%s: %s" % (self.__owner, throughput))
+        return throughput
+
+    # Determines whether a given (completed) future failed because its pool
+    # of processes was broken
+    def __broken(self, future):
+        return isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool)
+
+    # Shuts down a given (broken) pool of processes, and returns a new pool
+    def __replace(self, pool):
+        pool.shutdown(wait=False, cancel_futures=True)
+        return concurrent.futures.ProcessPoolExecutor(self.__jobs)
+
+    # Records the outcome of a completed task
+    def __completed(self, queue, future, task, throughput):
+        error = None
+        try:
+            result = future.result()
+            if task.kind() != 'scan' and not result:
+                error = "not every diff was prepared"
+        except Exception as e:
+            print("Failed [%s]: %s" % (task.key(), e))
+            print(traceback.format_exc())
+            error = "%s: %s" % (e.__class__.__name__, e)
+        if self.__record(queue, task, error, throughput) and task.kind() == 'scan' and \
+           error is None:
+            print("%s: submitted %d tasks" % (task.address(), result))
+
+    # Records the outcome of a task in the queue, and returns False if the
+    # lease for the task was lost before it completed, in which case the
+    # outcome is discarded
+    def __record(self, queue, task, error, throughput):
+        if not queue.complete(self.__owner, task.ident(), error):
+            print("warning: lease was lost for task [%s]; discarding its outcome" % task.key())
+            return False
+        if task.kind() != 'scan':
+            if error is None:
+                throughput.succeeded()
+            else:
+                throughput.failure()
+        return True
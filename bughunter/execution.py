@@ -0,0 +1,441 @@
+# This module provides an asyncio-based execution layer for the external
+# tools used by BugHunter (e.g., Git, GumTree and the preprocessor). Commands
+# are run as subprocesses by an event loop that belongs to a background
+# thread, so that a single process may keep many external jobs in flight
+# without dedicating a thread to each job.
+#
+# The number of commands that may run at once is bounded by the executor. The
+# standard output of each command may be discarded, captured, streamed to a
+# (binary) file, or passed to a callback line by line, as it's produced;
+# the tail of its standard error is always kept, so that failures may be
+# reported. Each command is started in its own process group, so that
+# cancelling a job (or the executor) kills the command together with any
+# processes that it started.
+#
+# Each command may be subject to a set of resource limits (see Limits): a
+# command that runs for too long is killed, together with its process group,
+# and CPU time and memory are bounded by the kernel, via ulimit. Commands
+# that exceed a limit raise a LimitExceeded error, rather than producing a
+# failed Result, so that they may be told apart from ordinary failures.
+#
+# Commands may be run from synchronous code (Executor.run and
+# Executor.submit) or from coroutines (Executor.run_async). Each process has
+# its own default executor (see execution.default), since event loops can't
+# be shared with forked processes.
+import asyncio
+import collections
+import multiprocessing
+import math
+import os
+import re
+import shlex
+import signal
+import tempfile
+import threading
+
+# Raised when a command can't be executed, or exits with a non-zero status
+class ExecutionError(Exception):
+    pass
+
+# Raised when a command is killed for exceeding one of its resource limits,
+# given by name (see Limits.NAMES)
+class LimitExceeded(ExecutionError):
+    def __init__(self, limit, message):
+        super().__init__(message)
+        self.__limit = limit
+
+    # Returns the name of the limit that was exceeded
+    def limit(self):
+        return self.__limit
+
+# Describes the resource limits for a single command: its wall-clock time
+# and CPU time (in seconds), and the size of its address space (in bytes).
+# Limits that are None are unbounded.
+#
+# Memory is bounded by the size of the address space, rather than the
+# resident set, since that's what the kernel enforces. Tools running on the
+# JVM (e.g., GumTree) reserve their heap up front, so their memory limit
+# should comfortably exceed their maximum heap size (-Xmx).
+class Limits(object):
+    # The names of the limits, in the order in which they're reported
+    NAMES = ['wall', 'cpu', 'memory']
+
+    # Markers written to standard error by programs that failed to allocate
+    # memory, which are used to recognise commands that exceeded their
+    # memory limit
+    MEMORY_ERRORS = [b'MemoryError', b'OutOfMemoryError', b'Cannot allocate memory',\
+                     b'std::bad_alloc', b'Could not reserve enough space']
+
+    # The signals that kill commands that fail to allocate memory, without
+    # reporting it: a segmentation fault or bus error (e.g., a native program
+    # that doesn't check the result of malloc), an abort (e.g., an uncaught
+    # std::bad_alloc), or a SIGKILL (e.g., from the OOM killer)
+    MEMORY_SIGNALS = [signal.SIGSEGV, signal.SIGBUS, signal.SIGABRT, signal.SIGKILL]
+
+    # The number of seconds of CPU time for which a command that ignores
+    # SIGXCPU may continue to run, before it's killed
+    CPU_GRACE = 5
+
+    # The fraction of the hard CPU limit that a command must be reported to
+    # have used for a SIGKILL to be attributed to the limit, since the CPU
+    # time reported by the shell is sampled more coarsely than the kernel's
+    CPU_ACCURACY = 0.95
+
+    def __init__(self, wall=None, cpu=None, memory=None):
+        self.__wall = wall
+        self.__cpu = cpu
+        self.__memory = memory
+
+    # Returns the limits described by a given JSON document (see
+    # Limits.to_json). Limits objects and None are returned as they are.
+    @staticmethod
+    def from_json(jsn):
+        if jsn is None or isinstance(jsn, Limits):
+            return jsn
+        for name in jsn:
+            assert name in Limits.NAMES, ("unrecognised resource limit: %s" % name)
+        return Limits(**jsn)
+
+    def wall(self):
+        return self.__wall
+    def cpu(self):
+        return self.__cpu
+    def memory(self):
+        return self.__memory
+
+    # Determines whether any limit is bounded
+    def bounded(self):
+        return any(v is not None for v in (self.__wall, self.__cpu, self.__memory))
+
+    # Returns the hard CPU time limit, in seconds, or None if CPU time is
+    # unbounded. A command that ignores SIGXCPU is killed once it reaches
+    # this limit.
+    def hard_cpu(self):
+        if self.__cpu is None:
+            return None
+        return max(1, math.ceil(self.__cpu)) + Limits.CPU_GRACE
+
+    # Returns a shell command that runs a given command subject to the CPU
+    # and memory limits (which also apply to any processes that it starts).
+    # If CPU time is bounded, and a path is given, the command is run in a
+    # subshell, after which the CPU time used by the command is written to
+    # the file at that path (see Limits.cpu_used).
+    def wrap(self, cmd, report=None):
+        prefix = ""
+        if self.__cpu is not None:
+            # the soft limit is lowered first, since it can't exceed the
+            # hard limit
+            prefix += "ulimit -S -t %d; ulimit -H -t %d; " % \
+                      (self.hard_cpu() - Limits.CPU_GRACE, self.hard_cpu())
+        if self.__memory is not None:
+            prefix += "ulimit -v %d; " % max(1, self.__memory // 1024)
+        if self.__cpu is None or report is None:
+            return prefix + cmd
+        return "%s(%s\n); status=$?; times > %s; exit $status" % \
+               (prefix, cmd, shlex.quote(report))
+
+    # Returns the CPU time (in seconds) used by the children of a shell, given
+    # the output of its `times` builtin, or None if it can't be parsed
+    @staticmethod
+    def cpu_used(times):
+        lines = times.decode('utf-8', 'replace').strip().splitlines()
+        if len(lines) < 2:
+            return None
+        used = re.findall(r'(\d+)m([\d.]+)s', lines[1])
+        if not used:
+            return None
+        return sum(60 * int(m) + float(s) for (m, s) in used)
+
+    # Returns the name of the limit (other than the wall-clock limit) that a
+    # command with a given exit status and standard error most likely
+    # exceeded, or None if it doesn't appear to have exceeded a limit. A
+    # command killed by SIGXCPU exceeded its CPU limit, as did a command
+    # killed by SIGKILL, provided that the CPU time that it used (if known)
+    # reached the hard CPU limit (see CPU_ACCURACY). If memory is bounded, a
+    # command exceeded its memory limit if it reported a failure to allocate
+    # memory (see MEMORY_ERRORS), or if it was killed by a signal that
+    # follows such a failure (see MEMORY_SIGNALS) that wasn't attributed to
+    # the CPU limit. (Shells report a command killed by a signal using a
+    # status of 128 plus the signal.)
+    def exceeded(self, returncode, error, cpu_used=None):
+        if returncode == 0:
+            return None
+        signals = [-returncode, returncode - 128]
+        if self.__cpu is not None:
+            if signal.SIGXCPU in signals:
+                return 'cpu'
+            if signal.SIGKILL in signals and cpu_used is not None and \
+               cpu_used >= self.hard_cpu() * Limits.CPU_ACCURACY:
+                return 'cpu'
+        if self.__memory is not None:
+            if any(m in error for m in Limits.MEMORY_ERRORS) or \
+               any(s in signals for s in Limits.MEMORY_SIGNALS):
+                return 'memory'
+        return None
+
+    def to_json(self):
+        return {n: v for (n, v) in zip(Limits.NAMES, (self.__wall, self.__cpu, self.__memory))\
+                if v is not None}
+
+    def __str__(self):
+        return ", ".join("%s: %s" % (n, v) for (n, v) in self.to_json().items()) or "unbounded"
+
+# Describes the outcome of a command: its exit status, its captured standard
+# output (if any), and the tail of its standard error
+class Result(object):
+    def __init__(self, cmd, returncode, output, error):
+        self.__cmd = cmd
+        self.__returncode = returncode
+        self.__output = output
+        self.__error = error
+
+    def command(self):
+        return self.__cmd
+    def returncode(self):
+        return self.__returncode
+    def output(self):
+        return self.__output
+    def error(self):
+        return self.__error
+
+    # Determines whether the command exited with a status of zero
+    def ok(self):
+        return self.__returncode == 0
+
+    # Raises an ExecutionError if the command failed, and returns this result
+    # otherwise
+    def check(self):
+        if not self.ok():
+            raise ExecutionError("command failed with status %d: %s\n%s" % \
+                                 (self.__returncode, self.__cmd,\
+                                  self.__error.decode('utf-8', 'replace')))
+        return self
+
+class Executor(object):
+    # The number of bytes of standard error that are kept for each command
+    ERROR_TAIL = 64 * 1024
+
+    # The size of the chunks in which standard output is read
+    CHUNK = 64 * 1024
+
+    # At most limit commands are run at once (by default, four per CPU)
+    def __init__(self, limit=None):
+        self.__limit = limit or 4 * multiprocessing.cpu_count()
+        self.__loop = None
+        self.__thread = None
+        self.__semaphore = None
+        self.__lock = threading.Lock()
+
+    # Returns the maximum number of commands that may run at once
+    def limit(self):
+        return self.__limit
+
+    # Returns the event loop for this executor, starting its thread if
+    # necessary
+    def loop(self):
+        with self.__lock:
+            if self.__loop is None:
+                started = threading.Event()
+                self.__thread = threading.Thread(target=self.__serve, args=(started,),\
+                                                 daemon=True)
+                self.__thread.start()
+                started.wait()
+            return self.__loop
+
+    # Runs the event loop for this executor until it's stopped. The semaphore
+    # is created by the loop, since it belongs to the loop that creates it.
+    def __serve(self, started):
+        self.__loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.__loop)
+        self.__semaphore = asyncio.Semaphore(self.__limit)
+        started.set()
+        try:
+            self.__loop.run_forever()
+        finally:
+            self.__loop.close()
+
+    # Runs a given shell command to completion, once a slot becomes available,
+    # and returns a Result. If output is given, standard output is written to
+    # it, as it's produced; if on_line is given, it's called with each line
+    # of standard output (as bytes); if capture is set, standard output is
+    # kept by the Result. Otherwise, standard output is discarded. If merge
+    # is set, standard error is sent to standard output.
+    #
+    # If limits are given (as a Limits object or its JSON form), the command
+    # is subject to them, and a LimitExceeded error is raised should it exceed
+    # any of them. The wall-clock limit only counts the time for which the
+    # command runs, not the time spent waiting for a slot.
+    #
+    # Should the coroutine be cancelled, the process group of the command is
+    # killed before the cancellation is propagated.
+    async def run_async(self, cmd, cwd=None, output=None, on_line=None,\
+                        capture=False, merge=False, limits=None):
+        limits = Limits.from_json(limits) or Limits()
+        async with self.__semaphore:
+            piped = output is not None or on_line is not None or capture
+
+            # the CPU time used by the command is reported through a file
+            report = None
+            if limits.cpu() is not None:
+                (fd, report) = tempfile.mkstemp(prefix="bughunter-times-")
+                os.close(fd)
+            try:
+                try:
+                    proc = await asyncio.create_subprocess_shell(limits.wrap(cmd, report), cwd=cwd,\
+                               stdin=asyncio.subprocess.DEVNULL,\
+                               stdout=asyncio.subprocess.PIPE if piped else asyncio.subprocess.DEVNULL,\
+                               stderr=asyncio.subprocess.STDOUT if merge else asyncio.subprocess.PIPE,\
+                               start_new_session=True)
+                except OSError as e:
+                    raise ExecutionError("failed to execute command: %s (%s)" % (cmd, e))
+
+                try:
+                    streams = []
+                    if piped:
+                        streams.append(self.__stdout(proc.stdout, output, on_line, capture))
+                    if not merge:
+                        streams.append(self.__stderr(proc.stderr))
+                    results = await asyncio.wait_for(asyncio.gather(*streams, proc.wait()),\
+                                                     limits.wall())
+                except asyncio.TimeoutError:
+                    self.__kill(proc)
+                    await proc.wait()
+                    raise LimitExceeded('wall', "wall-clock limit exceeded (%ss)\n%s" % \
+                                        (limits.wall(), cmd))
+                except BaseException:
+                    self.__kill(proc)
+                    await proc.wait()
+                    raise
+
+                # the shell has exited, so its report (if any) is complete
+                cpu_used = None
+                if report is not None:
+                    with open(report, 'rb') as f:
+                        cpu_used = Limits.cpu_used(f.read())
+            finally:
+                report is None or os.remove(report)
+
+        returncode = results[-1]
+        captured = results[0] if piped else None
+        error = b'' if merge else results[-2]
+        limit = limits.exceeded(returncode, (captured or b'') if merge else error, cpu_used)
+        if limit is not None:
+            raise LimitExceeded(limit, "%s limit exceeded (%s)\n%s" % \
+                                (limit, getattr(limits, limit)(), cmd))
+        return Result(cmd, returncode, captured, error)
+
+    # Reads the standard output of a command until it's closed, and returns
+    # its contents, if they're to be captured
+    async def __stdout(self, stream, output, on_line, capture):
+        chunks = []
+        pending = b''
+        while True:
+            chunk = await stream.read(Executor.CHUNK)
+            if not chunk:
+                break
+            if output is not None:
+                output.write(chunk)
+            if capture:
+                chunks.append(chunk)
+            if on_line is not None:
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    on_line(line + b'\n')
+        if on_line is not None and pending:
+            on_line(pending)
+        return b''.join(chunks) if capture else None
+
+    # Reads the standard error of a command until it's closed, and returns
+    # its tail
+    async def __stderr(self, stream):
+        tail = collections.deque()
+        size = 0
+        while True:
+            chunk = await stream.read(Executor.CHUNK)
+            if not chunk:
+                break
+            tail.append(chunk)
+            size += len(chunk)
+            while size - len(tail[0]) >= Executor.ERROR_TAIL:
+                size -= len(tail.popleft())
+        return b''.join(tail)[-Executor.ERROR_TAIL:]
+
+    # Kills the process group of a given process, if it's still running
+    def __kill(self, proc):
+        if proc.returncode is not None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    # Schedules a given coroutine on the loop for this executor, and returns
+    # a concurrent.futures.Future for its result. Cancelling the future
+    # cancels the coroutine.
+    def schedule(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop())
+
+    # Schedules a given shell command (see Executor.run_async), and returns a
+    # concurrent.futures.Future for its Result
+    def submit(self, cmd, **kwargs):
+        return self.schedule(self.run_async(cmd, **kwargs))
+
+    # Runs a given shell command (see Executor.run_async), blocking until
+    # it's complete, and returns its Result. Should the calling thread be
+    # interrupted, the command is cancelled.
+    def run(self, cmd, **kwargs):
+        return self.wait(self.submit(cmd, **kwargs))
+
+    # Runs a given list of coroutines concurrently, blocking until every
+    # coroutine is complete, and returns a list of their results, in order.
+    # If a coroutine raises an exception, the exception is returned in place
+    # of its result.
+    def gather(self, coros):
+        if not coros:
+            return []
+        async def gather():
+            return await asyncio.gather(*coros, return_exceptions=True)
+        return self.wait(self.schedule(gather()))
+
+    # Waits for a given future to complete, and returns its result. Should
+    # the calling thread be interrupted, the future is cancelled.
+    def wait(self, future):
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    # Cancels every job that's in flight, and stops the loop for this executor
+    def close(self):
+        with self.__lock:
+            if self.__loop is None:
+                return
+            async def cancel():
+                tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            asyncio.run_coroutine_threadsafe(cancel(), self.__loop).result()
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__loop = None
+            self.__thread = None
+
+# The default executor for each process, indexed by process ID
+_EXECUTORS = {}
+_EXECUTORS_LOCK = threading.Lock()
+
+# Returns the default executor for the current process
+def default():
+    pid = os.getpid()
+    with _EXECUTORS_LOCK:
+        if not pid in _EXECUTORS:
+            _EXECUTORS[pid] = Executor()
+        return _EXECUTORS[pid]
+
+# Runs a given shell command using the default executor for this process,
+# and returns its Result (see Executor.run_async)
+def run(cmd, **kwargs):
+    return default().run(cmd, **kwargs)
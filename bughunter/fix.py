@@ -43,6 +43,7 @@ class Fix(object):
         self.__repo = repo
         self.__commit = commit
         self.__files = None
+        self.__changes = None
 
         if commit:
             self.__identifier = str(commit)
@@ -58,6 +59,7 @@ class Fix(object):
             self.__name = jsn['committer']['name']
             self.__date = jsn['date']
             self.__files = jsn['files']
+            self.__changes = jsn.get('changes')
 
     def master(self):
         return self.__repo.master()
@@ -91,18 +93,36 @@ class Fix(object):
     def source_files(self):
         return filter(lambda s: s.endswith('.c'), self.files())
 
-    # Returns a list of all the C source files that were modified by this fix.
-    # Does not include files that were added or deleted.
+    # Returns a list of descriptions of the changes made to each file by this
+    # fix, relative to the previous commit. Each description records the type
+    # of the change (i.e., 'A', 'M' or 'D'; renamed files are described as a
+    # deletion and an addition), the paths and blob hashes of the file before
+    # and after the fix, and the number of inserted and deleted lines (or
+    # None, if the fix was scanned from a partial clone).
     #
-    # TODO: precompute and cache
+    # These descriptions are computed by the scanner, and are stored in the
+    # database; databases written by older versions of BugHunter are given
+    # them as they're converted (see DatabaseFile). Should a fix lack them
+    # regardless, they're computed using Git on demand.
+    def changes(self):
+        if self.__changes is None:
+            jsn = self.master().scanner().describe(self.__repo, self.__identifier)
+            self.__changes = jsn['changes']
+        return self.__changes
+
+    # Returns the description of the change made to a given file by this fix,
+    # or None if the file wasn't changed.
+    def change(self, fn):
+        for change in self.changes():
+            if change['a_path'] == fn or change['b_path'] == fn:
+                return change
+        return None
+
+    # Returns a list of all the C source files that were modified by this fix.
+    # Does not include files that were added, deleted or renamed.
     def modified_source_files(self):
-        repo = self.repository().repository()
-        before = repo.commit('%s~1' % self.__identifier)
-        after = repo.commit(self.__identifier)
-        diff = before.diff(after)
-        modified = [d.a_path for d in diff if   d.change_type == 'M' and\
-                                                d.a_path.endswith('.c')]
-        return modified
+        return [c['a_path'] for c in self.changes() if  c['change_type'] == 'M' and\
+                                                        c['a_path'].endswith('.c')]
     
     # Determines whether this fix modifies a header file
     def modifies_header_file(self):
@@ -112,11 +132,14 @@ class Fix(object):
     def modifies_multiple_source_files(self):
         return len(list(self.source_files())) > 1
 
-    # Prepares all on-disk files needed to analyse this fix
-    def prepare(self):
+    # Prepares all on-disk files needed to analyse this fix, and returns True
+    # if every diff was prepared. Diffs that failed to be prepared by an
+    # earlier call are skipped, unless a retry is forced. Errors that aren't
+    # caused by the files of a diff are raised (see FileDiff.prepare).
+    def prepare(self, force=False):
         print("Preparing bug: {}".format(self.identifier()))
-        for diff in self.diffs():
-            diff.prepare()
+        prepared = [diff.prepare(force) for diff in self.diffs()]
+        return all(prepared)
 
     # Returns a pointer to the version of the program before the fix
     def before(self):
@@ -132,7 +155,7 @@ class Fix(object):
         
     # Returns a JSON description of this fix, in the form of a Dict
     def to_json(self):
-        return {
+        jsn = {
             'id': self.identifier(),
             'message': self.message(),
             'committer': {
@@ -142,3 +165,6 @@ class Fix(object):
             'date': self.date(),
             'files': self.files()
         }
+        if not self.__changes is None:
+            jsn['changes'] = self.__changes
+        return jsn
@@ -0,0 +1,127 @@
+# This module provides a journal for long-running corpus builds, which records
+# the state of each unit of work (e.g., a fix or a diff) as the build runs:
+# when the unit was started, and whether it was completed or failed, together
+# with the inputs that it was given. Should the build be interrupted, a
+# restarted build may consult the journal to skip the units that were already
+# completed (or failed), without checking any of their artefacts, and to
+# redo only those that were in progress.
+#
+# The journal is held in a line-delimited JSON file, to which a line is
+# appended, and flushed, whenever the state of a unit changes, so that the
+# journal survives the build process being killed. When a journal is opened,
+# its file is rewritten to hold only the latest state of each unit, and any
+# partially written line at the end of the file is discarded.
+#
+# Each journal is written to by a single (coordinating) process at a time.
+import json
+import os
+import time
+import bughunter.utility as utility
+
+# Returns the key and inputs of the unit of work for a fix, given by its
+# repository and identifier
+def fix_unit(repo, fix_id):
+    key = "%s/%s" % (repo.id(), fix_id)
+    return (key, {'address': repo.address(), 'fix': fix_id})
+
+# Returns the key of the unit of work for a given FileDiff, which, unlike its
+# inputs, is found without consulting its repository
+def diff_key(df):
+    return "%s/%s/%s" % (df.fix().repository().id(), df.fix().identifier(), df.clean_name())
+
+# Returns the key and inputs of the unit of work for a given FileDiff
+def diff_unit(df):
+    repo = df.fix().repository()
+    key = diff_key(df)
+    inputs = {'address': repo.address(),
+              'fix': df.fix().identifier(),
+              'file': df.name(),
+              'blobs': [df.before().blob(), df.after().blob()]}
+    return (key, inputs)
+
+class Journal(object):
+    # The states that may be recorded for a unit of work
+    STATES = ['started', 'done', 'failed']
+
+    def __init__(self, fn):
+        self.__fn = fn
+        self.__entries = {}
+        if os.path.isfile(fn):
+            with open(fn, 'r') as f:
+                for line in f:
+                    try:
+                        jsn = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.__entries[jsn['unit']] = jsn
+        with utility.atomic_writer(fn) as f:
+            for jsn in self.__entries.values():
+                f.write(json.dumps(jsn) + "\n")
+        self.__file = open(fn, 'a')
+
+    # Returns the path to the file that holds this journal
+    def location(self):
+        return self.__fn
+
+    # Returns the latest entry recorded for a unit with a given key, as a
+    # dictionary, or None if the unit hasn't been recorded
+    def entry(self, key):
+        return self.__entries.get(key)
+
+    # Returns the state of a unit with a given key, or None if the unit
+    # hasn't been recorded
+    def state(self, key):
+        jsn = self.__entries.get(key)
+        return None if jsn is None else jsn['state']
+
+    # Determines whether a unit with a given key was completed (or, if failed
+    # is set, either completed or failed). If inputs are given, the unit is
+    # only considered to be complete if it was given the same inputs.
+    def finished(self, key, inputs=None, failed=False):
+        jsn = self.__entries.get(key)
+        if jsn is None or not (jsn['state'] == 'done' or (failed and jsn['state'] == 'failed')):
+            return False
+        return inputs is None or jsn.get('inputs') == inputs
+
+    # Returns a dictionary of the inputs of each finished unit (see
+    # Journal.finished), indexed by key
+    def finished_units(self, failed=False):
+        states = ('done', 'failed') if failed else ('done',)
+        return {k: jsn.get('inputs') for (k, jsn) in self.__entries.items()\
+                if jsn['state'] in states}
+
+    # Returns the keys of the units that were started, but were neither
+    # completed nor failed (e.g., because the run was interrupted)
+    def interrupted(self):
+        return sorted(k for (k, jsn) in self.__entries.items() if jsn['state'] == 'started')
+
+    # Returns the number of units in each state
+    def counts(self):
+        counts = {s: 0 for s in Journal.STATES}
+        for jsn in self.__entries.values():
+            counts[jsn['state']] += 1
+        return counts
+
+    def started(self, key, inputs=None):
+        self.__record(key, 'started', inputs)
+    def succeeded(self, key, inputs=None):
+        self.__record(key, 'done', inputs)
+    def failure(self, key, error, inputs=None):
+        self.__record(key, 'failed', inputs, error=error)
+
+    # Records the state of a unit with a given key. If no inputs are given,
+    # those recorded by its previous entry (if any) are kept.
+    def __record(self, key, state, inputs, error=None):
+        if inputs is None and key in self.__entries:
+            inputs = self.__entries[key].get('inputs')
+        jsn = {'unit': key, 'state': state, 'time': time.time()}
+        if inputs is not None:
+            jsn['inputs'] = inputs
+        if error is not None:
+            jsn['error'] = error
+        self.__entries[key] = jsn
+        self.__file.write(json.dumps(jsn) + "\n")
+        self.__file.flush()
+
+    def close(self):
+        self.__file.close()
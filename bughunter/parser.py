@@ -1,4 +1,5 @@
 from bughunter.utility import *
+import bughunter.service as service
 import shutil
 import os.path
 import subprocess
@@ -38,20 +39,28 @@ def parse_files(file_names, source_dir, dest_dir):
         if os.path.isfile(src_fn):
             parse_file(src_fn, dest_fn)
 
-def generate_diff(fix_fn, fault_fn, diff_fn):
-    ensure_dir(os.path.dirname(diff_fn))
-    with open(diff_fn, "w+") as out:
-        cmd = "gumtree jsondiff %s %s" % (fix_fn, fault_fn)
-        print(cmd)
-        proc = subprocess.Popen(cmd, stdout=out, stderr=subprocess.PIPE, shell=True)
-        err = proc.communicate()[0]
-        assert proc.returncode == 0, \
-            ("failed to generate diff file: %s\nreason: %s" % (diff_fn, err))
-
-def generate_diffs(file_names, fix_dir, fault_dir, diff_dir):
+# Generates the GumTree diff between two files, using a given parser service,
+# if one is provided, or by starting GumTree otherwise.
+def generate_diff(fix_fn, fault_fn, diff_fn, parser=None):
+    print("gumtree jsondiff %s %s" % (fix_fn, fault_fn))
+    if parser is None:
+        service.execute({'op': 'jsondiff', 'before': fix_fn, 'after': fault_fn, 'output': diff_fn})
+    else:
+        parser.jsondiff(fix_fn, fault_fn, diff_fn)
+
+# Generates the GumTree diffs for a list of files, as a single batch of jobs
+# for a given parser service, if one is provided, or by starting GumTree for
+# each file otherwise.
+def generate_diffs(file_names, fix_dir, fault_dir, diff_dir, parser=None):
+    jobs = []
     for fn in file_names:
         fix_fn = os.path.join(fix_dir, fn)
         fault_fn = os.path.join(fault_dir, fn)
         diff_fn = os.path.join(diff_dir, ('%s.diff.json' % fn))
         if os.path.isfile(fix_fn) and os.path.isfile(fault_fn):
-            generate_diff(fix_fn, fault_fn, diff_fn)
+            jobs.append({'op': 'jsondiff', 'before': fix_fn, 'after': fault_fn, 'output': diff_fn})
+    if parser is None:
+        for job in jobs:
+            service.execute(job)
+    else:
+        parser.batch(jobs)
@@ -0,0 +1,328 @@
+# This module provides a staged pipeline for preparing the diffs of a number
+# of repositories. Rather than preparing each diff from start to finish
+# before moving on to the next (as FileDiff.prepare does), each stage of
+# preparation is performed by its own pool of worker processes, and diffs
+# are passed from one stage to the next through bounded queues. Reading from
+# Git, parsing and mining therefore overlap, and the number of workers for
+# each stage may be chosen separately (e.g., a few Git readers, many parsers
+# and some miners).
+#
+# Each queue holds at most twice as many diffs as there are workers for the
+# stage that consumes it. Should a stage fall behind, the stages before it
+# block once its queue is full, rather than accumulating work in memory.
+#
+# Every stage checks the storage before doing any work, so diffs (or parts
+# of diffs) that were already prepared are passed straight through. Should a
+# stage fail, the diff is dropped from the pipeline, and, if the failure was
+# caused by its files (see service.DETERMINISTIC_ERRORS), the failure is
+# recorded for the diff (see Storage.failure).
+#
+# If a journal is given (see bughunter.journal), the state of each diff is
+# recorded by the coordinating process as it passes through the pipeline,
+# and diffs that the journal records as finished are never emitted by the
+# scan stage.
+import collections
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+import bughunter.runner as runner
+import bughunter.preprocessor as preprocessor
+import bughunter.service as service
+from bughunter.journal import Journal, diff_unit
+from bughunter.pool import ConcreteDonorPoolSet, AbstractDonorPoolSet
+from bughunter.action.collection import RepairActions
+
+# The stages of the pipeline, in order:
+#   scan: clones and scans a repository, and emits each of its diffs that
+#         has yet to be prepared, as planned by its manifest.
+#   read: writes the files of a diff to disk, from Git.
+#   preprocess: preprocesses both versions of the fix for a diff, using
+#         Docker. This stage is only used if a Docker image is given.
+#   parse: computes the diff, and parses any of its files whose ASTs are
+#         missing, using a single parser job.
+#   pools: builds the donor pools for a diff.
+#   actions: mines the repair actions for a diff. This stage may be
+#         disabled.
+STAGES = ['scan', 'read', 'preprocess', 'parse', 'pools', 'actions']
+
+# Returns the FileDiff for a unit of work, given by the address of its
+# repository, the JSON description of its fix, and the name of its file
+def unit_diff(master, unit):
+    import bughunter.fix
+    import bughunter.diff
+    (address, jsn, name) = unit
+    fx = bughunter.fix.Fix.from_json(master.repository(address), jsn)
+    return bughunter.diff.FileDiff(master, fx, name)
+
+# Returns a generator over the units of work for the diffs of a repository,
+# with a given address, that have yet to be prepared, excluding those that
+# the journal for the run (if any) records as finished
+def scan(master, address, config):
+    repo = master.repository(address)
+    diffs = master.storage().pending(repo, failed=config['retry'], actions=config['actions'],\
+                                     finished=config['finished'])
+    for df in diffs:
+        yield (address, df.fix().to_json(), df.name())
+
+def read(master, df, config):
+    df.before().path()
+    df.after().path()
+
+# Preprocessing checks out each version of the program; unless the repository
+# is a bare clone, in which case versions are checked out to temporary
+# working trees, its working tree is locked while it's in use.
+def preprocess(master, df, config):
+    storage = master.storage()
+    repo = df.fix().repository()
+    worker = preprocessor.Preprocessor(master, config['docker_image'])
+    for version in (df.fix().before(), df.fix().after()):
+        if storage.preprocessed(version, df.name()).exists():
+            continue
+        if repo.repository().bare:
+            lock = storage.lock(repo.id(), "%s.preprocess" % version.identifier())
+        else:
+            lock = storage.lock("repositories", repo.id())
+        with lock:
+            if not storage.preprocessed(version, df.name()).exists():
+                worker.preprocess(version)
+
+def parse(master, df, config):
+    master.storage().compute_diff(df)
+
+def pools(master, df, config):
+    ConcreteDonorPoolSet.build(df)
+    AbstractDonorPoolSet.build(df)
+
+def actions(master, df, config):
+    RepairActions.mine(df)
+
+# The function that performs each stage for a single diff
+STAGE_FUNCTIONS = {
+    'read': read,
+    'preprocess': preprocess,
+    'parse': parse,
+    'pools': pools,
+    'actions': actions
+}
+
+# Performs a given stage of the pipeline within a worker process, taking
+# units of work from an inbox, and passing them to an outbox (if any) once
+# they're complete, until a None is received. An event is sent for each
+# unit, recording the outcome of the stage, and the journal key and inputs
+# of its diff (see journal.diff_unit).
+def work(options, config, stage, inbox, outbox, events):
+    master = runner.master(options)
+    storage = master.storage()
+    while True:
+        unit = inbox.get()
+        if unit is None:
+            break
+        start = time.time()
+        (key, inputs, df, error, emitted) = (unit, None, None, None, 0)
+        try:
+            if stage == 'scan':
+                outputs = scan(master, unit, config)
+            else:
+                df = unit_diff(master, unit)
+                (key, inputs) = diff_unit(df)
+                STAGE_FUNCTIONS[stage](master, df, config)
+                outputs = [unit]
+            for output in outputs:
+                if outbox is not None:
+                    outbox.put(output)
+                emitted += 1
+            if outbox is None and df is not None:
+                storage.clear_failure(df)
+        except Exception as e:
+            error = "%s: %s" % (e.__class__.__name__, e)
+            print("Failed [%s] at stage %s: %s" % (unit if df is None else df.key(), stage, e))
+            print(traceback.format_exc())
+            if df is not None and isinstance(e, service.DETERMINISTIC_ERRORS):
+                storage.record_failure(df, e, time.time() - start)
+        events.put((stage, key, inputs, error, emitted))
+
+# Prepares the diffs of a number of repositories using a staged pipeline,
+# with a separate pool of worker processes for each stage.
+#
+# The number of workers for each stage is given by a dictionary, indexed by
+# stage (see STAGES); stages that aren't given are assigned a default number
+# of workers, based on the number of CPUs. If a Docker image is given, both
+# versions of each fix are preprocessed. Repair actions are mined, unless
+# actions is unset.
+class Pipeline(object):
+    def __init__(self, master, jobs=None, docker_image=None, actions=True, interval=10):
+        jobs = jobs or {}
+        for stage in jobs:
+            assert stage in STAGES, ("unrecognised pipeline stage: %s" % stage)
+        cpus = multiprocessing.cpu_count()
+        defaults = {'scan': 1, 'read': 2, 'preprocess': 1, 'parse': cpus,\
+                    'pools': max(1, cpus // 2), 'actions': max(1, cpus // 2)}
+        stages = [s for s in STAGES if (s != 'preprocess' or docker_image is not None)\
+                                   and (s != 'actions' or actions)]
+        self.__master = master
+        self.__jobs = collections.OrderedDict((s, jobs.get(s, defaults[s])) for s in stages)
+        self.__docker_image = docker_image
+        self.__interval = interval
+
+    # Returns the number of workers used by each stage of this pipeline, as
+    # an ordered dictionary, indexed by stage
+    def jobs(self):
+        return collections.OrderedDict(self.__jobs)
+
+    # Runs every diff of a given list of repositories through the pipeline,
+    # and returns a runner.Throughput object, recording the number of diffs
+    # that were prepared and that failed. Diffs that failed to be prepared
+    # by an earlier run are skipped, unless retry is set. If the path to a
+    # journal is given, the state of each diff is recorded within it.
+    def run(self, addresses, retry=False, journal=None):
+        run_journal = None if journal is None else Journal(journal)
+        try:
+            return self.__run(addresses, retry, run_journal)
+        finally:
+            if run_journal is not None:
+                run_journal.close()
+
+    def __run(self, addresses, retry, run_journal):
+        stages = list(self.__jobs)
+        finished = {}
+        if run_journal is not None:
+            finished = run_journal.finished_units(failed=not retry)
+        config = {'retry': retry,\
+                  'docker_image': self.__docker_image,\
+                  'actions': 'actions' in stages,\
+                  'finished': finished}
+        options = self.__master.options()
+        inboxes = [multiprocessing.Queue(2 * self.__jobs[s]) for s in stages]
+        events = multiprocessing.Queue()
+
+        workers = {}
+        for (i, stage) in enumerate(stages):
+            outbox = inboxes[i + 1] if i + 1 < len(stages) else None
+            workers[stage] = [multiprocessing.Process(target=work,\
+                                  args=(options, config, stage, inboxes[i], outbox, events))\
+                              for _ in range(self.__jobs[stage])]
+            for p in workers[stage]:
+                p.start()
+
+        # feed the repositories to the first stage from a separate thread, so
+        # that events are handled while the first stage is busy
+        def feed():
+            for address in addresses:
+                inboxes[0].put(address)
+            for _ in workers[stages[0]]:
+                inboxes[0].put(None)
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        # once every worker for a stage has exited, the workers for the next
+        # stage are told to exit once they've emptied their queue. Should
+        # every worker for a stage die before then, the stage is dead: the
+        # units sent to it are taken from its queue, and recorded as failures,
+        # so that the stages before it never block on its full queue.
+        throughput = runner.Throughput(0)
+        counts = collections.OrderedDict((s, collections.Counter()) for s in stages)
+        settled = set()
+        handle = lambda event: self.__handle(event, stages, counts, throughput,\
+                                             run_journal, settled)
+        finished = []
+        dead = []
+        reported = time.time()
+        while True:
+            self.__drain(events, handle, timeout=0.1)
+            for (i, stage) in enumerate(stages):
+                if not stage in dead and \
+                   not any(p.is_alive() for p in workers[stage]) and \
+                   any(p.exitcode != 0 for p in workers[stage]):
+                    print("error: every worker for stage %s exited unexpectedly" % stage)
+                    dead.append(stage)
+            for stage in dead:
+                self.__discard(stage, inboxes[stages.index(stage)], handle)
+            while len(finished) < len(stages) and \
+                  not any(p.is_alive() for p in workers[stages[len(finished)]]):
+                stage = stages[len(finished)]
+                if any(p.exitcode != 0 for p in workers[stage]):
+                    print("warning: a worker for stage %s exited unexpectedly" % stage)
+                finished.append(stage)
+                if len(finished) < len(stages):
+                    for _ in workers[stages[len(finished)]]:
+                        inboxes[len(finished)].put(None)
+            if len(finished) == len(stages) and not feeder.is_alive():
+                break
+
+            if time.time() - reported >= self.__interval:
+                self.__report(throughput, counts)
+                reported = time.time()
+
+        # every worker has flushed its events (and its units) before exiting,
+        # so any that remain are waiting to be read
+        self.__drain(events, handle)
+        for stage in dead:
+            self.__discard(stage, inboxes[stages.index(stage)], handle)
+        feeder.join()
+        for stage in stages:
+            for p in workers[stage]:
+                p.join()
+        self.__report(throughput, counts)
+        return throughput
+
+    # Passes every event waiting in a given queue to a given function. If a
+    # timeout is given, waits up to that many seconds for the first event.
+    def __drain(self, events, handle, timeout=None):
+        try:
+            if timeout is not None:
+                handle(events.get(timeout=timeout))
+            while True:
+                handle(events.get_nowait())
+        except queue.Empty:
+            pass
+
+    # Takes every unit waiting in the queue for a given dead stage, and
+    # records each as having failed at that stage
+    def __discard(self, stage, inbox, handle):
+        error = "Exception: every worker for stage %s exited unexpectedly" % stage
+        while True:
+            try:
+                unit = inbox.get_nowait()
+            except queue.Empty:
+                return
+            if unit is None:
+                continue
+            (key, inputs) = (unit, None)
+            if stage != 'scan':
+                try:
+                    (key, inputs) = diff_unit(unit_diff(self.__master, unit))
+                except Exception:
+                    pass
+            handle((stage, key, inputs, error, 0))
+
+    # Records the outcome of a single stage for a single unit, given by an
+    # event sent by a worker. Events from different stages may arrive out of
+    # order, so units that have already completed or failed (given by a set
+    # of their keys, settled) are never recorded as started.
+    def __handle(self, event, stages, counts, throughput, run_journal, settled):
+        (stage, key, inputs, error, emitted) = event
+        counts[stage]['failed' if error else 'done'] += 1
+        if run_journal is not None and stage != 'scan':
+            if error:
+                run_journal.failure(key, error, inputs)
+                settled.add(key)
+            elif stage == stages[-1]:
+                run_journal.succeeded(key, inputs)
+                settled.add(key)
+            elif stage == stages[1] and not key in settled:
+                run_journal.started(key, inputs)
+        if stage == 'scan':
+            throughput.expect(emitted)
+        elif error:
+            throughput.failure()
+        elif stage == stages[-1]:
+            throughput.succeeded()
+
+    # Reports the overall throughput of the pipeline, together with the
+    # number of units that each stage has completed and failed
+    def __report(self, throughput, counts):
+        print("pipeline: %s" % throughput)
+        print("  " + "; ".join("%s: %d done, %d failed" % (s, c['done'], c['failed'])\
+                               for (s, c) in counts.items()))
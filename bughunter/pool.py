@@ -24,26 +24,23 @@ class DonorPool(object):
 
 class DonorPoolBuilder(object):
     @staticmethod
-    def build(ast, loc):
-        # Load existing pools from disk
-        if os.path.exists(loc):
-            with open(loc, "r") as f:
-                pools = json.load(f)
+    def build(ast, store, key):
+        # Load existing pools from the store
+        try:
+            pools = json.loads(store.get(key).decode('utf-8'))
             for (pname, pool) in pools.items():
                 pools[pname] = DonorPool.from_json(pname, pool)
-        else:
+        except KeyError:
             pools = {}
 
         # Build the remaining pools
         buffers = DonorPoolBuilder(ast, pools).collect()
         pools.update(buffers)
 
-        # If any new pools have been built, save the set to disk
+        # If any new pools have been built, save the set to the store
         if buffers:
             jsn = {n: pl.to_json() for (n, pl) in pools.items()}
-            ensure_dir(os.path.dirname(loc))
-            with open(loc, "w") as f:
-                json.dump(jsn, f)
+            store.put(key, json.dumps(jsn).encode('utf-8'))
        
         return pools
 
@@ -138,37 +135,35 @@ class DonorPoolSet(object):
         return False
 
 class AbstractDonorPoolSet(DonorPoolSet):
+    # Returns the key of the pool file for a given diff, within the artefact
+    # store for its repository
     @staticmethod
     def locator(diff):
-        storage = diff.fix().master().storage()
-        path = "%s.abstract.pool.json" % diff.clean_name()
-        path = os.path.join(diff.fix().repository().id(),\
-                            diff.fix().identifier(),\
-                            path)
-        path = os.path.join(storage.root(), "artefacts", path)
-        return path
+        return "%s/%s.abstract.pool.json" % (diff.fix().identifier(), diff.clean_name())
 
     @staticmethod
     def build(diff):
-        loc = AbstractDonorPoolSet.locator(diff)
-        ast = diff.before().ast().strip_variable_names()
-        pools = DonorPoolBuilder.build(ast, loc)
+        storage = diff.fix().master().storage()
+        store = storage.artefacts(diff.fix().repository())
+        key = AbstractDonorPoolSet.locator(diff)
+        ast = diff.before().ast(copy=True).strip_variable_names()
+        with storage.lock(diff.fix().repository().id(), key):
+            pools = DonorPoolBuilder.build(ast, store, key)
         return AbstractDonorPoolSet(diff, pools)
 
 class ConcreteDonorPoolSet(DonorPoolSet):
+    # Returns the key of the pool file for a given diff, within the artefact
+    # store for its repository
     @staticmethod
     def locator(diff):
-        storage = diff.fix().master().storage()
-        path = "%s.concrete.pool.json" % diff.clean_name()
-        path = os.path.join(diff.fix().repository().id(),\
-                            diff.fix().identifier(),\
-                            path)
-        path = os.path.join(storage.root(), "artefacts", path)
-        return path
+        return "%s/%s.concrete.pool.json" % (diff.fix().identifier(), diff.clean_name())
 
     @staticmethod
     def build(diff):
-        loc = ConcreteDonorPoolSet.locator(diff)
+        storage = diff.fix().master().storage()
+        store = storage.artefacts(diff.fix().repository())
+        key = ConcreteDonorPoolSet.locator(diff)
         ast = diff.before().ast()
-        pools = DonorPoolBuilder.build(ast, loc)
+        with storage.lock(diff.fix().repository().id(), key):
+            pools = DonorPoolBuilder.build(ast, store, key)
         return ConcreteDonorPoolSet(diff, pools)
@@ -1,8 +1,9 @@
 # This module is responsible for producing the pre-processed form of each file
 # modified by a given edit.
 import os
-import subprocess
+import shlex
 import bughunter.utility as util
+import bughunter.execution as execution
 
 # Calculate the path to the preprocess executable
 EXE_PREPROCESS = os.path.join(os.path.dirname(os.path.realpath(__file__)),\
@@ -21,47 +22,26 @@ class Preprocessor(object):
 
     def preprocess(self, version):
         repo = version.fix().repository().repository()
-        storage = self.__master.storage()
 
         # Find the commit ID for this program version
         fix = version.fix()
         commit = version.identifier()
 
+        # Bare clones have no working tree of their own, so the program
+        # version is checked out to a temporary working tree instead.
+        if repo.bare:
+            storage = self.__master.storage()
+            with storage.worktree(fix.repository(), commit) as working_dir:
+                self.__preprocess(version, working_dir)
+            return
+
         # Switch the repository's preprocessing branch to point at the
         # correct commit for this program version.
         current_branch_name = repo.active_branch.name
         try:         
             repo.git.reset('--hard')
             repo.git.checkout(commit, b='preprocessing')
-
-            # Compute and execute the pre-process command
-            cmd  = "%s '%s' '%s'" % (EXE_PREPROCESS, repo.working_dir, self.__docker_image)
-
-            # TODO: log std. err and std. out to a temporary file to improve
-            # debugging
-            with open(os.devnull, "w") as f:
-                print(cmd)
-                rc = subprocess.call(cmd, stdout=f, stderr=f, shell=True)
-                assert rc == 0, ("preprocessor failure: %s" % cmd)
-
-            # Save each of the modified source files to storage
-            for fn in fix.modified_source_files():
-
-                # Find where the file resides. For some projects, it will be in the
-                # same directory as the original source code file; for others, it
-                # may reside at the root of the repository.
-                pp_fn = '%s.i' % fn[:-2]
-                if os.path.isfile(os.path.join(repo.working_dir,\
-                                               os.path.basename(pp_fn))):
-                    cp_from = os.path.join(repo.working_dir, os.path.basename(pp_fn)) 
-                elif os.path.isfile(os.path.join(repo.working_dir, pp_fn)):
-                    cp_from = os.path.join(repo.working_dir, pp_fn)
-                else:
-                    cp_from = None
-
-                # If the file can be found, save it to storage
-                f = storage.preprocessed(version, fn)
-                f.write_from(cp_from)
+            self.__preprocess(version, repo.working_dir)
 
         # Ensure the repository is returned to its original state, prior to
         # pre-processing
@@ -70,3 +50,38 @@ class Preprocessor(object):
             repo.git.reset('--hard')
             repo.git.checkout(current_branch_name)
             repo.git.branch('-D', 'preprocessing')
+
+    # Preprocesses the program version checked out at a given working
+    # directory, and saves the preprocessed form of each of the source files
+    # modified by its fix to storage.
+    def __preprocess(self, version, working_dir):
+        storage = self.__master.storage()
+        fix = version.fix()
+
+        # Compute and execute the pre-process command
+        cmd = " ".join(shlex.quote(a) for a in (EXE_PREPROCESS, working_dir, self.__docker_image))
+
+        # The tail of std. err is kept by the execution layer, and is reported
+        # should the preprocessor fail
+        result = execution.run(cmd)
+        assert result.ok(), ("preprocessor failure: %s\n%s" % \
+                             (cmd, result.error().decode('utf-8', 'replace')))
+
+        # Save each of the modified source files to storage
+        for fn in fix.modified_source_files():
+
+            # Find where the file resides. For some projects, it will be in the
+            # same directory as the original source code file; for others, it
+            # may reside at the root of the repository.
+            pp_fn = '%s.i' % fn[:-2]
+            if os.path.isfile(os.path.join(working_dir,\
+                                           os.path.basename(pp_fn))):
+                cp_from = os.path.join(working_dir, os.path.basename(pp_fn)) 
+            elif os.path.isfile(os.path.join(working_dir, pp_fn)):
+                cp_from = os.path.join(working_dir, pp_fn)
+            else:
+                cp_from = None
+
+            # If the file can be found, save it to storage
+            f = storage.preprocessed(version, fn)
+            f.write_from(cp_from)
@@ -1,4 +1,5 @@
 import hashlib as hsh
+import bughunter.runner as runner
 #import bughunter.preprocessor as preprocessor
 
 # Used to provide access to a Git repository and its mined edits
@@ -30,4 +31,28 @@ class Repository(object):
     # provided to this repository to generate them (if they aren't already
     # saved to disk).
     def fixes(self):
-        return self.__master.storage().database(self).read(self.__master.scanner())
+        return list(self.iter_fixes())
+
+    # Returns a generator over the bug fixes for this repository, which loads
+    # a single fix into memory at a time. As with fixes(), the scanner is used
+    # to find the fixes if they aren't already saved to disk.
+    def iter_fixes(self):
+        return self.__master.storage().database(self).iter(self.__master.scanner())
+
+    # Prepares every diff of the bug fixes for this repository that hasn't
+    # been prepared yet, using a pool of worker processes (one per CPU,
+    # unless a number of jobs is given), and reports its throughput as it
+    # goes. Diffs that failed to be prepared by an earlier run are skipped,
+    # unless retry is set. Returns a runner.Throughput object, recording the
+    # number of diffs that were prepared and that failed. If the path to a
+    # journal is given, an interrupted call may be resumed from the point at
+    # which it stopped (see bughunter.journal).
+    def prepare_all(self, jobs=None, retry=False, journal=None):
+        return runner.Runner(self.__master, jobs).prepare(self, retry=retry, journal=journal)
+
+    # Fetches any new commits from the remote repository, and returns an
+    # updated list of its bug fixes. Only those commits that were introduced
+    # since the last scan of the repository are scanned.
+    def refresh(self):
+        self.__master.storage().database(self).refresh(self.__master.scanner())
+        return self.fixes()
@@ -0,0 +1,370 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import time
+import traceback
+from bughunter.journal import Journal, fix_unit, diff_unit
+
+# The BugHunter instance used by the tasks executed within this process
+_MASTER = None
+
+# Returns the BugHunter instance for the current (worker) process, constructed
+# with a given set of options
+def master(options):
+    global _MASTER
+    if _MASTER is None or _MASTER.options() != options:
+        from bughunter.bughunter import BugHunter
+        _MASTER = BugHunter(**options)
+    return _MASTER
+
+# Clones and scans a given repository within a worker process, and returns
+# the number of fixes that were found.
+def scan_repository(options, address):
+    repo = master(options).repository(address)
+    return sum(1 for _ in repo.iter_fixes())
+
+# Prepares the on-disk artefacts for a fix, described by a given JSON
+# document, within a worker process. Returns True if every diff for the fix
+# was prepared.
+def prepare_fix(options, address, jsn, retry=False):
+    import bughunter.fix
+    repo = master(options).repository(address)
+    return bughunter.fix.Fix.from_json(repo, jsn).prepare(retry)
+
+# Prepares the on-disk artefacts for a single diff, given by the JSON
+# document for its fix and the name of its file, within a worker process.
+# Returns True if the diff was prepared.
+def prepare_diff(options, address, jsn, name, retry=False):
+    import bughunter.fix
+    import bughunter.diff
+    repo = master(options).repository(address)
+    fx = bughunter.fix.Fix.from_json(repo, jsn)
+    return bughunter.diff.FileDiff(fx.master(), fx, name).prepare(retry)
+
+# Tracks the progress of a run for a single repository
+class Progress(object):
+    def __init__(self, address):
+        self.__address = address
+        self.__fixes = None
+        self.__prepared = 0
+        self.__failed = 0
+        self.__error = None
+
+    def address(self):
+        return self.__address
+
+    # Returns the number of fixes within this repository, or None if the
+    # repository hasn't been scanned yet
+    def fixes(self):
+        return self.__fixes
+    def prepared(self):
+        return self.__prepared
+    def failed(self):
+        return self.__failed
+
+    # Returns a description of the error that prevented this repository from
+    # being scanned, if any
+    def error(self):
+        return self.__error
+
+    # Determines whether all work for this repository has been completed
+    def finished(self):
+        return self.__error is not None or \
+               (self.__fixes is not None and \
+                self.__prepared + self.__failed == self.__fixes)
+
+    def scanned(self, fixes):
+        self.__fixes = fixes
+    def scan_failed(self, error):
+        self.__error = error
+    def succeeded(self):
+        self.__prepared += 1
+    def failure(self):
+        self.__failed += 1
+
+    def __str__(self):
+        if self.__error is not None:
+            return "%s: failed to scan (%s)" % (self.__address, self.__error)
+        if self.__fixes is None:
+            return "%s: scanning" % self.__address
+        return "%s: prepared %d/%d fixes (%d failed)" % \
+            (self.__address, self.__prepared, self.__fixes, self.__failed)
+
+    def to_json(self):
+        return {
+            'fixes': self.__fixes,
+            'prepared': self.__prepared,
+            'failed': self.__failed,
+            'error': self.__error
+        }
+
+# Tracks the throughput of a batch of work units (e.g., diffs), and estimates
+# the time remaining until the batch is complete
+class Throughput(object):
+    def __init__(self, total, unit="diffs"):
+        self.__total = total
+        self.__unit = unit
+        self.__prepared = 0
+        self.__failed = 0
+        self.__started = time.time()
+
+    def total(self):
+        return self.__total
+    def prepared(self):
+        return self.__prepared
+    def failed(self):
+        return self.__failed
+
+    # Returns the number of units that have been completed, successfully or not
+    def completed(self):
+        return self.__prepared + self.__failed
+
+    def succeeded(self):
+        self.__prepared += 1
+    def failure(self):
+        self.__failed += 1
+
+    # Adds a given number of units to the batch, for batches whose size isn't
+    # known upfront
+    def expect(self, units):
+        self.__total += units
+
+    # Returns the number of seconds since the batch was started
+    def elapsed(self):
+        return time.time() - self.__started
+
+    # Returns the number of units completed per second
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.completed() / elapsed if elapsed > 0 else 0.0
+
+    # Returns the estimated number of seconds until the batch is complete, or
+    # None if no units have been completed yet
+    def eta(self):
+        rate = self.rate()
+        if rate == 0:
+            return None
+        return (self.__total - self.completed()) / rate
+
+    def __str__(self):
+        eta = self.eta()
+        eta = "--:--:--" if eta is None else "%d:%02d:%02d" % \
+            (eta // 3600, eta % 3600 // 60, eta % 60)
+        return "prepared %d/%d %s (%d failed), %.2f %s/s, ETA %s" % \
+            (self.__prepared, self.__total, self.__unit, self.__failed,\
+             self.rate(), self.__unit, eta)
+
+    def to_json(self):
+        return {
+            'total': self.__total,
+            'prepared': self.__prepared,
+            'failed': self.__failed,
+            'elapsed': self.elapsed()
+        }
+
+# Clones, scans and prepares a number of repositories concurrently, using a
+# single pool of worker processes. Every task, be it the scan of a repository
+# or the preparation of one of its fixes, occupies one worker, so the total
+# number of tasks in flight is bounded by the number of workers, regardless
+# of the number of repositories.
+#
+# Repositories are scanned as soon as a worker becomes available, and their
+# fixes are then scheduled in a round-robin fashion, so that every scanned
+# repository makes progress.
+class Runner(object):
+    def __init__(self, master, jobs=None, interval=10):
+        self.__master = master
+        self.__jobs = jobs or multiprocessing.cpu_count()
+        self.__interval = interval
+
+    # Returns the number of worker processes used by this runner
+    def jobs(self):
+        return self.__jobs
+
+    # Runs the scan (and, optionally, preparation) of a given list of
+    # repository addresses to completion. Returns a dictionary of Progress
+    # objects, indexed by address. Diffs that failed to be prepared by an
+    # earlier run are skipped, unless retry is set.
+    #
+    # If the path to a journal is given (see bughunter.journal), the state of
+    # each fix is recorded within it, and fixes that the journal records as
+    # completed (or, unless retry is set, as failed) are skipped outright.
+    def run(self, addresses, prepare=True, retry=False, journal=None):
+        run_journal = None if journal is None else Journal(journal)
+        try:
+            return self.__run(addresses, prepare, retry, run_journal)
+        finally:
+            if run_journal is not None:
+                run_journal.close()
+
+    def __run(self, addresses, prepare, retry, run_journal):
+        progress = collections.OrderedDict((a, Progress(a)) for a in addresses)
+        unscanned = collections.deque(progress.keys())
+        sources = collections.OrderedDict()
+        pending = {}
+        reported = time.time()
+        options = self.__master.options()
+
+        with concurrent.futures.ProcessPoolExecutor(self.__jobs) as pool:
+            while unscanned or sources or pending:
+
+                # keep a bounded number of tasks queued for the workers, to
+                # avoid loading every fix into memory at once
+                while len(pending) < 2 * self.__jobs:
+                    if unscanned:
+                        address = unscanned.popleft()
+                        future = pool.submit(scan_repository, options, address)
+                        pending[future] = (address, None)
+                    elif sources:
+                        (address, fixes) = sources.popitem(last=False)
+                        jsn = next(fixes, None)
+                        if jsn is None:
+                            continue
+                        sources[address] = fixes
+                        if run_journal is not None:
+                            unit = fix_unit(self.__master.repository(address), jsn['id'])
+                            if run_journal.finished(*unit, failed=not retry):
+                                if run_journal.state(unit[0]) == 'done':
+                                    progress[address].succeeded()
+                                else:
+                                    progress[address].failure()
+                                continue
+                            run_journal.started(*unit)
+                        future = pool.submit(prepare_fix, options, address, jsn, retry)
+                        pending[future] = (address, jsn['id'])
+                    else:
+                        break
+
+                done, _ = concurrent.futures.wait(pending, timeout=self.__interval,\
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (address, fix_id) = pending.pop(future)
+                    error = self.__completed(future, address, fix_id, progress[address])
+                    if run_journal is not None and fix_id is not None:
+                        unit = fix_unit(self.__master.repository(address), fix_id)
+                        if error is None:
+                            run_journal.succeeded(unit[0])
+                        else:
+                            run_journal.failure(unit[0], error)
+                    if fix_id is None and prepare and progress[address].error() is None:
+                        sources[address] = self.__fixes(address)
+
+                if time.time() - reported >= self.__interval:
+                    self.__report(progress)
+                    reported = time.time()
+
+        self.__report(progress, finished=True)
+        return progress
+
+    # Prepares the diffs of a given repository that have yet to be prepared,
+    # using the pool of worker processes. Each diff is prepared by a separate
+    # task, so that the diffs of a single fix are prepared in parallel, and
+    # the artefacts that they produce are shared through the storage. The
+    # outstanding diffs are planned using the manifest for the repository
+    # (see Storage.pending); diffs that failed to be prepared by an earlier
+    # run are only included if retry is set. Returns a Throughput object.
+    #
+    # If the path to a journal is given, the state of each diff is recorded
+    # within it, and diffs that the journal records as completed (or, unless
+    # retry is set, as failed) are skipped outright.
+    def prepare(self, repo, retry=False, journal=None):
+        run_journal = None if journal is None else Journal(journal)
+        try:
+            return self.__prepare(repo, retry, run_journal)
+        finally:
+            if run_journal is not None:
+                run_journal.close()
+
+    def __prepare(self, repo, retry, run_journal):
+        finished = None
+        if run_journal is not None:
+            finished = run_journal.finished_units(failed=not retry)
+        diffs = self.__master.storage().pending(repo, failed=retry, finished=finished)
+        units = {}
+        if run_journal is not None:
+            units = {df.key(): diff_unit(df) for df in diffs}
+        throughput = Throughput(len(diffs))
+        options = self.__master.options()
+        queued = iter(diffs)
+        pending = {}
+        reported = time.time()
+        print("%s: %d diffs to prepare" % (repo.address(), len(diffs)))
+
+        with concurrent.futures.ProcessPoolExecutor(self.__jobs) as pool:
+            while True:
+                while len(pending) < 2 * self.__jobs:
+                    df = next(queued, None)
+                    if df is None:
+                        break
+                    future = pool.submit(prepare_diff, options, repo.address(),\
+                                         df.fix().to_json(), df.name(), retry)
+                    pending[future] = df.key()
+                    if run_journal is not None:
+                        run_journal.started(*units[df.key()])
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(pending, timeout=self.__interval,\
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    error = None
+                    try:
+                        if not future.result():
+                            error = "the diff wasn't prepared"
+                    except Exception as e:
+                        print("Failed [%s]: %s" % (key, e))
+                        print(traceback.format_exc())
+                        error = "%s: %s" % (e.__class__.__name__, e)
+                    if error is None:
+                        throughput.succeeded()
+                    else:
+                        throughput.failure()
+                    if run_journal is not None and error is None:
+                        run_journal.succeeded(units[key][0])
+                    elif run_journal is not None:
+                        run_journal.failure(units[key][0], error)
+
+                if time.time() - reported >= self.__interval:
+                    print("%s: %s" % (repo.address(), throughput))
+                    reported = time.time()
+
+        print("%s: %s" % (repo.address(), throughput))
+        return throughput
+
+    # Returns a generator over the JSON descriptions of the fixes for a
+    # scanned repository
+    def __fixes(self, address):
+        for fx in self.__master.repository(address).iter_fixes():
+            yield fx.to_json()
+
+    # Records the outcome of a completed task, and returns a description of
+    # the reason that it failed, or None if it succeeded
+    def __completed(self, future, address, fix_id, progress):
+        try:
+            result = future.result()
+        except Exception as e:
+            if fix_id is None:
+                progress.scan_failed(str(e))
+            else:
+                progress.failure()
+            print("Failed [%s]: %s" % (fix_id or address, e))
+            print(traceback.format_exc())
+            return "%s: %s" % (e.__class__.__name__, e)
+
+        if fix_id is None:
+            progress.scanned(result)
+            print(progress)
+        elif result:
+            progress.succeeded()
+        else:
+            progress.failure()
+            return "not every diff was prepared"
+        return None
+
+    # Reports the progress of each unfinished repository, or of every
+    # repository if the run has finished
+    def __report(self, progress, finished=False):
+        for p in progress.values():
+            if finished or not p.finished():
+                print(p)
@@ -9,19 +9,200 @@ class Scanner(object):
     BUG_MARKERS = ['fixed', 'bug', 'patch', 'patched', 'fails', 'fail']
     BUG_ANTI_MARKERS = ['compile', 'compilation', 'debug', 'merge', 'revert']
 
+    # Format of each commit within the log stream: a record separator,
+    # followed by the hash, committer e-mail, committer name, commit date and
+    # raw message of the commit, each terminated by a unit separator. The
+    # NUL-separated list of changed files follows the header.
+    LOG_FORMAT = '%x1e%H%x1f%ce%x1f%cn%x1f%ct%x1f%B%x1f'
+    RECORD_SEPARATOR = b'\x1e'
+    UNIT_SEPARATOR = b'\x1f'
+
+    # Size of the blocks read from the log stream
+    BLOCK_SIZE = 1 << 16
+
     def __init__(self, master):
         self.__master = master
 
     # Determines whether a given commit is a fix
     def is_fix(self, commit):
-        msg = commit.message.strip().lower()
-        files = list(commit.stats.files.keys())
+        return self.matches(commit.message, list(commit.stats.files.keys()))
+
+    # Determines whether a commit with a given message, which changes a given
+    # list of files, should be treated as a bug fix
+    def matches(self, message, files):
+        msg = message.strip().lower()
         return  any(s in msg for s in Scanner.BUG_MARKERS) and \
                 (not (any (s in msg for s in Scanner.BUG_ANTI_MARKERS))) and \
                 any(f.endswith('.c') for f in files)
 
-    # Finds all bug fixes within a given repository
-    def scan(self, repo):
-        print("scanning for fixes: %s" % repo.address())
-        commits = repo.repository().iter_commits()
-        return [fix.Fix(repo, c) for c in commits if self.is_fix(c)]
+    # Finds all bug fixes within a given repository. If a starting commit is
+    # given, only those fixes that were introduced after that commit, up to
+    # and including the given end commit, are returned.
+    def scan(self, repo, since=None, until='HEAD'):
+        if since is None:
+            print("scanning for fixes: %s" % repo.address())
+        else:
+            print("scanning for fixes: %s (%s..%s)" % (repo.address(), since, until))
+        return [fix.Fix.from_json(repo, jsn) \
+                for jsn in self.stream(repo, since, until)]
+
+    # Returns a generator over the JSON descriptions of each bug fix within a
+    # given repository (or range of commits within that repository), in the
+    # same order as they would be visited by iter_commits.
+    #
+    # Rather than computing the stats of each commit separately, the whole
+    # history is read from a single git log process. Git is used to discard
+    # commits that don't touch a C source file, or that don't mention a bug
+    # marker, before the remaining checks are applied to each commit as it
+    # arrives. The full diff of each remaining commit is reported, so that
+    # the list of files matches that given by commit.stats.
+    def stream(self, repo, since=None, until='HEAD'):
+        rev = until if since is None else '%s..%s' % (since, until)
+        args = [rev,
+                '--full-diff',
+                '--full-history',
+                '--regexp-ignore-case',
+                '--fixed-strings']
+        args += ['--grep=%s' % m for m in Scanner.BUG_MARKERS]
+        args += ['--', '*.c']
+        for jsn in Scanner.log(repo, args):
+            if self.matches(jsn['message'], jsn['files']):
+                yield jsn
+
+    # Returns the JSON description of a single commit within a given
+    # repository, regardless of whether or not it is a bug fix.
+    def describe(self, repo, commit):
+        log = Scanner.log(repo, ['-1', commit])
+        try:
+            return next(log)
+        finally:
+            log.close()
+
+    # Returns the JSON descriptions of a number of commits within a given
+    # repository, given by their hashes, as a dictionary indexed by hash.
+    # The commits are described by a few git log processes, rather than one
+    # process per commit.
+    def describe_all(self, repo, commits, batch=256):
+        described = {}
+        for i in range(0, len(commits), batch):
+            for jsn in Scanner.log(repo, ['--no-walk=unsorted'] + commits[i:i + batch]):
+                described[jsn['id']] = jsn
+        return described
+
+    # Returns a generator over the JSON descriptions of the commits reported
+    # by git log, when called with a given list of arguments.
+    #
+    # The changes made by each commit, relative to its first parent, are
+    # described by the raw and numstat output of git log. As for
+    # commit.stats, renames aren't detected, and are described as a deletion
+    # followed by an addition, so that the files and changes of a commit
+    # are the same regardless of how its repository was cloned (detecting
+    # renames would fetch the contents of every changed file within a
+    # partial clone).
+    #
+    # Counting the lines changed within each file also requires the contents
+    # of the files that were changed. For partial clones, which fetch the
+    # contents of files on demand, the numstat output is omitted, and line
+    # counts are unknown.
+    @staticmethod
+    def log(repo, args):
+        g = repo.repository()
+        opts = ['-z', '--raw', '--no-abbrev', '--no-renames']
+        if not Scanner.partial(g):
+            opts.append('--numstat')
+        opts += ['--diff-merges=first-parent', '--format=%s' % Scanner.LOG_FORMAT]
+        proc = g.git.log(*(opts + args), as_process=True)
+
+        buff = b''
+        try:
+            for block in iter(lambda: proc.stdout.read(Scanner.BLOCK_SIZE), b''):
+                buff += block
+                records = buff.split(Scanner.RECORD_SEPARATOR)
+                buff = records.pop()
+                for record in records:
+                    if record:
+                        yield Scanner.parse(record)
+            if buff:
+                yield Scanner.parse(buff)
+            proc.wait()
+        finally:
+            proc.stdout.close()
+
+    # Determines whether a given GitPython repository is a partial clone
+    @staticmethod
+    def partial(g):
+        with g.config_reader() as cfg:
+            return cfg.get_value('remote "origin"', 'promisor', False)
+
+    # Transforms a single commit record from the log stream into a JSON
+    # description of that commit, in the same form used by Fix.to_json.
+    @staticmethod
+    def parse(record):
+        (ident, email, name, date, rest) = \
+            record.split(Scanner.UNIT_SEPARATOR, 4)
+        (message, _, stats) = rest.partition(Scanner.UNIT_SEPARATOR)
+        changes = Scanner.parse_changes(stats.lstrip(b'\0\n').split(b'\0'))
+
+        # list each path touched by the commit, as commit.stats does
+        files = []
+        for change in changes:
+            if not change['b_path'] in files:
+                files.append(change['b_path'])
+
+        return {
+            'id': ident.decode('ascii'),
+            'message': message.decode('utf-8', 'replace').strip(),
+            'committer': {
+                'email': email.decode('utf-8', 'replace'),
+                'name': name.decode('utf-8', 'replace')
+            },
+            'date': int(date),
+            'files': files,
+            'changes': changes
+        }
+
+    # Transforms the NUL-separated raw and numstat output for a single commit
+    # into a list of descriptions of the changes made to each file.
+    #
+    # Raw entries take the form ":<mode> <mode> <blob> <blob> <type>", and are
+    # followed by the path of the file, or by its old and new paths if it was
+    # renamed or copied. Numstat entries take the form
+    # "<insertions>\t<deletions>\t<path>", where the path is empty, and the
+    # old and new paths follow, for renamed and copied files.
+    @staticmethod
+    def parse_changes(tokens):
+        decode = lambda p: p.decode('utf-8', 'replace')
+        blob = lambda sha: None if sha.strip(b'0') == b'' else sha.decode('ascii')
+        tokens = iter(tokens)
+        changes = []
+        stats = {}
+        for token in tokens:
+            if not token:
+                continue
+
+            if token.startswith(b':'):
+                (_, _, a_blob, b_blob, typ) = token[1:].split(b' ')
+                typ = typ[:1].decode('ascii')
+                a_path = decode(next(tokens))
+                b_path = decode(next(tokens)) if typ in ('R', 'C') else a_path
+                changes.append({
+                    'change_type': typ,
+                    'a_path': a_path,
+                    'b_path': b_path,
+                    'a_blob': blob(a_blob),
+                    'b_blob': blob(b_blob)
+                })
+
+            else:
+                (ins, dels, path) = token.split(b'\t', 2)
+                if not path:
+                    next(tokens)
+                    path = next(tokens)
+                count = lambda n: None if n == b'-' else int(n)
+                stats[decode(path)] = (count(ins), count(dels))
+
+        for change in changes:
+            (ins, dels) = stats.get(change['b_path'], (None, None))
+            change['insertions'] = ins
+            change['deletions'] = dels
+        return changes
@@ -0,0 +1,324 @@
+# This module provides the protocol for a long-lived parsing service, which
+# accepts batches of parse and diff jobs over a pipe, so that a service that
+# keeps its parser running (e.g., one built on GumTree's Java API) pays the
+# cost of starting the parser once, rather than once per file.
+#
+# Jobs and their replies are exchanged as JSON documents, one per line:
+#
+#   {"id": 1, "op": "parse", "source": "a.c", "output": "a.ast.json"}
+#   {"id": 2, "op": "diff", "before": "a.c", "after": "b.c", "output": "d.json"}
+#   {"id": 3, "op": "jsondiff", "before": "a.c", "after": "b.c", "output": "d.json"}
+#   {"id": 4, "op": "diff", "before": "a.c", "after": "b.c", "output": "d.json",
+#    "before_ast": "a.ast.json", "after_ast": "b.ast.json"}
+#
+#   {"id": 1, "ok": true}
+#   {"id": 2, "ok": false, "type": "Exception", "error": "..."}
+#
+# Any job may carry resource limits (see execution.Limits), in which case the
+# service should kill the job should it exceed them, and reply accordingly:
+#
+#   {"id": 5, "op": "parse", "source": "big.c", "output": "big.ast.json",
+#    "limits": {"wall": 600, "cpu": 600, "memory": 4294967296}}
+#
+#   {"id": 5, "ok": false, "type": "LimitExceeded", "limit": "wall", "error": "..."}
+#
+# parse and diff jobs produce CGum ASTs and annotated diffs, whereas jsondiff
+# jobs produce the raw output of `gumtree jsondiff`. A diff job may also
+# name outputs for the ASTs of its files (before_ast and after_ast), so that
+# a single job writes everything that's needed to load the diff; a service
+# that parses each file once, and computes the diff from those trees, need
+# only parse each file of a cold diff once. Each output file must be written
+# atomically, so that it's either complete or absent.
+#
+# This module provides the protocol, and the client for it, only. Any program
+# that implements the protocol may act as the service, and it's only used if
+# its command is given explicitly; by default, jobs are executed one at a
+# time (see ParserService). Running this module as a script starts a
+# reference implementation, which exists to exercise the protocol rather
+# than to save time: it executes each job using CGum, which starts GumTree
+# for every job, so it doesn't amortise the start-up of GumTree's JVM. Nor does it share trees
+# between the ASTs and the diff of a diff job: GumTree parses both files
+# again to compute the diff.
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import cgum.diff
+import cgum.program
+import bughunter.execution as execution
+from bughunter.utility import *
+
+# Raised when the parser fails to complete a job
+class ParserError(Exception):
+    pass
+
+# The errors that are caused by the files given to the parser, and so are
+# raised again should the same files be parsed again: the parser rejecting a
+# file, a job exceeding its resource limits, or the output of a job failing
+# to be read. Other errors (e.g., I/O errors, or contention for locks) are
+# caused by the environment, and mightn't recur.
+DETERMINISTIC_ERRORS = (ParserError, execution.LimitExceeded, ValueError)
+
+# Executes a single job within the current process. Jobs that are subject
+# to resource limits, and jsondiff jobs, are executed by subprocesses (see
+# execute_async).
+def execute(job):
+    op = job['op']
+    if external(job):
+        executor = execution.default()
+        executor.wait(executor.schedule(execute_async(job, executor)))
+    elif op == 'parse':
+        with atomic_writer(job['output']) as f:
+            cgum.program.Program.parse_to_json_file(job['source'], f)
+    elif op == 'diff':
+        with atomic_writer(job['output']) as f:
+            cgum.diff.AnnotatedDiff.parse_to_json_file(job['before'], job['after'], f)
+        for side in ('before', 'after'):
+            if job.get('%s_ast' % side):
+                with atomic_writer(job['%s_ast' % side]) as f:
+                    cgum.program.Program.parse_to_json_file(job[side], f)
+    else:
+        raise ParserError("unrecognised job type: %s" % op)
+
+# Determines whether a given job is executed by a subprocess, rather than
+# within the current process
+def external(job):
+    return job['op'] == 'jsondiff' or bool(job.get('limits'))
+
+# Executes a job using a subprocess, run by a given executor (see
+# bughunter.execution), subject to the resource limits of the job, if any.
+# jsondiff jobs run GumTree directly, streaming its output to disk; other
+# jobs are executed by a one-shot instance of this module. Should the job
+# exceed a limit, an execution.LimitExceeded error is raised.
+async def execute_async(job, executor):
+    limits = job.get('limits')
+    if job['op'] == 'jsondiff':
+        with atomic_writer(job['output'], 'wb') as f:
+            cmd = "gumtree jsondiff %s %s" % \
+                  (shlex.quote(job['before']), shlex.quote(job['after']))
+            result = await executor.run_async(cmd, output=f, limits=limits)
+            if not result.ok():
+                raise ParserError("failed to generate diff file: %s\nreason: %s" % \
+                                  (job['output'], result.error().decode('utf-8', 'replace')))
+        return
+
+    inner = {k: v for (k, v) in job.items() if k != 'limits'}
+    cmd = "%s -m bughunter.service --job %s" % \
+          (shlex.quote(sys.executable), shlex.quote(json.dumps(inner)))
+    result = await executor.run_async(cmd, capture=True, limits=limits)
+    try:
+        r = json.loads(result.output().decode('utf-8'))
+    except ValueError:
+        raise ParserError("parser exited with status %d\nreason: %s" % \
+                          (result.returncode(), result.error().decode('utf-8', 'replace')))
+    if not r['ok']:
+        raise ParserError("%s: %s" % (r['type'], r['error']))
+
+# Returns a reply describing the outcome of a given job, given the exception
+# that it raised, if any
+def outcome(job, error=None):
+    if error is None:
+        return {'id': job.get('id'), 'ok': True}
+    jsn = {'id': job.get('id'),
+           'ok': False,
+           'type': error.__class__.__name__,
+           'error': str(error)}
+    if isinstance(error, execution.LimitExceeded):
+        jsn['limit'] = error.limit()
+    return jsn
+
+# Executes a single job within the current process, and returns a reply
+# describing its outcome
+def reply(job):
+    try:
+        execute(job)
+        return outcome(job)
+    except Exception as e:
+        return outcome(job, e)
+
+# Executes a list of jobs within the current process, and returns a list of
+# their replies, in order. Jobs that are executed by subprocesses (see
+# external) are run concurrently by the execution layer for this process;
+# the remaining jobs are run in turn.
+def execute_all(jobs):
+    executor = execution.default()
+    indices = [i for (i, job) in enumerate(jobs) if external(job)]
+    results = [None] * len(jobs)
+    errors = executor.gather([execute_async(jobs[i], executor) for i in indices])
+    for (i, error) in zip(indices, errors):
+        results[i] = outcome(jobs[i], error)
+    for (i, job) in enumerate(jobs):
+        if results[i] is None:
+            results[i] = reply(job)
+    return results
+
+# Serves jobs read from a given input stream, writing a reply for each job to
+# a given output stream, until the input stream is closed.
+def serve(inp, out):
+    for line in inp:
+        if not line.strip():
+            continue
+        out.write(json.dumps(reply(json.loads(line))) + "\n")
+        out.flush()
+
+# Provides access to the parsing service. If a command for the service is
+# given, the service is started the first time that it's needed, and is kept
+# running until this object is closed. If no command is given, or the service
+# can't be started, or it terminates unexpectedly, jobs are executed within
+# the current process instead. A service that terminates unexpectedly is
+# restarted for the next batch of jobs, up to a limited number of times.
+#
+# Access to the service is serialised; threads that need to parse files
+# concurrently should use separate instances.
+class ParserService(object):
+    # The command used to start the reference implementation of the service,
+    # which only exercises the protocol (see above)
+    DEFAULT_COMMAND = "%s -m bughunter.service" % sys.executable
+
+    # The maximum number of jobs sent to the service before their replies
+    # are read
+    WINDOW = 64
+
+    # The number of times that the service may be restarted
+    RESTARTS = 3
+
+    # If limits are given (as an execution.Limits object or its JSON form),
+    # every job is subject to them.
+    def __init__(self, command=None, limits=None):
+        self.__command = command
+        self.__limits = execution.Limits.from_json(limits)
+        self.__proc = None
+        self.__restarts = ParserService.RESTARTS
+        self.__counter = 0
+        self.__lock = threading.Lock()
+
+    # Returns the command used to start the service, if any
+    def command(self):
+        return self.__command
+
+    # Returns the resource limits for each job, if any
+    def limits(self):
+        return self.__limits
+
+    # Parses a given source file, and writes its AST to a given path
+    def parse(self, source, output):
+        self.batch([{'op': 'parse', 'source': source, 'output': output}])
+
+    # Computes the annotated diff between two source files, and writes it to
+    # a given path. The ASTs of either file may also be written, to the paths
+    # given by before_ast and after_ast, by the same job.
+    def diff(self, before, after, output, before_ast=None, after_ast=None):
+        job = {'op': 'diff', 'before': before, 'after': after, 'output': output}
+        for (side, path) in (('before', before_ast), ('after', after_ast)):
+            if path is not None:
+                job['%s_ast' % side] = path
+        self.batch([job])
+
+    # Computes the raw GumTree diff between two source files, and writes it to
+    # a given path
+    def jsondiff(self, before, after, output):
+        self.batch([{'op': 'jsondiff', 'before': before, 'after': after, 'output': output}])
+
+    # Executes a given list of jobs, and returns a list of their replies. If
+    # any job fails, a ParserError (or, if the job exceeded a resource limit,
+    # an execution.LimitExceeded error) is raised once the batch is
+    # complete, unless check is set to False.
+    def batch(self, jobs, check=True):
+        with self.__lock:
+            replies = []
+            for i in range(0, len(jobs), ParserService.WINDOW):
+                replies += self.__send(jobs[i:i + ParserService.WINDOW])
+
+        if check:
+            for r in replies:
+                if not r['ok'] and r['type'] == 'LimitExceeded':
+                    raise execution.LimitExceeded(r.get('limit'), r['error'])
+                if not r['ok']:
+                    raise ParserError("%s: %s" % (r['type'], r['error']))
+        return replies
+
+    # Sends a list of jobs to the service, and returns their replies. Should
+    # the service be unavailable, the jobs are executed in this process.
+    def __send(self, jobs):
+        for job in jobs:
+            self.__counter += 1
+            job['id'] = self.__counter
+            if self.__limits is not None and self.__limits.bounded():
+                job.setdefault('limits', self.__limits.to_json())
+
+        proc = self.__service()
+        if proc is None:
+            return execute_all(jobs)
+
+        try:
+            for job in jobs:
+                proc.stdin.write((json.dumps(job) + "\n").encode('utf-8'))
+            proc.stdin.flush()
+            replies = []
+            for job in jobs:
+                line = proc.stdout.readline()
+                if not line:
+                    raise IOError("parser service terminated unexpectedly")
+                replies.append(json.loads(line.decode('utf-8')))
+            return replies
+
+        # restart the service for the next batch, and execute the jobs in
+        # this batch within the current process
+        except (IOError, ValueError) as e:
+            print("parser service failed (%s); falling back to one-shot parsing" % e)
+            self.__stop()
+            self.__restarts -= 1
+            return execute_all(jobs)
+
+    # Returns the process for the service, starting it if necessary, or None
+    # if there is no service
+    def __service(self):
+        if self.__command is None or self.__restarts < 0:
+            return None
+        if self.__proc is None or self.__proc.poll() is not None:
+            try:
+                self.__proc = subprocess.Popen(self.__command,\
+                                               shell=True,\
+                                               stdin=subprocess.PIPE,\
+                                               stdout=subprocess.PIPE)
+            except OSError as e:
+                print("failed to start parser service (%s)" % e)
+                self.__proc = None
+        return self.__proc
+
+    def __stop(self):
+        if self.__proc is not None:
+            self.__proc.kill()
+            self.__proc.wait()
+            self.__proc.stdin.close()
+            self.__proc.stdout.close()
+            self.__proc = None
+
+    # Stops the service, if it's running
+    def close(self):
+        with self.__lock:
+            self.__stop()
+
+if __name__ == "__main__":
+    # reserve the original standard output for replies, and send anything
+    # else that's written to it to standard error instead
+    out = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    # a single job may be given on the command line, in which case its reply
+    # is written once it's complete. Should the job fail, its error is also
+    # written to standard error, and a non-zero status is returned, so that
+    # a failure to allocate memory is recognised as exceeding the memory
+    # limit of the job (see execution.Limits.exceeded).
+    if sys.argv[1:2] == ['--job']:
+        r = reply(json.loads(sys.argv[2]))
+        out.write(json.dumps(r) + "\n")
+        out.flush()
+        if not r['ok']:
+            print("%s: %s" % (r['type'], r['error']), file=sys.stderr)
+            sys.exit(1)
+    else:
+        serve(sys.stdin, out)
@@ -1,5 +1,3 @@
-import tempfile
-
 # Provides access to the original source code contained within a given file
 # belonging to a specified program version
 class SourceFile(object):
@@ -27,18 +25,29 @@ class SourceFile(object):
 
     # Returns a readable file handler; responsibility of the requestee to close
     def readable(self):
-        f = tempfile.NamedTemporaryFile(suffix=".c", mode="wb")
-        f.write(self.contents().encode("utf-8"))
-        f.flush()
-        f.seek(0)
-        return f
+        return open(self.path(), "rb")
+
+    # Returns the absolute path to a copy of this source file on disk. Copies
+    # are shared by all source files with the same contents, and are only
+    # written once.
+    def path(self):
+        return self.__master.storage().source(self)
+
+    # Returns the hash of the blob for this source file, if it's known
+    def blob(self):
+        change = self.__version.fix().change(self.__name)
+        if change is None:
+            return None
+        return change['b_blob'] if self.__version.is_fixed() else change['a_blob']
 
     # Returns the contents of this source file as a string
     def contents(self):
-        repo = self.__version.fix().repository().repository()
-        blob = repo.commit(self.__version.identifier()).tree[self.__name]
-        return blob.data_stream.read().decode()
-
-    # Returns the abstract syntax tree for this file.
-    def ast(self):
-        return self.__master.storage().ast(self)
+        repo = self.__version.fix().repository()
+        blobs = self.__master.storage().blobs(repo)
+        return blobs.contents(self.__version.identifier(), self.__name, self.blob())
+
+    # Returns the abstract syntax tree for this file. The tree is shared with
+    # other users of this file within the process, unless a private copy,
+    # which may be modified, is requested.
+    def ast(self, copy=False):
+        return self.__master.storage().ast(self, copy)
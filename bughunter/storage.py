@@ -1,81 +1,613 @@
 import bughunter.utility as utility
 import bughunter.fix as fix
+import bughunter.diff as diff
+import bughunter.pool as pool
+import bughunter.action.collection as collection
+import bughunter.blob as blob
+import bughunter.service as service
+import bughunter.execution as execution
+import bughunter.journal as journal
+import bughunter.store as store
+import bughunter.compression as compression
+import bughunter.source as source
 import cgum.diff
 import cgum.program
 import tempfile
 import git
 import hashlib
+import shutil
 import os
+import io
 import json
+import stat
+import time
+import importlib.metadata
+import contextlib
 from bughunter.utility import *
 
+# The version of the parser used to generate ASTs. Stored ASTs are keyed by
+# this version, so that ASTs produced by other versions aren't reused.
+try:
+    PARSER_VERSION = importlib.metadata.version('cgum')
+except importlib.metadata.PackageNotFoundError:
+    PARSER_VERSION = getattr(cgum, '__version__', 'unknown')
+
+# The versions of the tools used to produce artefacts. Failures that were
+# recorded using other versions of these tools are ignored.
+try:
+    BUGHUNTER_VERSION = importlib.metadata.version('bughunter')
+except importlib.metadata.PackageNotFoundError:
+    BUGHUNTER_VERSION = 'unknown'
+TOOL_VERSIONS = {'bughunter': BUGHUNTER_VERSION, 'cgum': PARSER_VERSION}
+
+# The tool versions recorded for each artefact within the manifest
+TOOL_VERSION = " ".join("%s-%s" % (t, v) for (t, v) in sorted(TOOL_VERSIONS.items()))
+
+# The namespace of the store that holds the ASTs produced by this version of
+# the parser
+AST_NAMESPACE = os.path.join("asts", PARSER_VERSION)
+
 # The Storage class is responsible for abstracting away the details of how and
 # where BugHunter's artefacts are stored, including pre-processed, parsed, and
 # differenced files.
 class Storage(object):
-    def __init__(self, master, root=None):
+    # The ways in which repositories may be cloned to disk:
+    #   full: a regular clone, with a working tree.
+    #   bare: a bare clone, without a working tree. Working trees are only
+    #         created, temporarily, when they're needed for preprocessing.
+    #   blobless: a bare, partial clone that fetches file contents from the
+    #         remote on demand.
+    CLONE_MODES = ['full', 'bare', 'blobless']
+
+    # The backends that may be used to hold artefacts (see bughunter.store):
+    #   files: each artefact is held in its own file.
+    #   pack: the artefacts for each repository (and the shared ASTs) are held
+    #         within a single, indexed file.
+    BACKENDS = ['files', 'pack']
+
+    # The name of the file that holds the pack for a namespace
+    PACK = "artefacts.pack"
+
+    # The types of artefact that may be compressed, and the suffixes of their
+    # keys
+    ARTEFACT_TYPES = {
+        'ast': ('.ast.json',),
+        'diff': ('.diff.json',),
+        'pool': ('.pool.json',),
+        'actions': ('.actions.json',),
+        'preprocessed': ('.i',),
+        'failure': ('.failure.json',)
+    }
+
+    # The policies that may be used to choose which artefacts are evicted by
+    # Storage.gc:
+    #   lru: the least recently accessed artefacts are evicted first.
+    #   fifo: the least recently written artefacts are evicted first.
+    GC_POLICIES = ['lru', 'fifo']
+
+    # An estimate of the memory (in bytes) used by each value of a loaded AST
+    # or diff, including the CGum objects built from it, which is used to weigh
+    # the entries of the cache. Decoded JSON alone uses around 65 bytes per
+    # value, several times the size of its text.
+    VALUE_SIZE = 128
+
+    # The suffixes of the keys of the artefacts that belong to a single diff,
+    # which are evicted together (see Storage.gc)
+    DIFF_SUFFIXES = ('.diff.json', '.abstract.pool.json', '.concrete.pool.json',
+                     '.actions.json', '.failure.json',
+                     '.before.ast.json', '.after.ast.json',
+                     '.before.i', '.after.i')
+
+    # If fetch is set, any existing clone of a repository is fetched from its
+    # remote the first time it's opened by this storage, rather than being
+    # used as is.
+    #
+    # If a parser command is given, all parsing and differencing is performed
+    # by a long-lived service started using that command (see
+    # bughunter.service); otherwise, each job is executed using CGum within
+    # the current process.
+    #
+    # Loaded ASTs and diffs are kept in memory, up to a total size given by
+    # cache (in bytes, estimated from the number of values within their
+    # stored artefacts; see Storage.VALUE_SIZE), so that the objects for the
+    # same artefacts are shared, rather than loaded again, within a process.
+    # Since they're shared, cached objects must not be modified.
+    #
+    # Artefacts may be compressed as they're written, using one of the codecs
+    # in bughunter.compression. The compress parameter gives either the
+    # name of the codec used for every artefact, or a dictionary of codecs,
+    # indexed by artefact type (see Storage.ARTEFACT_TYPES). Artefacts are
+    # decompressed as they're read, regardless of this setting.
+    #
+    # If limits are given (as an execution.Limits object, or a dictionary of
+    # its wall, cpu and memory limits), every parsing and differencing job is
+    # subject to them. Jobs that exceed a limit are killed, and the diffs
+    # that they were computing are recorded as failures of their own type
+    # (see Storage.record_failure).
+    def __init__(self, master, root=None, clone='full', fetch=False, parser=None,\
+                 backend='files', cache=256 * 1024 * 1024, compress=None, limits=None):
+        assert clone in Storage.CLONE_MODES, ("unrecognised clone mode: %s" % clone)
+        assert backend in Storage.BACKENDS, ("unrecognised storage backend: %s" % backend)
         self.__master = master
+        self.__clone = clone
+        self.__fetch = fetch
+        self.__fetched = set()
+        self.__blobs = {}
+        self.__parser_command = parser
+        self.__parsers = {}
+        self.__limits = execution.Limits.from_json(limits)
+        self.__backend = backend
+        self.__stores = {}
+        self.__cache = utility.LRUCache(cache)
+        if not isinstance(compress, dict):
+            compress = {t: compress or 'none' for t in Storage.ARTEFACT_TYPES}
+        for (typ, codec) in compress.items():
+            assert typ in Storage.ARTEFACT_TYPES, ("unrecognised artefact type: %s" % typ)
+            compression.check(codec)
+        self.__compress = compress
         if 'BUGHUNTER' in os.environ:
             self.__root = os.environ['BUGHUNTER']
         else:
             self.__root = os.path.join(os.path.expanduser('~'), 'bughunter')
         utility.ensure_dir(self.__root)
 
-    # Returns the CGum AST for a given SourceFile
-    def ast(self, src):
-        path = "after" if src.version().is_fixed() else "before"
-        path = "%s.%s.ast.json" % (src.clean_name(), path)
-        path = os.path.join(src.version().fix().repository().id(),\
-                            src.version().fix().identifier(),\
-                            path)
-        path = os.path.join(self.root(), "artefacts", path)
-        
-        if not os.path.exists(path):
-            ensure_dir(os.path.dirname(path))
-            f_src = src.readable()
-            try:
-                with open(path, "w") as f_jsn:
-                    #print("Parsing AST: %s" % path)
-                    cgum.program.Program.parse_to_json_file(f_src.name, f_jsn)
-                    f_jsn.flush()
-                    #print("Parsed")
-            # prevent any cache-destroying partial ASTs
-            except:
-                if os.path.exists(path):
-                    os.unlink(path)
-                raise
-            finally:
-                f_src.close()
-
-        return cgum.program.Program.from_json_file(path)
-
-    # Returns the CGum annotated diff for a BugHunter diff
+    # Returns the CGum AST for a given SourceFile. If copy is set, a private
+    # copy of the AST is loaded, which the caller may modify, rather than the
+    # object that's shared through the cache.
+    #
+    # ASTs are stored by the hash of the blob that they were parsed from, and
+    # the version of the parser that produced them, so that each distinct
+    # blob is only parsed once across all fixes and repositories. When
+    # artefacts are held in files, the AST for each source file of a fix is
+    # also reachable from the directory for that fix, via a symbolic link to
+    # the shared AST.
+    def ast(self, src, copy=False):
+        (asts, key) = (self.asts(), self.__ast_key(src))
+        if not asts.exists(key):
+            with self.lock(AST_NAMESPACE, key):
+                if not asts.exists(key):
+                    produce = lambda output: self.parser().parse(src.path(), output)
+                    self.__produce([(asts, key)], produce)
+        return self.__load_ast(src, copy)
+
+    # Returns the CGum annotated diff for a BugHunter diff.
+    #
+    # If the diff hasn't been computed, it's computed by a single parser job,
+    # which also writes any of the ASTs for the diff that haven't been
+    # computed either (see bughunter.service). The locks for those ASTs
+    # aren't held, so that diffs never wait on each other's ASTs; at worst,
+    # an AST is produced twice.
     def diff(self, df):
-        ast_before = df.before().ast()
-        ast_after = df.after().ast()
+        store = self.artefacts(df.fix().repository())
+        key = df.key()
+        ident = ('diff', df.fix().repository().id(), key)
+        cached = self.__cache.get(ident)
+        if cached is not None:
+            return cached
+
+        self.compute_diff(df)
+        ast_before = self.ast(df.before())
+        ast_after = self.ast(df.after())
+        data = store.get(key)
+        loaded = cgum.diff.AnnotatedDiff.from_json(self.__decode(data), ast_before, ast_after)
+        self.__cache.put(ident, loaded, self.__weigh(data))
+        return loaded
+
+    # Ensures that a given diff has been computed and stored, without loading
+    # it (see Storage.diff)
+    def compute_diff(self, df):
+        (store, key) = (self.artefacts(df.fix().repository()), df.key())
+        if not store.exists(key):
+            with self.lock(df.fix().repository().id(), key):
+                if not store.exists(key):
+                    self.__produce_diff(df)
+
+    # Computes a given diff, together with any of its missing ASTs
+    def __produce_diff(self, df):
+        (before, after) = (df.before(), df.after())
+        (store, asts) = (self.artefacts(df.fix().repository()), self.asts())
+        sides = [(side, src) for (side, src) in [('before', before), ('after', after)]\
+                 if not asts.exists(self.__ast_key(src))]
+        outputs = [(store, df.key())] + [(asts, self.__ast_key(src)) for (_, src) in sides]
+
+        def produce(output, *paths):
+            kwargs = {"%s_ast" % side: path for ((side, _), path) in zip(sides, paths)}
+            self.parser().diff(before.path(), after.path(), output, **kwargs)
+        self.__produce(outputs, produce)
+
+    # Returns the failure recorded for a given diff, as a JSON document, or
+    # None if no failure was recorded by the current versions of the tools.
+    def failure(self, df):
+        store = self.artefacts(df.fix().repository())
+        if not store.exists(self.__failure_key(df)):
+            return None
+        try:
+            jsn = json.loads(store.get(self.__failure_key(df)).decode('utf-8'))
+        except KeyError:
+            return None
+        return jsn if jsn.get('versions') == TOOL_VERSIONS else None
+
+    # Records that a given diff couldn't be prepared, due to a given exception,
+    # after a given number of seconds. Should a parsing or differencing job
+    # have exceeded its resource limits, the failure records the limit that
+    # was exceeded, and the limits that were in force.
+    def record_failure(self, df, error, duration):
+        jsn = {'type': error.__class__.__name__,
+               'error': str(error),
+               'versions': TOOL_VERSIONS,
+               'duration': duration,
+               'time': time.time()}
+        if isinstance(error, execution.LimitExceeded):
+            jsn['limit'] = error.limit()
+            jsn['limits'] = None if self.__limits is None else self.__limits.to_json()
+        store = self.artefacts(df.fix().repository())
+        store.put(self.__failure_key(df), json.dumps(jsn).encode('utf-8'))
+
+    # Removes the failure recorded for a given diff, if any
+    def clear_failure(self, df):
+        self.artefacts(df.fix().repository()).delete(self.__failure_key(df))
+
+    # Returns a generator over every failure recorded by this storage, as
+    # (repository id, diff key, JSON document) tuples
+    def failures(self):
+        for namespace in self.namespaces():
+            if namespace.startswith("asts"):
+                continue
+            store = self.store(namespace)
+            keys = [k for k in store.keys() if k.endswith(Storage.FAILURE_SUFFIX)]
+            for (key, data) in sorted(store.get_many(keys).items()):
+                diff_key = key[:-len(Storage.FAILURE_SUFFIX)] + ".diff.json"
+                yield (namespace, diff_key, json.loads(data.decode('utf-8')))
+
+    # The suffix of the keys of failure artefacts
+    FAILURE_SUFFIX = ".failure.json"
+
+    # Returns the key of the failure artefact for a given diff
+    def __failure_key(self, df):
+        return "%s/%s%s" % (df.fix().identifier(), df.clean_name(), Storage.FAILURE_SUFFIX)
+
+    # Returns the key of the shared AST for a given SourceFile
+    def __ast_key(self, src):
+        sha = self.blob(src)
+        return "%s/%s.ast.json" % (sha[:2], sha)
+
+    # Loads the AST for a given SourceFile from the shared store, ensuring that
+    # the AST is linked to from the directory for its fix, if possible. Unless
+    # copy is set, the AST is shared through the cache.
+    def __load_ast(self, src, copy=False):
+        (asts, key) = (self.asts(), self.__ast_key(src))
+
+        fx = src.version().fix()
+        name = "after" if src.version().is_fixed() else "before"
+        name = "%s/%s.%s.ast.json" % (fx.identifier(), src.clean_name(), name)
+        (shared, path) = (asts.path(key), self.artefacts(fx.repository()).path(name))
+        if shared is not None and path is not None and (not os.path.islink(path) or \
+           not os.path.exists(path) or not os.path.samefile(path, shared)):
+            utility.link(shared, path)
+
+        if copy:
+            return cgum.program.Program.from_json(self.__decode(asts.get(key)))
+        ident = ('ast', PARSER_VERSION, key)
+        loaded = self.__cache.get(ident)
+        if loaded is None:
+            data = asts.get(key)
+            loaded = cgum.program.Program.from_json(self.__decode(data))
+            self.__cache.put(ident, loaded, self.__weigh(data))
+        return loaded
+
+    # Returns an estimate of the memory used by the object loaded from a
+    # given stored artefact, for the purposes of the cache
+    def __weigh(self, data):
+        return self.__values(data) * Storage.VALUE_SIZE
+
+    # Returns an estimate of the number of values (i.e., objects, arrays and
+    # scalars) within the JSON text of a given artefact, which is found by
+    # counting its separators, rather than by decoding it
+    def __values(self, data):
+        return data.count(b',') + data.count(b'[') + data.count(b'{') + 1
+
+    # Returns the JSON document held by the contents of an artefact
+    def __decode(self, data):
+        return json.loads(data.decode('utf-8'))
+
+    # Calls a given function to produce a number of JSON artefacts, given as a
+    # list of (store, key) pairs, passing it the path to which each artefact
+    # should be written, before adding those artefacts to their stores.
+    def __produce(self, artefacts, produce):
+        paths = [store.path(key) or self.__scratch() for (store, key) in artefacts]
+        try:
+            produce(*paths)
+            for ((store, key), path) in zip(artefacts, paths):
+                store.ingest(key, path)
+        finally:
+            for ((store, key), path) in zip(artefacts, paths):
+                if store.path(key) != path and os.path.exists(path):
+                    os.remove(path)
+
+    # Returns the path to a new, empty scratch file, to which artefacts that
+    # aren't held in files may be written before they're stored
+    def __scratch(self):
+        d = os.path.join(self.root(), "artefacts", "tmp")
+        utility.ensure_dir(d)
+        (fd, path) = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=d)
+        os.close(fd)
+        return path
+
+    # Returns the store that holds the artefacts within a given namespace,
+    # named by a path relative to the artefacts directory (e.g., the
+    # identifier of a repository). Each store belongs to the process that
+    # opened it.
+    def store(self, namespace):
+        key = (os.getpid(), namespace)
+        if not key in self.__stores:
+            self.__stores[key] = self.__open_store(namespace, self.__backend)
+        return self.__stores[key]
+
+    # Opens the store for a given namespace, using a given backend
+    def __open_store(self, namespace, backend):
+        path = os.path.join(self.root(), "artefacts", namespace)
+        if backend == 'pack':
+            opened = store.PackStore(os.path.join(path, Storage.PACK))
+        else:
+            opened = store.DirectoryStore(path)
+        manifest = os.path.join(path, "%s.manifest" % backend)
+        opened = store.ManifestStore(opened, manifest, TOOL_VERSION)
+        return store.CompressedStore(opened, self.__codec)
+
+    # Returns the manifest for the artefacts of a given repository, which
+    # records the size, tool version and time of writing of each artefact
+    # (see store.ManifestStore)
+    def manifest(self, repo):
+        return self.artefacts(repo).inner()
+
+    # Returns a list of the diffs for a given repository that have yet to be
+    # prepared (i.e., whose diff or donor pools are missing, or, if actions is
+    # set, whose repair actions are missing), excluding those whose
+    # preparation failed using the current versions of the tools, unless
+    # failed is set. Only the manifest for the repository is consulted.
+    #
+    # The units of work that a journal records as finished may be given, as
+    # a dictionary of their inputs, indexed by key (see
+    # Journal.finished_units), in which case their diffs are excluded before
+    # anything else is done with them.
+    def pending(self, repo, failed=False, actions=False, finished=None):
+        entries = {e['key']: e for e in self.manifest(repo).entries()}
+        pending = []
+        for fx in repo.iter_fixes():
+            for df in fx.diffs():
+                if finished:
+                    unit = journal.diff_key(df)
+                    if unit in finished and journal.diff_unit(df)[1] == finished[unit]:
+                        continue
+                failure = entries.get(self.__failure_key(df))
+                if not failed and failure is not None and failure['version'] == TOOL_VERSION:
+                    continue
+                needed = [df.key(),\
+                          pool.ConcreteDonorPoolSet.locator(df),\
+                          pool.AbstractDonorPoolSet.locator(df)]
+                if actions:
+                    needed.append(collection.RepairActions.locator(df))
+                if not all(k in entries for k in needed):
+                    pending.append(df)
+        return pending
+
+    # Returns the name of the codec used to compress the artefact with a given
+    # key
+    def __codec(self, key):
+        for (typ, suffixes) in Storage.ARTEFACT_TYPES.items():
+            if key.endswith(suffixes):
+                return self.__compress.get(typ, 'none')
+        return 'none'
+
+    # Returns a handler for the preprocessed form of a given source file, for
+    # a given program version
+    def preprocessed(self, version, fn):
+        return PreprocessedFile(self.__master, version, fn)
+
+    # Returns the store that holds the artefacts for a given repository
+    def artefacts(self, repo):
+        return self.store(repo.id())
+
+    # Returns the store that holds the ASTs produced by the current version
+    # of the parser
+    def asts(self):
+        return self.store(AST_NAMESPACE)
+
+    # Returns the namespaces of all stores within this storage
+    def namespaces(self):
+        root = os.path.join(self.root(), "artefacts")
+        found = []
+        if os.path.isdir(root):
+            found += [d for d in sorted(os.listdir(root))\
+                      if len(d) == 40 and os.path.isdir(os.path.join(root, d))]
+        if os.path.isdir(os.path.join(root, "asts")):
+            found += [os.path.join("asts", v) for v in sorted(os.listdir(os.path.join(root, "asts")))]
+        return found
+
+    # Moves every artefact held using a given backend into the stores used by
+    # this storage, and returns the number of artefacts that were moved. The
+    # manifests of the source stores are rebuilt beforehand, so that every
+    # artefact on disk is moved. The links from the directories of fixes to
+    # their shared ASTs (which aren't recorded by manifests) are dropped,
+    # rather than copied, and are recreated as the ASTs are loaded.
+    def migrate(self, backend):
+        assert backend != self.__backend, "cannot migrate a backend to itself"
+        moved = 0
+        for namespace in self.namespaces():
+            source = self.__open_store(namespace, backend)
+            source.inner().rebuild()
+            if not namespace.startswith("asts"):
+                for key in source.keys():
+                    if key.endswith(".ast.json"):
+                        source.delete(key)
+            n = store.migrate(source, self.store(namespace))
+            source.discard()
+            if n > 0:
+                print("migrated %d artefacts: %s" % (n, namespace))
+            moved += n
+        return moved
+
+    # Evicts artefacts until the artefacts held by this storage occupy no
+    # more than a given number of bytes (as recorded by their manifests), and
+    # returns the number of bytes that were freed. Artefacts produced by
+    # other versions of the tools (including the ASTs of other versions of
+    # the parser) are evicted first, followed by the remaining artefacts, in
+    # the order given by a policy from Storage.GC_POLICIES. The copies of
+    # source files (see Storage.source), which aren't recorded by manifests,
+    # are evicted alongside the artefacts, using their file times.
+    #
+    # The artefacts that belong to a single diff (its diff, donor pools,
+    # repair actions, preprocessed files, recorded failure, and links to its
+    # ASTs) depend on one another, and are evicted together, as a unit that
+    # was last used when any of them was last used. Each unit is deleted
+    # while holding the locks that are used to produce its artefacts. Shared
+    # ASTs are evicted individually; should a diff whose AST was evicted be
+    # loaded, the AST is simply parsed again. Only the bytes that are
+    # actually released are counted as freed: a file that's still linked to
+    # from elsewhere (e.g., a shared AST that's hard linked by a fix written
+    # by an older version of BugHunter) frees nothing until its last link is
+    # removed.
+    def gc(self, max_bytes, policy='lru'):
+        assert policy in Storage.GC_POLICIES, ("unrecognised gc policy: %s" % policy)
+        field = 'atime' if policy == 'lru' else 'time'
+        units = []
+        for namespace in self.namespaces():
+            manifest = self.store(namespace).inner()
+            manifest.flush()
+            grouped = {}
+            for entry in manifest.entries():
+                grouped.setdefault(self.__unit(namespace, entry['key']), []).append(entry)
+            for (unit, entries) in grouped.items():
+                stale = namespace.startswith("asts") and namespace != AST_NAMESPACE
+                stale = stale or any(e['version'] not in (None, TOOL_VERSION) for e in entries)
+                used = max((e[field] or e['time'] or 0) for e in entries)
+                size = sum(e['size'] for e in entries)
+                units.append((not stale, used, namespace, unit, entries, size))
+        for entry in self.__sources():
+            units.append((True, entry[field], Storage.SOURCES, entry['key'], [entry], entry['size']))
+
+        total = sum(u[5] for u in units)
+        freed = 0
+        vacuum = set()
+        for (_, _, namespace, unit, entries, size) in sorted(units, key=lambda u: u[:4]):
+            if total - freed <= max_bytes:
+                break
+            if namespace == Storage.SOURCES:
+                freed += self.__unlink(os.path.join(self.root(), "artefacts", "sources", unit))
+                continue
+            sizes = {e['key']: e['size'] for e in entries}
+            keys = set(sizes)
+            if not namespace.startswith("asts"):
+                keys.update(unit + suffix for suffix in Storage.DIFF_SUFFIXES)
+            with contextlib.ExitStack() as stack:
+                for (ns, key) in self.__unit_locks(namespace, unit):
+                    stack.enter_context(self.lock(ns, key))
+                store = self.store(namespace)
+                for key in sorted(keys):
+                    path = store.path(key)
+                    if path is None:
+                        freed += sizes.get(key, 0)
+                    else:
+                        freed += self.__released(path)
+                    store.delete(key)
+            vacuum.add(namespace)
+
+        for namespace in sorted(vacuum):
+            self.store(namespace).vacuum()
+        print("evicted %d bytes of artefacts; %d bytes remain" % (freed, total - freed))
+        return freed
+
+    # The name used by Storage.gc for the copies of source files
+    SOURCES = "sources"
+
+    # Returns pseudo-manifest entries for the copies of source files, whose
+    # access and write times are given by their files
+    def __sources(self):
+        root = os.path.join(self.root(), "artefacts", "sources")
+        found = []
+        for (d, _, files) in os.walk(root):
+            for fn in files:
+                try:
+                    st = os.lstat(os.path.join(d, fn))
+                except FileNotFoundError:
+                    continue
+                key = "%s/%s" % (os.path.relpath(d, root).replace(os.sep, '/'), fn)
+                found.append({'key': key, 'size': st.st_size, 'version': None,\
+                              'time': st.st_mtime, 'atime': st.st_atime})
+        return found
+
+    # Returns the number of bytes that would be released by removing the file
+    # at a given path: nothing, if the path is a symbolic link, or if the file
+    # has other (hard) links
+    def __released(self, path):
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return 0
+        if stat.S_ISLNK(st.st_mode) or st.st_nlink > 1:
+            return 0
+        return st.st_size
+
+    # Removes the file at a given path, if it exists, and returns the number
+    # of bytes that were released
+    def __unlink(self, path):
+        released = self.__released(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return released
+
+    # Returns the locks, as (namespace, key) pairs, that are used to produce
+    # the artefacts within a given unit of eviction (see Storage.gc), in the
+    # order in which they must be acquired. Producers nest these locks from
+    # the outermost inwards (e.g., repair actions are mined while holding the
+    # lock for their actions, which in turn takes the lock for their diff,
+    # and a diff may fetch its repository, which takes the lock for the
+    # repository), so they're acquired in the same order here.
+    def __unit_locks(self, namespace, unit):
+        if namespace.startswith("asts"):
+            return [(namespace, unit)]
+        suffixes = ('.actions.json', '.abstract.pool.json', '.concrete.pool.json', '.diff.json')
+        locks = [(namespace, unit + suffix) for suffix in suffixes]
+        fx = unit.split('/')[0]
+        if self.__clone == 'full':
+            return locks + [("repositories", namespace)]
+        return locks + [(namespace, "%s.preprocess" % v) for v in ("%s~1" % fx, fx)]
 
-        path = df.location()
+    # Returns the name of the unit of eviction to which an artefact with a
+    # given key within a given namespace belongs. The artefacts for a diff
+    # are named by the stem of their keys (e.g., "<fix>/<file>"); all other
+    # artefacts form units of their own.
+    def __unit(self, namespace, key):
+        if not namespace.startswith("asts"):
+            for suffix in Storage.DIFF_SUFFIXES:
+                if key.endswith(suffix):
+                    return key[:-len(suffix)]
+        return key
+
+    # Returns the absolute path to a copy of a given SourceFile on disk.
+    # Copies are addressed by the hash of their blob, so each distinct blob
+    # is written to disk at most once, and its path is stable across calls,
+    # fixes and repositories.
+    def source(self, src):
+        sha = self.blob(src)
+        path = os.path.join(self.root(), "artefacts", "sources", sha[:2], "%s.c" % sha)
         if not os.path.exists(path):
-            ensure_dir(os.path.dirname(path))
-            src_before_h = df.before().readable()
-            src_after_h = df.after().readable()
-            try:
-                with open(path, "w") as f_jsn:
-                    cgum.diff.AnnotatedDiff.parse_to_json_file(src_before_h.name, \
-                                                               src_after_h.name, \
-                                                               f_jsn)
-                    f_jsn.flush()
-
-            # again, prevent cache-destroying diffs
-            except:
-                if os.path.exists(path):
-                    os.unlink(path)
-                raise
-            finally:
-                src_before_h.close()
-                src_after_h.close()
-
-        return cgum.diff.AnnotatedDiff.from_file(path, ast_before, ast_after)
+            repo = src.version().fix().repository()
+            (_, data) = self.blobs(repo).read(sha)
+            utility.write_atomic(path, data)
+        return path
+
+    # Returns the hash of the blob for a given SourceFile. If the hash wasn't
+    # recorded by the scanner, it's looked up using Git.
+    def blob(self, src):
+        sha = src.blob()
+        if sha is None:
+            repo = src.version().fix().repository()
+            name = "%s:%s" % (src.version().identifier(), src.name())
+            (sha, _) = self.blobs(repo).read(name)
+        return sha
 
     # Returns a handler for a given database file.
     def database(self, repo):
@@ -84,14 +616,130 @@ class Storage(object):
     # Returns a GitPython repository object for a given repository. Clones the
     # repository to disk, if necessary.
     def git(self, repo):
+        if self.__fetch and not repo.id() in self.__fetched:
+            self.update(repo)
+        return self.__open(repo)
+
+    # Opens the local clone of a given repository, creating it if necessary
+    def __open(self, repo):
         loc = os.path.join(self.root(), "repositories", repo.id())
         if not os.path.exists(loc):
-            print("cloning remote repository: %s" % repo.address())
-            return git.Repo.clone_from(repo.address(),\
-                                       loc,\
-                                       odbt=git.GitCmdObjectDB)
+            with self.lock("repositories", repo.id()):
+                if not os.path.exists(loc):
+                    self.__clone_to(repo, loc)
         return git.Repo(loc, odbt=git.GitCmdObjectDB)
 
+    # Clones a given repository to a given location. The repository is cloned
+    # into a temporary directory, which is only moved into place once the
+    # clone is complete.
+    def __clone_to(self, repo, loc):
+        print("cloning remote repository: %s" % repo.address())
+        utility.ensure_dir(os.path.dirname(loc))
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(loc))
+        try:
+            if self.__clone == 'full':
+                git.Repo.clone_from(repo.address(), tmp, odbt=git.GitCmdObjectDB)
+            else:
+                args = ['--bare']
+                if self.__clone == 'blobless':
+                    args.append('--filter=blob:none')
+                g = git.Repo.clone_from(repo.address(), tmp, odbt=git.GitCmdObjectDB,\
+                                        multi_options=args)
+
+                # fetch the branches of the remote directly into the branches
+                # of the bare clone, so that they're kept up to date
+                with g.config_writer() as cfg:
+                    cfg.set_value('remote "origin"', 'fetch', Storage.BARE_REFSPEC)
+            os.rename(tmp, loc)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # Returns a context manager that holds an exclusive lock on an artefact,
+    # named by its namespace and key, across every process that shares this
+    # storage. Processes that produce an artefact should hold its lock, and
+    # check whether the artefact exists once they've acquired it, so that
+    # work that's in progress elsewhere is waited for, rather than repeated.
+    def lock(self, namespace, key):
+        name = hashlib.sha1(("%s:%s" % (namespace, key)).encode('utf-8')).hexdigest()
+        return utility.file_lock(os.path.join(self.root(), "locks", name[:2], "%s.lock" % name))
+
+    # Returns the pool of blob readers for a given repository. Each pool
+    # belongs to the process that created it, since its readers can't be
+    # shared with forked processes.
+    def blobs(self, repo):
+        key = (os.getpid(), repo.id())
+        if not key in self.__blobs:
+            self.__blobs[key] = blob.BlobReaderPool(self.git(repo).git_dir)
+        return self.__blobs[key]
+
+    # Returns the in-memory cache of loaded ASTs and diffs, which records the
+    # number of hits and misses
+    def cache(self):
+        return self.__cache
+
+    # Returns the parser service for the current process
+    def parser(self):
+        pid = os.getpid()
+        if not pid in self.__parsers:
+            self.__parsers[pid] = service.ParserService(self.__parser_command, self.__limits)
+        return self.__parsers[pid]
+
+    # Refspec used to update the branches of bare clones
+    BARE_REFSPEC = '+refs/heads/*:refs/heads/*'
+
+    # Brings the local clone of a given repository up to date with its remote,
+    # and returns the hash of its (possibly updated) HEAD commit. The local
+    # clone is treated as a mirror: if the remote history has been rewritten,
+    # the clone is reset to match it. Should the HEAD of the clone be detached
+    # (e.g., because a version was checked out for preprocessing), it's reset
+    # to the HEAD of the remote.
+    def update(self, repo):
+        g = self.__open(repo)
+        with self.lock("repositories", repo.id()):
+            print("fetching remote repository: %s" % repo.address())
+            if g.bare:
+                g.remotes.origin.fetch(Storage.BARE_REFSPEC, prune=True)
+            else:
+                g.remotes.origin.fetch()
+                if g.head.is_detached:
+                    target = self.__remote_head(g)
+                else:
+                    tracking = g.active_branch.tracking_branch()
+                    target = None if tracking is None else tracking.commit
+                if target is not None:
+                    g.head.reset(target, index=True, working_tree=True)
+        self.__fetched.add(repo.id())
+        return g.head.commit.hexsha
+
+    # Returns the commit at the HEAD of the remote of a given (non-bare)
+    # clone, asking the remote for its HEAD if the clone doesn't know it
+    def __remote_head(self, g):
+        try:
+            return g.commit('refs/remotes/origin/HEAD')
+        except (git.BadName, ValueError):
+            g.git.remote('set-head', 'origin', '--auto')
+            return g.commit('refs/remotes/origin/HEAD')
+
+    # Returns a context manager that provides the path to a temporary working
+    # tree for a given commit within a bare clone of a given repository. The
+    # working tree is destroyed once the context is exited. For partial
+    # clones, the contents of the commit are fetched from the remote as
+    # they're checked out.
+    @contextlib.contextmanager
+    def worktree(self, repo, commit):
+        g = self.git(repo)
+        path = tempfile.mkdtemp(prefix="bughunter-")
+        try:
+            g.git.worktree('add', '--detach', '--force', path, commit)
+        except:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        try:
+            yield path
+        finally:
+            g.git.worktree('remove', '--force', path)
+            shutil.rmtree(path, ignore_errors=True)
+
     # Returns the absolute path to the root of this storage on disk
     def root(self):
         return self.__root
@@ -99,20 +747,21 @@ class Storage(object):
     # Returns the absolute path to an artefact
     def locator(self, artefact):
         if isinstance(artefact, DatabaseFile):
-            rel = os.path.join(artefact.repository().id(), "fixes.json")
+            rel = os.path.join(artefact.repository().id(), "fixes.jsonl")
         return os.path.join(self.root(), "artefacts", rel)
 
-    # Determines whether a given artefact exists on disk.
+    # Determines whether a given artefact exists on disk
     def exists(self, artefact):
+        if isinstance(artefact, diff.FileDiff):
+            store = self.artefacts(artefact.fix().repository())
+            return store.exists(artefact.key())
         return os.path.isfile(self.locator(artefact))
 
     # Returns a writable file for a given artefact. Any writes to this file
-    # will be reflected in the actual storage after the file has been
-    # closed.
+    # will be reflected in the actual storage, atomically, after the file has
+    # been closed.
     def writer(self, artefact):
-        loc = self.locator(artefact)
-        utility.ensure_dir(os.path.dirname(loc))
-        return open(loc, 'w')
+        return utility.atomic_writer(self.locator(artefact))
 
     # Returns a readable file for a given artefact.
     def reader(self, artefact):
@@ -121,7 +770,12 @@ class Storage(object):
             raise Exception("No physical file found on disk for artefact at location: %s" % loc)
         return open(loc, 'r')
         
-# Provides access to the database of mined bug fixes for a particular repo
+# Provides access to the database of mined bug fixes for a particular repo.
+#
+# The database is stored as a line-delimited JSON file. The first line of the
+# file records the HEAD commit that the database was scanned from, and each
+# subsequent line holds the JSON description of a single fix, allowing fixes
+# to be read and written one at a time.
 class DatabaseFile(object):
 
     # Constructs a new database file for a given Git repository.
@@ -135,30 +789,189 @@ class DatabaseFile(object):
 
     # Determines whether this file exists on disk.
     def exists(self):
+        self.__migrate()
         return self.__master.storage().exists(self)
 
     # Returns a list of the bug fixes contained within this database file.
     # If the file doesn't exist, then the provided Scanner is used to generate
     # it.
     def read(self, scanner):
+        return list(self.iter(scanner))
+
+    # Returns a generator over the bug fixes contained within this database
+    # file, which reads a single fix from disk at a time. If the file doesn't
+    # exist, then the provided Scanner is used to generate it first: each fix
+    # is written to disk as soon as it is found, and the file is only committed
+    # to storage once the scan is complete. The file is read without holding
+    # its lock, since new versions of the file replace the old atomically.
+    def iter(self, scanner):
         if not self.exists():
-            fixes = scanner.scan(self.repository())
-            self.write(fixes)
-        else:
-            f = self.__master.storage().reader(self)
-            fixes = json.load(f)
-            fixes = [fix.Fix.from_json(self.__repository, fx) for fx in fixes]
-            f.close()
-        return fixes
-
-    # Writes a list of bug fixes to this database file
-    def write(self, fixes):
-        f = self.__master.storage().writer(self)
+            self.__scan_once(scanner)
+        return self.__stream()
+
+    # Scans the repository for this file, unless another process has already
+    # done so by the time that the lock for this file is acquired. The lock
+    # is held until the scan is complete, so that each repository is only
+    # scanned once, no matter how many processes are waiting for it.
+    def __scan_once(self, scanner):
+        with self.__lock():
+            if self.exists():
+                return
+            head = self.repository().repository().head.commit.hexsha
+            self.__scan(scanner, head)
+
+    # Returns a context manager that holds the lock for this file
+    def __lock(self):
+        return self.__master.storage().lock(self.__repository.id(), "fixes.jsonl")
+
+    # Updates the local clone of the repository, before adding any bug fixes
+    # that were introduced since this database file was last written to it.
+    # Only the commits between the previously scanned HEAD and the new HEAD
+    # are scanned, unless the history of the repository has been rewritten,
+    # or the file doesn't record the HEAD that it was scanned from.
+    def refresh(self, scanner):
+        with self.__lock():
+            self.__refresh(scanner)
+
+    def __refresh(self, scanner):
+        repo = self.repository()
+        head = self.__master.storage().update(repo)
+        last = self.head()
+        if last == head:
+            return
+        if last is None or not self.__descends(last, head):
+            self.__scan(scanner, head)
+            return
+
+        # write the new fixes, followed by the existing fixes that weren't
+        # rediscovered by the scan
+        with self.__writer(head) as (f, write):
+            ids = set()
+            for jsn in scanner.stream(repo, since=last, until=head):
+                ids.add(jsn['id'])
+                write(jsn)
+            for jsn in self.__lines():
+                if not jsn['id'] in ids:
+                    write(jsn)
+
+    # Returns the hash of the HEAD commit that this database was scanned from,
+    # or None if that information isn't recorded by the file.
+    def head(self):
+        if not self.exists():
+            return None
+        with self.__master.storage().reader(self) as f:
+            return json.loads(f.readline())['head']
+
+    # Writes a collection of bug fixes, scanned from a given HEAD commit, to
+    # this database file
+    def write(self, fixes, head=None):
+        with self.__lock():
+            with self.__writer(head) as (f, write):
+                for fx in fixes:
+                    write(fx.to_json())
+
+    # Determines whether a given commit is an ancestor of another commit
+    # within the repository for this file.
+    def __descends(self, ancestor, commit):
         try:
-            json.dump([fx.to_json() for fx in fixes], f, indent=2)
-            f.close()
-        # destroy any partially written files
-        except:
-            f.close()
-            os.path.isfile(f.name) and os.remove(f.name)
-            raise
+            return self.repository().repository().is_ancestor(ancestor, commit)
+        except git.GitCommandError:
+            return False
+
+    # Scans the repository for this file up to a given HEAD commit, writing
+    # each fix to disk as it's found.
+    def __scan(self, scanner, head):
+        repo = self.repository()
+        print("scanning for fixes: %s" % repo.address())
+        with self.__writer(head) as (f, write):
+            for jsn in scanner.stream(repo, until=head):
+                write(jsn)
+
+    # Returns a generator over the bug fixes within this file
+    def __stream(self):
+        for jsn in self.__lines():
+            yield fix.Fix.from_json(self.__repository, jsn)
+
+    # Returns a generator over the JSON descriptions of the fixes in this file
+    def __lines(self):
+        with self.__master.storage().reader(self) as f:
+            f.readline()
+            for line in f:
+                yield json.loads(line)
+
+    # Returns a context manager for writing a new version of this file,
+    # scanned from a given HEAD commit. The context manager provides the
+    # underlying file, together with a function that writes the JSON
+    # description of a single fix to it. The new version of the file only
+    # replaces the old version once the context is successfully exited;
+    # should an error occur, the partially written file is destroyed.
+    @contextlib.contextmanager
+    def __writer(self, head):
+        with self.__master.storage().writer(self) as f:
+            write = lambda jsn: f.write(json.dumps(jsn) + "\n")
+            write({'head': head})
+            yield (f, write)
+
+    # Converts any database file written by an older version of BugHunter,
+    # which stores a single JSON document, to the line-delimited format. The
+    # changes made by each fix, which older versions didn't record, are
+    # described by the scanner as the file is converted, so that they're
+    # never computed again once the fixes are loaded.
+    def __migrate(self):
+        loc = self.__master.storage().locator(self)
+        legacy = os.path.join(os.path.dirname(loc), "fixes.json")
+        if os.path.isfile(loc) or not os.path.isfile(legacy):
+            return
+        with self.__lock():
+            if not os.path.isfile(legacy):
+                return
+            with open(legacy, 'r') as f:
+                jsn = json.load(f)
+            if isinstance(jsn, list):
+                jsn = {'head': None, 'fixes': jsn}
+            missing = [fx['id'] for fx in jsn['fixes'] if fx.get('changes') is None]
+            described = self.__master.scanner().describe_all(self.repository(), missing)
+            with self.__writer(jsn['head']) as (f, write):
+                for fx in jsn['fixes']:
+                    if fx.get('changes') is None and fx['id'] in described:
+                        fx = dict(fx, changes=described[fx['id']]['changes'])
+                    write(fx)
+            os.remove(legacy)
+
+# Provides access to the preprocessed form of a source file for a particular
+# program version, which is held within the artefact store for its repository.
+class PreprocessedFile(object):
+    def __init__(self, master, version, name):
+        self.__master = master
+        self.__version = version
+        self.__name = name
+
+    # Returns the key of this file within the artefact store
+    def key(self):
+        side = "after" if self.__version.is_fixed() else "before"
+        return "%s/%s.%s.i" % (self.__version.fix().identifier(),\
+                               source.SourceFile.clean_filename(self.__name),\
+                               side)
+
+    # Returns the artefact store that holds this file
+    def store(self):
+        repo = self.__version.fix().repository()
+        return self.__master.storage().artefacts(repo)
+
+    # Determines whether this file has been stored
+    def exists(self):
+        return self.store().exists(self.key())
+
+    # Stores the contents of a file at a given path as this file. If no path
+    # is given (i.e., the preprocessor didn't produce the file), nothing is
+    # stored.
+    def write_from(self, path):
+        if path is None:
+            print("no preprocessed file found for: %s" % self.__name)
+            return
+        with open(path, 'rb') as f:
+            self.store().put(self.key(), f.read())
+
+    # Returns a readable (binary) file for the contents of this file
+    def readable(self):
+        return io.BytesIO(self.store().get(self.key()))
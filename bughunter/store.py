@@ -0,0 +1,504 @@
+# This module provides the backends used by Storage to hold artefacts (e.g.,
+# ASTs, diffs, donor pools and repair actions). Each store holds the artefacts
+# for a single namespace (e.g., a repository), indexed by a relative key (e.g.,
+# "<fix>/<file>.diff.json"), and implements the same interface:
+#
+#   get(key)            returns the contents of an artefact, as bytes
+#   get_many(keys)      returns a dictionary of the artefacts that exist
+#                       among a given list of keys
+#   put(key, data)      stores an artefact, atomically
+#   put_many(items)     stores a dictionary of artefacts
+#   ingest(key, path)   stores an artefact that was written to a file, taking
+#                       ownership of that file
+#   exists(key)         determines whether an artefact exists
+#   delete(key)         destroys an artefact, if it exists
+#   keys(prefix)        returns the keys of all artefacts with a given prefix
+#   sizes(prefix)       returns a dictionary of the stored sizes (in bytes) of
+#                       all artefacts with a given prefix, indexed by key
+#   path(key)           returns the path of the file that holds an artefact,
+#                       or None if artefacts aren't held in individual files
+#   vacuum()            reclaims the space left behind by deleted artefacts
+#   discard()           removes the store from disk, if it's empty
+#
+# DirectoryStore keeps each artefact in its own file, whereas PackStore keeps
+# all of the artefacts for a namespace within a single SQLite database, which
+# avoids creating millions of small files for large corpora. Either may be
+# wrapped by a ManifestStore, which keeps an index of the artefacts within the
+# store, and by a CompressedStore, which compresses artefacts transparently.
+import os
+import sqlite3
+import threading
+import time
+import bughunter.compression as compression
+from bughunter.utility import *
+
+# Stores each artefact as a separate file, beneath a given directory. Keys
+# always name a file within a subdirectory of the store (e.g., the directory
+# for a fix), so files at the top level of the directory (e.g., the database
+# of fixes for a repository) are left alone. Symbolic links within the
+# directory (e.g., the links from fixes to their shared ASTs) aren't
+# artefacts of the store, so they're omitted from its listings, although
+# they may still be read and deleted by key.
+class DirectoryStore(object):
+    def __init__(self, root):
+        self.__root = root
+
+    # Returns the directory that holds this store
+    def root(self):
+        return self.__root
+
+    def path(self, key):
+        return os.path.join(self.__root, key)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            try:
+                found[key] = self.get(key)
+            except KeyError:
+                pass
+        return found
+
+    def put(self, key, data):
+        write_atomic(self.path(key), data)
+
+    def put_many(self, items):
+        for (key, data) in items.items():
+            self.put(key, data)
+
+    def ingest(self, key, path):
+        if path != self.path(key):
+            ensure_dir(os.path.dirname(self.path(key)))
+            os.replace(path, self.path(key))
+
+    def delete(self, key):
+        if os.path.lexists(self.path(key)):
+            os.remove(self.path(key))
+
+    def keys(self, prefix=''):
+        return sorted(self.sizes(prefix))
+
+    def sizes(self, prefix=''):
+        sizes = {}
+        for (d, _, files) in os.walk(self.__root):
+            rel = os.path.relpath(d, self.__root)
+            if rel == '.':
+                continue
+            for fn in files:
+                key = "%s/%s" % (rel.replace(os.sep, '/'), fn)
+                path = os.path.join(d, fn)
+                if key.startswith(prefix) and not fn.startswith('.tmp-') and \
+                   not os.path.islink(path):
+                    try:
+                        sizes[key] = os.path.getsize(path)
+                    except FileNotFoundError:
+                        pass
+        return sizes
+
+    def vacuum(self):
+        pass
+
+    def discard(self):
+        if not os.path.isdir(self.__root):
+            return
+        for (d, _, files) in os.walk(self.__root, topdown=False):
+            if d == self.__root:
+                continue
+            for fn in files:
+                if os.path.islink(os.path.join(d, fn)):
+                    os.remove(os.path.join(d, fn))
+            if not os.listdir(d):
+                os.rmdir(d)
+
+    def close(self):
+        pass
+
+# Stores artefacts within a single SQLite database file. Several processes
+# may safely read from and write to the same pack; each process should open
+# the pack separately. Since SQLite's write-ahead log can't be shared across
+# machines, packs use a rollback journal (converting any pack that was
+# written with a write-ahead log), so that they may be held on a shared
+# filesystem.
+class PackStore(object):
+    # The maximum number of keys within a single query
+    CHUNK = 500
+
+    def __init__(self, fn):
+        ensure_dir(os.path.dirname(fn))
+        self.__fn = fn
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(fn, timeout=60, isolation_level=None,\
+                                    check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=DELETE")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS artefacts "\
+                          "(key TEXT PRIMARY KEY, data BLOB NOT NULL)")
+
+    # Returns the path to the database file for this pack
+    def location(self):
+        return self.__fn
+
+    def path(self, key):
+        return None
+
+    def exists(self, key):
+        with self.__lock:
+            row = self.__db.execute("SELECT 1 FROM artefacts WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def get(self, key):
+        with self.__lock:
+            row = self.__db.execute("SELECT data FROM artefacts WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return bytes(row[0])
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), PackStore.CHUNK):
+            chunk = keys[i:i + PackStore.CHUNK]
+            query = "SELECT key, data FROM artefacts WHERE key IN (%s)" % \
+                ",".join("?" * len(chunk))
+            with self.__lock:
+                rows = self.__db.execute(query, chunk).fetchall()
+            found.update((k, bytes(d)) for (k, d) in rows)
+        return found
+
+    def put(self, key, data):
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO artefacts (key, data) VALUES (?, ?)",\
+                              (key, sqlite3.Binary(data)))
+
+    def put_many(self, items):
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN")
+                self.__db.executemany("INSERT OR REPLACE INTO artefacts (key, data) VALUES (?, ?)",\
+                                      ((k, sqlite3.Binary(d)) for (k, d) in items.items()))
+
+    def ingest(self, key, path):
+        with open(path, 'rb') as f:
+            self.put(key, f.read())
+        os.remove(path)
+
+    def delete(self, key):
+        with self.__lock:
+            self.__db.execute("DELETE FROM artefacts WHERE key = ?", (key,))
+
+    def keys(self, prefix=''):
+        with self.__lock:
+            rows = self.__db.execute("SELECT key FROM artefacts "\
+                                     "WHERE substr(key, 1, ?) = ? ORDER BY key",\
+                                     (len(prefix), prefix)).fetchall()
+        return [r[0] for r in rows]
+
+    def sizes(self, prefix=''):
+        with self.__lock:
+            rows = self.__db.execute("SELECT key, length(data) FROM artefacts "\
+                                     "WHERE substr(key, 1, ?) = ?",\
+                                     (len(prefix), prefix)).fetchall()
+        return dict(rows)
+
+    def vacuum(self):
+        with self.__lock:
+            self.__db.execute("VACUUM")
+
+    def discard(self):
+        if self.keys():
+            return
+        self.close()
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            if os.path.exists(self.__fn + suffix):
+                os.remove(self.__fn + suffix)
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+# Wraps another store, compressing each artefact as it's written, using the
+# codec chosen for it by a given function of its key, and decompressing each
+# artefact as it's read, regardless of the codec that it was written with.
+# Artefacts keep their keys when compressed.
+class CompressedStore(object):
+    def __init__(self, store, codec):
+        self.__store = store
+        self.__codec = codec
+
+    # Returns the store wrapped by this store
+    def inner(self):
+        return self.__store
+
+    def path(self, key):
+        return self.__store.path(key)
+
+    def exists(self, key):
+        return self.__store.exists(key)
+
+    def get(self, key):
+        return compression.decompress(self.__store.get(key))
+
+    def get_many(self, keys):
+        found = self.__store.get_many(keys)
+        return {k: compression.decompress(d) for (k, d) in found.items()}
+
+    def put(self, key, data):
+        self.__store.put(key, compression.compress(data, self.__codec(key)))
+
+    def put_many(self, items):
+        items = {k: compression.compress(d, self.__codec(k)) for (k, d) in items.items()}
+        self.__store.put_many(items)
+
+    def ingest(self, key, path):
+        if self.__codec(key) == 'none':
+            self.__store.ingest(key, path)
+            return
+        with open(path, 'rb') as f:
+            self.put(key, f.read())
+        if path != self.path(key):
+            os.remove(path)
+
+    def delete(self, key):
+        self.__store.delete(key)
+
+    def keys(self, prefix=''):
+        return self.__store.keys(prefix)
+
+    def sizes(self, prefix=''):
+        return self.__store.sizes(prefix)
+
+    def vacuum(self):
+        self.__store.vacuum()
+
+    def discard(self):
+        self.__store.discard()
+
+    def close(self):
+        self.__store.close()
+
+# Wraps another store, and records the key, stored size, tool version and
+# time of writing of every artefact that's written to it within an index,
+# held by a given SQLite database file. Listings are answered by the index,
+# without touching the wrapped store. Existence checks trust the index, and
+# only ask the wrapped store about artefacts that the index doesn't hold, or
+# when they're asked to verify that an artefact is still held by it.
+# Artefacts that are deleted behind the index's back are dropped from the
+# index when they fail to be read, or when the index is rebuilt.
+#
+# The index also records the time at which each artefact was last accessed
+# (i.e., read or written), so that the least recently used artefacts may be
+# evicted. Reads are recorded in batches, rather than one at a time, so the
+# access times held by the index may lag behind by up to TOUCH_INTERVAL
+# seconds (or TOUCH_BATCH reads), until the store is flushed or closed.
+#
+# When the index is first created, it's populated from the contents of the
+# wrapped store; should the store be modified by other means, the index may
+# be rebuilt. Like packs, indices use a rollback journal.
+class ManifestStore(object):
+    TOUCH_BATCH = 256
+    TOUCH_INTERVAL = 30
+
+    def __init__(self, store, fn, version):
+        ensure_dir(os.path.dirname(fn))
+        self.__store = store
+        self.__fn = fn
+        self.__version = version
+        self.__lock = threading.Lock()
+        self.__touched = {}
+        self.__flushed = time.time()
+        self.__db = sqlite3.connect(fn, timeout=60, isolation_level=None,\
+                                    check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=DELETE")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS manifest "\
+                          "(key TEXT PRIMARY KEY, size INTEGER, version TEXT, time REAL, atime REAL)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        columns = [r[1] for r in self.__db.execute("PRAGMA table_info(manifest)")]
+        if not 'atime' in columns:
+            self.__db.execute("ALTER TABLE manifest ADD COLUMN atime REAL")
+        self.__rebuild(force=False)
+
+    # Returns the store wrapped by this store
+    def inner(self):
+        return self.__store
+
+    # Populates the index from the contents of the wrapped store, discarding
+    # its existing entries
+    def rebuild(self):
+        self.__rebuild(force=True)
+
+    # Populates the index from the contents of the wrapped store. Unless the
+    # rebuild is forced, the index is left alone if it's already populated.
+    def __rebuild(self, force):
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN IMMEDIATE")
+                row = self.__db.execute("SELECT value FROM meta WHERE name = 'indexed'").fetchone()
+                if row is not None and not force:
+                    return
+                now = time.time()
+                self.__db.execute("DELETE FROM manifest")
+                self.__db.executemany("INSERT INTO manifest (key, size, version, time, atime) "\
+                                      "VALUES (?, ?, NULL, ?, ?)",\
+                                      ((k, n, now, now) for (k, n) in self.__store.sizes().items()))
+                self.__db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('indexed', '1')")
+
+    # Records that a number of artefacts, given as a dictionary of stored
+    # sizes indexed by key, have been written
+    def __record(self, sizes):
+        now = time.time()
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN")
+                self.__db.executemany("INSERT OR REPLACE INTO manifest (key, size, version, time, atime) "\
+                                      "VALUES (?, ?, ?, ?, ?)",\
+                                      ((k, n, self.__version, now, now) for (k, n) in sizes.items()))
+
+    # Records that a number of artefacts have been read. The access times
+    # are written to the index once enough of them have accumulated.
+    def __touch(self, keys):
+        now = time.time()
+        with self.__lock:
+            for key in keys:
+                self.__touched[key] = now
+            due = len(self.__touched) >= ManifestStore.TOUCH_BATCH or \
+                  now - self.__flushed >= ManifestStore.TOUCH_INTERVAL
+        if due:
+            self.flush()
+
+    # Writes any outstanding access times to the index
+    def flush(self):
+        with self.__lock:
+            (touched, self.__touched) = (self.__touched, {})
+            self.__flushed = time.time()
+            if not touched:
+                return
+            with self.__db:
+                self.__db.execute("BEGIN")
+                self.__db.executemany("UPDATE manifest SET atime = ? WHERE key = ?",\
+                                      ((t, k) for (k, t) in touched.items()))
+
+    # Returns the index entry for an artefact with a given key, as a
+    # dictionary, or None if there's no such artefact
+    def entry(self, key):
+        entries = self.entries(keys=[key])
+        return entries[0] if entries else None
+
+    # Returns the index entries for every artefact with a given prefix (or,
+    # if a list of keys is given, for those artefacts), as dictionaries. The
+    # access time of each entry is given by its atime.
+    def entries(self, prefix='', keys=None):
+        query = "SELECT key, size, version, time, atime FROM manifest "
+        rows = []
+        if keys is None:
+            with self.__lock:
+                rows = self.__db.execute(query + "WHERE substr(key, 1, ?) = ? ORDER BY key",\
+                                         (len(prefix), prefix)).fetchall()
+        else:
+            keys = list(keys)
+            for i in range(0, len(keys), PackStore.CHUNK):
+                chunk = keys[i:i + PackStore.CHUNK]
+                with self.__lock:
+                    rows += self.__db.execute(query + "WHERE key IN (%s)" % ",".join("?" * len(chunk)),\
+                                              chunk).fetchall()
+        return [{'key': k, 'size': n, 'version': v, 'time': t, 'atime': a}\
+                for (k, n, v, t, a) in rows]
+
+    def path(self, key):
+        return self.__store.path(key)
+
+    # Determines whether an artefact with a given key exists, according to
+    # the index. If verify is set, artefacts held by the index are also
+    # checked against the wrapped store.
+    def exists(self, key, verify=False):
+        with self.__lock:
+            row = self.__db.execute("SELECT 1 FROM manifest WHERE key = ?", (key,)).fetchone()
+        if row is not None and not verify:
+            return True
+        found = self.__store.exists(key)
+        if row is not None and not found:
+            self.__forget(key)
+        return found
+
+    def get(self, key):
+        try:
+            data = self.__store.get(key)
+        except KeyError:
+            self.__forget(key)
+            raise
+        self.__touch([key])
+        return data
+
+    def get_many(self, keys):
+        found = self.__store.get_many(keys)
+        self.__touch(found)
+        return found
+
+    def put(self, key, data):
+        self.__store.put(key, data)
+        self.__record({key: len(data)})
+
+    def put_many(self, items):
+        self.__store.put_many(items)
+        self.__record({k: len(d) for (k, d) in items.items()})
+
+    def ingest(self, key, path):
+        size = os.path.getsize(path)
+        self.__store.ingest(key, path)
+        self.__record({key: size})
+
+    def delete(self, key):
+        self.__store.delete(key)
+        self.__forget(key)
+
+    # Removes the entry for an artefact with a given key from the index
+    def __forget(self, key):
+        with self.__lock:
+            self.__touched.pop(key, None)
+            self.__db.execute("DELETE FROM manifest WHERE key = ?", (key,))
+
+    def keys(self, prefix=''):
+        return [e['key'] for e in self.entries(prefix)]
+
+    def sizes(self, prefix=''):
+        return {e['key']: e['size'] for e in self.entries(prefix)}
+
+    def vacuum(self):
+        self.__store.vacuum()
+
+    def discard(self):
+        self.__store.discard()
+        if self.keys():
+            return
+        self.close()
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            if os.path.exists(self.__fn + suffix):
+                os.remove(self.__fn + suffix)
+
+    def close(self):
+        self.flush()
+        self.__store.close()
+        with self.__lock:
+            self.__db.close()
+
+# Moves every artefact from one store to another, and returns the number of
+# artefacts that were moved. Artefacts are only removed from the source once
+# they've been written to the destination.
+def migrate(source, destination, batch=256):
+    moved = 0
+    keys = source.keys()
+    for i in range(0, len(keys), batch):
+        found = source.get_many(keys[i:i + batch])
+        destination.put_many(found)
+        for key in found:
+            source.delete(key)
+        moved += len(found)
+    return moved
@@ -1,24 +1,160 @@
 import os
 import os.path
-import subprocess
+import tempfile
+import collections
+import contextlib
+import fcntl
+import threading
+import bughunter.execution as execution
 
 FNULL = open(os.devnull, 'w')
 
 # Ensures that a given directory exists
 def ensure_dir(d):
-    os.path.exists(d) or os.makedirs(d)
+    os.makedirs(d, exist_ok=True)
+
+# Returns a context manager that provides a writable file for a given path.
+# Writes are made to a temporary file in the same directory, which replaces
+# the file at the given path once the context is exited, so that the file is
+# never partially written. Should an error occur, the temporary file is
+# destroyed, and the file at the given path is left untouched.
+@contextlib.contextmanager
+def atomic_writer(path, mode='w'):
+    ensure_dir(os.path.dirname(path))
+    f = tempfile.NamedTemporaryFile(mode=mode, dir=os.path.dirname(path),\
+                                    prefix=".tmp-", delete=False)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, path)
+    finally:
+        os.path.exists(f.name) and os.remove(f.name)
+
+# Writes a given sequence of bytes to a file at a specified path, atomically.
+def write_atomic(path, data):
+    with atomic_writer(path, 'wb') as f:
+        f.write(data)
+
+# Creates a symbolic link at a given path to a given file, replacing any
+# existing file at that path. The link is relative, so that it survives the
+# directory that holds both being moved. (Hard links aren't used, since the
+# file couldn't be removed without also finding and removing its links.)
+def link(target, path):
+    ensure_dir(os.path.dirname(path))
+    tmp = os.path.join(os.path.dirname(path), ".tmp-link-%d-%d-%s" % \
+                       (os.getpid(), threading.get_ident(), os.path.basename(path)))
+    try:
+        os.symlink(os.path.relpath(target, os.path.dirname(path)), tmp)
+        os.replace(tmp, path)
+    finally:
+        os.path.lexists(tmp) and os.remove(tmp)
+
+# The paths of the file locks held by each thread
+_HELD_LOCKS = threading.local()
+
+# Returns a context manager that holds an exclusive, advisory lock on a file
+# at a given path, which is created if necessary. Should another process (or
+# thread) hold the lock, the context waits for it to be released. Locks are
+# reentrant within a thread, and are released if the process holding them
+# terminates.
+@contextlib.contextmanager
+def file_lock(path):
+    held = _HELD_LOCKS.__dict__.setdefault('paths', set())
+    if path in held:
+        yield
+        return
+    ensure_dir(os.path.dirname(path))
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        held.add(path)
+        try:
+            yield
+        finally:
+            held.discard(path)
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 # Executes a given command on the terminal, blocking until completion.
 # Returns True if an exit status of zero was returned, otherwise False
-# is returned.
+# is returned. Commands are run by the execution layer for this process
+# (see bughunter.execution), which bounds the number that run at once.
 def execute(cmd):
-     return subprocess.Popen(cmd, shell=True, stdout=FNULL, \
-                             stderr=subprocess.STDOUT).wait() == 0
+     return execution.run(cmd, merge=True).ok()
 
 # Executes a given command on the terminal, using a specified working
 # directory. Blocks until completion.
 # Returns True if an exit status of zero was returned, otherwise False
 # is returned.
 def exec_from_dir(cmd, cmd_dir):
-     return subprocess.Popen(cmd, shell=True, stdout=FNULL,
-                stderr=subprocess.STDOUT, cwd=cmd_dir).wait() == 0
+     return execution.run(cmd, cwd=cmd_dir, merge=True).ok()
+
+# A thread-safe, least-recently-used cache with a bounded total weight. The
+# weight of each entry is computed by a given function (by default, each entry
+# has a weight of one). Entries are evicted, least recently used first, until
+# the total weight of the cache falls within its capacity. The cache counts
+# the number of lookups that hit and missed.
+class LRUCache(object):
+    def __init__(self, capacity, weigh=lambda v: 1):
+        self.__capacity = capacity
+        self.__weigh = weigh
+        self.__weight = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    # Returns the value stored for a given key, or a default value if there
+    # is no such entry
+    def get(self, key, default=None):
+        with self.__lock:
+            if not key in self.__entries:
+                self.__misses += 1
+                return default
+            self.__hits += 1
+            self.__entries.move_to_end(key)
+            return self.__entries[key][0]
+
+    # Stores a value for a given key, evicting other entries as necessary.
+    # The weight of the value may be given; otherwise, it's computed by the
+    # weighing function for this cache. Values that exceed the capacity of the
+    # cache are not stored.
+    def put(self, key, value, weight=None):
+        if weight is None:
+            weight = self.__weigh(value)
+        with self.__lock:
+            if key in self.__entries:
+                self.__weight -= self.__entries.pop(key)[1]
+            if weight > self.__capacity:
+                return
+            self.__entries[key] = (value, weight)
+            self.__weight += weight
+            while self.__weight > self.__capacity:
+                (_, (_, w)) = self.__entries.popitem(last=False)
+                self.__weight -= w
+
+    # Returns the total weight of the entries within this cache
+    def weight(self):
+        return self.__weight
+
+    # Returns the maximum total weight of the entries within this cache
+    def capacity(self):
+        return self.__capacity
+
+    # Returns the number of lookups that found an entry
+    def hits(self):
+        return self.__hits
+
+    # Returns the number of lookups that didn't find an entry
+    def misses(self):
+        return self.__misses
+
+    # Removes every entry from this cache
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__weight = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+import shutil
+import tempfile
+import threading
+import unittest
+import git
+from bughunter.blob import BlobReaderPool
+from bughunter.utility import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def testEviction(self):
+        cache = LRUCache(10, len)
+        cache.put("a", "xxxx")
+        cache.put("b", "xxxx")
+        cache.get("a")
+        cache.put("c", "xxxx")
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.weight(), 8)
+
+        cache.put("d", "x" * 11)
+        self.assertNotIn("d", cache)
+
+    def testCounters(self):
+        cache = LRUCache(10)
+        cache.put("a", object(), weight=6)
+        cache.put("b", object(), weight=6)
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertEqual((cache.hits(), cache.misses()), (1, 1))
+        self.assertEqual(cache.weight(), 6)
+
+class TestBlobReaderPool(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.repo = git.Repo.init(self.dir)
+        with self.repo.config_writer() as cfg:
+            cfg.set_value("user", "name", "Jane Doe")
+            cfg.set_value("user", "email", "jane@example.com")
+        for contents in ["int x;\n", "int y;\n"]:
+            with open("%s/main.c" % self.dir, "w") as f:
+                f.write(contents)
+            self.repo.index.add(["main.c"])
+            self.repo.index.commit("update")
+        self.pool = BlobReaderPool(self.repo.git_dir, size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.dir)
+
+    def testContents(self):
+        self.assertEqual(self.pool.contents("HEAD", "main.c"), "int y;\n")
+        self.assertEqual(self.pool.contents("HEAD~1", "main.c"), "int x;\n")
+
+        blob = self.repo.head.commit.tree["main.c"].hexsha
+        self.assertEqual(self.pool.contents("HEAD", "main.c", blob), "int y;\n")
+
+    def testMissing(self):
+        with self.assertRaises(KeyError):
+            self.pool.contents("HEAD", "missing.c")
+        self.assertEqual(self.pool.contents("HEAD", "main.c"), "int y;\n")
+
+    def testThreads(self):
+        results = []
+        def read():
+            for _ in range(50):
+                results.append(self.pool.contents("HEAD~1", "main.c"))
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ["int x;\n"] * 200)
+
+if __name__ == "__main__":
+    unittest.main()
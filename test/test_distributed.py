@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+import bughunter.distributed as distributed
+from bughunter.distributed import TaskQueue, Worker
+
+# Stands in for the execution of a task, which kills its worker process if
+# the task asks it to
+def execute(options, path, kind, address, payload, retry=False):
+    if payload.get('crash'):
+        os._exit(1)
+    time.sleep(0.2)
+    return True
+
+class TestTaskQueue(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.queue = TaskQueue(os.path.join(self.dir, "tasks.db"))
+        self.queue.submit([('diff', "r/a", "addr", {'file': 'a.c'}),\
+                           ('diff', "r/b", "addr", {'file': 'b.c'})])
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.dir)
+
+    def testLease(self):
+        # resubmitted tasks are ignored
+        self.queue.submit([('diff', "r/a", "addr", {'file': 'a.c'})])
+        tasks = self.queue.lease("one", 1, 60)
+        self.assertEqual([t.key() for t in tasks], ["r/a"])
+        self.assertEqual(tasks[0].payload(), {'file': 'a.c'})
+        self.assertEqual([t.key() for t in self.queue.lease("two", 5, 60)], ["r/b"])
+        self.assertEqual(self.queue.lease("three", 5, 60), [])
+
+        self.assertTrue(self.queue.complete("one", tasks[0].ident()))
+        self.assertEqual(self.queue.counts(),\
+                         {'queued': 0, 'leased': 1, 'done': 1, 'failed': 0})
+
+    # once its lease has expired, an owner can no longer complete a task
+    # that has been leased by another owner
+    def testOwner(self):
+        held = self.queue.lease("dead", 2, 0.01)
+        time.sleep(0.05)
+        self.queue.lease("alive", 2, 60)
+        self.assertFalse(self.queue.complete("dead", held[0].ident(), "lost"))
+        self.assertEqual(self.queue.counts()['leased'], 2)
+        self.assertEqual(self.queue.failures(), [])
+
+    # released tasks are returned to the queue without counting as attempts
+    def testRelease(self):
+        for _ in range(TaskQueue.MAX_ATTEMPTS + 1):
+            tasks = self.queue.lease("one", 2, 60)
+            self.assertEqual(len(tasks), 2)
+            self.queue.release("two", [t.ident() for t in tasks])
+            self.assertEqual(self.queue.counts()['leased'], 2)
+            self.queue.release("one", [t.ident() for t in tasks])
+            self.assertEqual(self.queue.counts()['queued'], 2)
+
+    def testExpiry(self):
+        held = self.queue.lease("dead", 2, 0.01)
+        time.sleep(0.05)
+        leased = self.queue.lease("alive", 2, 0.01)
+        self.assertEqual(sorted(t.key() for t in leased), ["r/a", "r/b"])
+        self.assertEqual(self.queue.heartbeat("dead", [t.ident() for t in held], 60), [])
+        time.sleep(0.05)
+
+        # tasks whose leases keep expiring are eventually failed
+        for _ in range(TaskQueue.MAX_ATTEMPTS - 2):
+            self.queue.lease("dead", 2, 0.01)
+            time.sleep(0.05)
+        self.queue.lease("alive", 2, 60)
+        self.assertEqual(self.queue.counts()['failed'], 2)
+        self.assertEqual(self.queue.requeue(), 2)
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "tasks.db")
+        queue = TaskQueue(self.path)
+        queue.set_options({})
+        queue.submit([('diff', "r/%d" % i, "addr", {'crash': i == 1}) for i in range(4)])
+        queue.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # a task that kills its worker process breaks the pool, and is failed,
+    # whereas the tasks that were in progress alongside it are executed again
+    def testBrokenPool(self):
+        with unittest.mock.patch.object(distributed, 'execute', execute):
+            throughput = Worker(self.path, jobs=4, interval=1).run()
+        self.assertEqual((throughput.prepared(), throughput.failed()), (3, 1))
+
+        queue = TaskQueue(self.path)
+        self.assertEqual(queue.counts(), {'queued': 0, 'leased': 0, 'done': 3, 'failed': 1})
+        self.assertEqual([k for (k, _) in queue.failures()], ["r/1"])
+        queue.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+import io
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import unittest.mock
+import bughunter.execution as execution
+import bughunter.service as service
+
+class TestExecution(unittest.TestCase):
+    def setUp(self):
+        self.executor = execution.Executor(limit=2)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def testOutput(self):
+        lines = []
+        result = self.executor.run("printf 'a\\nb\\nc'; echo oops >&2",\
+                                   on_line=lines.append, capture=True)
+        self.assertTrue(result.ok())
+        self.assertEqual(result.output(), b"a\nb\nc")
+        self.assertEqual(lines, [b"a\n", b"b\n", b"c"])
+        self.assertEqual(result.error(), b"oops\n")
+
+        out = io.BytesIO()
+        self.assertFalse(self.executor.run("echo hi; exit 3", output=out).ok())
+        self.assertEqual(out.getvalue(), b"hi\n")
+        self.assertRaises(execution.ExecutionError, self.executor.run("false").check)
+
+    # at most two commands run at once, so four sleeps take two rounds
+    def testLimit(self):
+        start = time.time()
+        futures = [self.executor.submit("sleep 0.3") for _ in range(4)]
+        self.assertTrue(all(f.result().ok() for f in futures))
+        self.assertGreaterEqual(time.time() - start, 0.6)
+
+    # cancelling a job kills the whole process group of its command
+    def testCancel(self):
+        d = tempfile.mkdtemp()
+        try:
+            marker = os.path.join(d, "marker")
+            future = self.executor.submit("(sleep 0.5; touch %s) & wait" % marker)
+            time.sleep(0.2)
+            future.cancel()
+            time.sleep(0.6)
+            self.assertFalse(os.path.exists(marker))
+        finally:
+            shutil.rmtree(d)
+
+    def testLimits(self):
+        with self.assertRaises(execution.LimitExceeded) as cm:
+            self.executor.run("sleep 5", limits={'wall': 0.2})
+        self.assertEqual(cm.exception.limit(), 'wall')
+        with self.assertRaises(execution.LimitExceeded) as cm:
+            self.executor.run("while :; do :; done", limits={'cpu': 1})
+        self.assertEqual(cm.exception.limit(), 'cpu')
+        with self.assertRaises(execution.LimitExceeded) as cm:
+            self.executor.run("python3 -c 'x = bytearray(1 << 30)'", limits={'memory': 256 << 20})
+        self.assertEqual(cm.exception.limit(), 'memory')
+
+        # commands that fail within their limits fail as usual, including
+        # those killed by something other than the CPU limit, if memory is
+        # unbounded
+        limits = execution.Limits(wall=5, cpu=5, memory=1 << 30)
+        self.assertEqual(self.executor.run("exit 1", limits=limits).returncode(), 1)
+        limits = execution.Limits(wall=5, cpu=5)
+        self.assertEqual(self.executor.run("sh -c 'kill -9 $$'", limits=limits).returncode(), 137)
+
+    # commands that ignore SIGXCPU are killed once they reach the hard limit
+    def testHardCPULimit(self):
+        ignore = "import signal; signal.signal(signal.SIGXCPU, signal.SIG_IGN)\nwhile 1: pass"
+        with unittest.mock.patch.object(execution.Limits, 'CPU_GRACE', 1):
+            with self.assertRaises(execution.LimitExceeded) as cm:
+                self.executor.run("python3 -c '%s'" % ignore, limits={'cpu': 1})
+        self.assertEqual(cm.exception.limit(), 'cpu')
+
+    # commands that exceed their memory limit are recognised, whether they
+    # report their failure to allocate memory, or handle it themselves and
+    # crash (as native parsers may)
+    def testMemoryLimit(self):
+        grow = "x = []\nwhile 1: x.append(bytearray(1 << 20))"
+        crash = "import os, signal\ntry:\n    %s\nexcept MemoryError:\n    x = None\n" \
+                "    os.kill(os.getpid(), signal.SIGSEGV)" % grow.replace("\n", "\n    ")
+        for script in (grow, crash):
+            cmd = "%s -c %s" % (shlex.quote(sys.executable), shlex.quote(script))
+            with self.assertRaises(execution.LimitExceeded) as cm:
+                self.executor.run(cmd, limits={'memory': 256 << 20})
+            self.assertEqual(cm.exception.limit(), 'memory')
+
+    # jsondiff jobs executed within the process report their failures
+    def testReplies(self):
+        d = tempfile.mkdtemp()
+        try:
+            jobs = [{'id': 1, 'op': 'jsondiff', 'before': 'missing.c', 'after': 'missing.c',\
+                     'output': os.path.join(d, "a.json")},\
+                    {'id': 2, 'op': 'unknown'}]
+            replies = service.execute_all(jobs)
+            self.assertEqual([r['id'] for r in replies], [1, 2])
+            self.assertFalse(any(r['ok'] for r in replies))
+            self.assertFalse(os.path.exists(os.path.join(d, "a.json")))
+        finally:
+            shutil.rmtree(d)
+
+if __name__ == '__main__':
+    unittest.main()
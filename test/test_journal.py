@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+import os
+import shutil
+import tempfile
+import unittest
+from bughunter.journal import Journal
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "run.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testResume(self):
+        journal = Journal(self.fn)
+        journal.started("repo/a", {'blobs': ['1', '2']})
+        journal.succeeded("repo/a")
+        journal.started("repo/b")
+        journal.failure("repo/b", "Exception: boom")
+        journal.started("repo/c")
+        journal.close()
+
+        # a partially written line is discarded when the journal is reopened
+        with open(self.fn, 'a') as f:
+            f.write('{"unit": "repo/d", "sta')
+
+        journal = Journal(self.fn)
+        self.assertTrue(journal.finished("repo/a", {'blobs': ['1', '2']}))
+        self.assertFalse(journal.finished("repo/a", {'blobs': ['1', '3']}))
+        self.assertFalse(journal.finished("repo/b"))
+        self.assertTrue(journal.finished("repo/b", failed=True))
+        self.assertEqual(journal.interrupted(), ["repo/c"])
+        self.assertEqual(journal.counts(), {'started': 1, 'done': 1, 'failed': 1})
+        journal.close()
+
+        with open(self.fn, 'r') as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+if __name__ == "__main__":
+    unittest.main()
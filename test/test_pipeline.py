@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import bughunter.pipeline as pipeline
+from bughunter.journal import Journal
+
+# Stands in for a BugHunter instance within the workers of the pipeline
+class StubMaster(object):
+    def options(self):
+        return {}
+    def storage(self):
+        return self
+    def clear_failure(self, df):
+        pass
+    def record_failure(self, df, error, duration):
+        pass
+
+# Stands in for the FileDiff of a unit of work, named by the unit
+class StubDiff(str):
+    def key(self):
+        return str(self)
+
+# The number of units emitted by the scan stage for each repository
+UNITS = 1500
+
+def scan(master, address, config):
+    for i in range(UNITS):
+        yield "%s/%d" % (address, i)
+
+def fail(master, df, config):
+    if df.endswith("7"):
+        raise Exception("boom")
+
+def crash(master, df, config):
+    os._exit(1)
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        stubs = {'scan': scan,\
+                 'unit_diff': lambda master, unit: StubDiff(unit),\
+                 'diff_unit': lambda df: (str(df), {'unit': str(df)})}
+        self.patches = [unittest.mock.patch.object(pipeline, k, v) for (k, v) in stubs.items()]
+        self.patches.append(unittest.mock.patch.object(pipeline.runner, 'master',\
+                                                       lambda options: StubMaster()))
+        self.patches.append(unittest.mock.patch.dict(pipeline.STAGE_FUNCTIONS,\
+                            {s: (lambda master, df, config: None) for s in pipeline.STAGES}))
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.dir)
+
+    def run_pipeline(self, journal=None):
+        jobs = {'read': 2, 'parse': 3, 'pools': 2}
+        p = pipeline.Pipeline(StubMaster(), jobs=jobs, actions=False)
+        return p.run(["a", "b", "c"], journal=journal)
+
+    # every event is counted, including those sent just before the workers
+    # for the last stage exit
+    def testCounts(self):
+        throughput = self.run_pipeline()
+        self.assertEqual(throughput.total(), 3 * UNITS)
+        self.assertEqual(throughput.prepared(), 3 * UNITS)
+        self.assertEqual(throughput.failed(), 0)
+
+    def testJournal(self):
+        fn = os.path.join(self.dir, "run.journal")
+        pipeline.STAGE_FUNCTIONS['parse'] = fail
+        throughput = self.run_pipeline(journal=fn)
+        failed = 3 * (UNITS // 10)
+        self.assertEqual(throughput.failed(), failed)
+        self.assertEqual(throughput.prepared(), 3 * UNITS - failed)
+
+        journal = Journal(fn)
+        self.assertEqual(journal.counts(),\
+                         {'started': 0, 'done': 3 * UNITS - failed, 'failed': failed})
+        self.assertTrue(journal.finished("b/8", {'unit': "b/8"}))
+        journal.close()
+
+    # should every worker for a stage die, the units sent to that stage are
+    # recorded as failures, rather than blocking the stages before it
+    def testDeadStage(self):
+        fn = os.path.join(self.dir, "run.journal")
+        pipeline.STAGE_FUNCTIONS['pools'] = crash
+        throughput = self.run_pipeline(journal=fn)
+        self.assertEqual(throughput.total(), 3 * UNITS)
+        self.assertEqual(throughput.prepared(), 0)
+
+        # the units held by the workers as they died are lost
+        self.assertGreaterEqual(throughput.failed(), 3 * UNITS - 2)
+        journal = Journal(fn)
+        self.assertEqual(journal.counts()['failed'], throughput.failed())
+        journal.close()
+
+if __name__ == "__main__":
+    unittest.main()
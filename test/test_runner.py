@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+import git
+import bughunter.journal
+import bughunter.runner as runner
+from bughunter.bughunter import BugHunter
+from bughunter.runner import Progress, Runner, Throughput
+
+# The number of fixes within each stub repository
+FIXES = 25
+
+# Stands in for the fix objects returned by a repository
+class StubFix(object):
+    def __init__(self, ident):
+        self.__ident = ident
+    def to_json(self):
+        return {'id': self.__ident}
+
+# Stands in for a repository, whose fixes record the number of fixes that
+# were in flight (i.e., taken from the repository, but not yet completed,
+# as recorded by the log of completed fixes) as each fix is taken
+class StubRepository(object):
+    def __init__(self, address, log, inflight):
+        self.__address = address
+        self.__log = log
+        self.__inflight = inflight
+
+    def id(self):
+        return self.__address
+
+    def iter_fixes(self):
+        for i in range(FIXES):
+            completed = 0
+            if os.path.exists(self.__log):
+                with open(self.__log, 'r') as f:
+                    completed = len(f.readlines())
+            self.__inflight.append(len(self.__inflight) - completed)
+            yield StubFix("%s/%d" % (self.__address, i))
+
+# Stands in for a BugHunter instance within the main process
+class StubMaster(object):
+    def __init__(self, log):
+        self.__log = log
+        self.inflight = []
+
+    def options(self):
+        return {'log': self.__log}
+
+    def repository(self, address):
+        return StubRepository(address, self.__log, self.inflight)
+
+def scan_repository(options, address):
+    if address == "broken":
+        raise Exception("no such repository")
+    return FIXES
+
+# Records each fix that's prepared, and fails one in every ten
+def prepare_fix(options, address, jsn, retry=False):
+    time.sleep(0.005)
+    with open(options['log'], 'a') as f:
+        f.write("%s\n" % jsn['id'])
+    return not jsn['id'].endswith("7")
+
+# Takes a while to prepare the first fix
+def prepare_slowly(options, address, jsn, retry=False):
+    if jsn['id'].endswith("/0"):
+        time.sleep(1.5)
+    return True
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "log")
+        self.patches = [unittest.mock.patch.object(runner, 'scan_repository', scan_repository),\
+                        unittest.mock.patch.object(runner, 'prepare_fix', prepare_fix)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.dir)
+
+    # no more than two tasks per worker are ever scheduled at once, and every
+    # repository is scanned and prepared
+    def testBounded(self):
+        master = StubMaster(self.log)
+        progress = Runner(master, jobs=2, interval=60).run(["a", "b", "c", "broken"])
+        self.assertEqual(len(master.inflight), 3 * FIXES)
+        self.assertLessEqual(max(master.inflight), 2 * 2)
+
+        for address in ("a", "b", "c"):
+            self.assertEqual(progress[address].to_json(),\
+                             {'fixes': FIXES, 'prepared': FIXES - 2, 'failed': 2, 'error': None})
+            self.assertTrue(progress[address].finished())
+        self.assertEqual(progress["broken"].error(), "no such repository")
+        self.assertTrue(progress["broken"].finished())
+
+    # repositories are only scanned, unless their fixes are to be prepared
+    def testScanOnly(self):
+        progress = Runner(StubMaster(self.log), jobs=2, interval=60).run(["a"], prepare=False)
+        self.assertEqual(progress["a"].fixes(), FIXES)
+        self.assertFalse(progress["a"].finished())
+        self.assertFalse(os.path.exists(self.log))
+
+    # progress is reported at every interval, even while no task completes
+    def testReport(self):
+        out = io.StringIO()
+        with unittest.mock.patch.object(runner, 'prepare_fix', prepare_slowly),\
+             contextlib.redirect_stdout(out):
+            Runner(StubMaster(self.log), jobs=1, interval=0.2).run(["a"])
+        self.assertGreaterEqual(out.getvalue().count("a: prepared"), 5)
+
+class TestProgress(unittest.TestCase):
+    def testProgress(self):
+        p = Progress("a")
+        self.assertEqual(str(p), "a: scanning")
+        self.assertFalse(p.finished())
+        p.scanned(2)
+        p.succeeded()
+        self.assertFalse(p.finished())
+        p.failure()
+        self.assertTrue(p.finished())
+        self.assertEqual(str(p), "a: prepared 1/2 fixes (1 failed)")
+
+class TestThroughput(unittest.TestCase):
+    def testArithmetic(self):
+        with unittest.mock.patch('time.time', lambda: 100.0):
+            throughput = Throughput(20)
+            self.assertIsNone(throughput.eta())
+            self.assertEqual(throughput.rate(), 0.0)
+            self.assertIn("ETA --:--:--", str(throughput))
+        for _ in range(4):
+            throughput.succeeded()
+        throughput.failure()
+        with unittest.mock.patch('time.time', lambda: 110.0):
+            self.assertEqual(throughput.completed(), 5)
+            self.assertEqual(throughput.rate(), 0.5)
+            self.assertEqual(throughput.eta(), 30.0)
+            self.assertEqual(str(throughput),\
+                             "prepared 4/20 diffs (1 failed), 0.50 diffs/s, ETA 0:00:30")
+            throughput.expect(7200)
+            self.assertEqual(throughput.eta(), 14430.0)
+            self.assertIn("ETA 4:00:30", str(throughput))
+            self.assertEqual(throughput.to_json(),\
+                             {'total': 7220, 'prepared': 4, 'failed': 1, 'elapsed': 10.0})
+
+# Stands in for the preparation of a diff, which fails the diffs of one file
+def prepare_diff(options, address, jsn, name, retry=False):
+    return name != "b.c"
+
+# Stands in for the preparation of a diff that takes a while
+def prepare_diff_slowly(options, address, jsn, name, retry=False):
+    time.sleep(1)
+    return True
+
+class TestPrepareAll(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        origin = git.Repo.init(os.path.join(self.dir, "origin"))
+        with origin.config_writer() as cfg:
+            cfg.set_value("user", "name", "Jane Doe")
+            cfg.set_value("user", "email", "jane@example.com")
+        for (contents, message) in [("a\n", "initial commit"), ("b\n", "fixed crash")]:
+            for fn in ("a.c", "b.c"):
+                with open(os.path.join(origin.working_dir, fn), "w") as f:
+                    f.write(contents)
+            origin.index.add(["a.c", "b.c"])
+            origin.index.commit(message)
+
+        self.patches = [unittest.mock.patch.dict(os.environ,\
+                            {'BUGHUNTER': os.path.join(self.dir, "bughunter")}),\
+                        unittest.mock.patch.object(runner, 'prepare_diff', prepare_diff)]
+        for p in self.patches:
+            p.start()
+        self.master = BugHunter()
+        self.repo = self.master.repository(origin.working_dir)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.dir)
+
+    def counts(self, throughput):
+        return (throughput.total(), throughput.prepared(), throughput.failed())
+
+    # diffs that the journal records as completed are skipped, as are those
+    # that it records as failed, unless they're to be retried
+    def testJournal(self):
+        journal = os.path.join(self.dir, "run.journal")
+        self.assertEqual(self.counts(self.repo.prepare_all(jobs=2, journal=journal)), (2, 1, 1))
+        self.assertEqual(self.counts(self.repo.prepare_all(jobs=2, journal=journal)), (0, 0, 0))
+        self.assertEqual(self.counts(self.repo.prepare_all(jobs=2, retry=True, journal=journal)),\
+                         (1, 0, 1))
+        self.assertEqual(self.counts(self.repo.prepare_all(jobs=2)), (2, 1, 1))
+
+    # the journal is consulted by key before the inputs of any diff are
+    # found, and only the inputs of the diffs that it records are checked
+    def testJournalFirst(self):
+        journal = os.path.join(self.dir, "run.journal")
+        self.repo.prepare_all(jobs=2, journal=journal)
+        units = []
+        diff_unit = bughunter.journal.diff_unit
+        def record(df):
+            units.append(df.name())
+            return diff_unit(df)
+        with unittest.mock.patch.object(bughunter.journal, 'diff_unit', record),\
+             unittest.mock.patch.object(runner, 'diff_unit', record):
+            self.assertEqual(self.counts(self.repo.prepare_all(jobs=2, journal=journal)), (0, 0, 0))
+            self.assertEqual(sorted(units), ["a.c", "b.c"])
+            self.assertEqual(self.counts(self.repo.prepare_all(jobs=2, retry=True,\
+                                                               journal=journal)), (1, 0, 1))
+        self.assertEqual(sorted(units), ["a.c", "a.c", "b.c", "b.c"])
+
+    # progress is reported at every interval, even while no diff completes
+    def testReport(self):
+        out = io.StringIO()
+        with unittest.mock.patch.object(runner, 'prepare_diff', prepare_diff_slowly),\
+             contextlib.redirect_stdout(out):
+            Runner(self.master, jobs=1, interval=0.2).prepare(self.repo)
+        lines = [l for l in out.getvalue().splitlines() if "prepared" in l]
+        self.assertGreaterEqual(len(lines), 5)
+
+if __name__ == "__main__":
+    unittest.main()
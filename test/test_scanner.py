@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import git
+from bughunter.scanner import Scanner
+
+# A minimal stand-in for a bughunter.repository.Repository that wraps a local
+# Git repository
+class LocalRepository(object):
+    def __init__(self, path):
+        self.__git = git.Repo(path)
+
+    def repository(self):
+        return self.__git
+
+    def address(self):
+        return self.__git.working_dir
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        repo = git.Repo.init(self.dir)
+        with repo.config_writer() as cfg:
+            cfg.set_value("user", "name", "Jane Doe")
+            cfg.set_value("user", "email", "jane@example.com")
+
+        self.commit(repo, {"a.c": "a\n", "a.h": "h\n"}, "initial commit")
+        self.commit(repo, {"a.c": "b\n", "README": "x\n"}, "Fixed crash\n\nin a.c")
+        self.commit(repo, {"README": "y\n"}, "fix bug in docs")
+        self.commit(repo, {"src/b c.c": "c\n"}, "patch for bug")
+        self.commit(repo, {"a.c": "d\n"}, "fix debug build")
+        self.repo = LocalRepository(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def commit(self, repo, files, message):
+        for (fn, contents) in files.items():
+            path = os.path.join(self.dir, fn)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(contents)
+            repo.index.add([fn])
+        repo.index.commit(message)
+
+    def testStream(self):
+        fixes = list(Scanner(None).stream(self.repo))
+        self.assertEqual([f['message'] for f in fixes],
+                         ["patch for bug", "Fixed crash\n\nin a.c"])
+        self.assertEqual(fixes[0]['files'], ["src/b c.c"])
+        self.assertEqual(sorted(fixes[1]['files']), ["README", "a.c"])
+        self.assertEqual(fixes[1]['committer']['email'], "jane@example.com")
+
+    def testChanges(self):
+        fixes = list(Scanner(None).stream(self.repo))
+        changes = {c['b_path']: c for c in fixes[1]['changes']}
+        self.assertEqual(changes['a.c']['change_type'], 'M')
+        self.assertEqual(changes['a.c']['insertions'], 1)
+        self.assertEqual(changes['a.c']['deletions'], 1)
+        self.assertEqual(changes['README']['change_type'], 'A')
+        self.assertIsNone(changes['README']['a_blob'])
+
+        commit = self.repo.repository().commit(fixes[1]['id'])
+        self.assertEqual(changes['a.c']['b_blob'], commit.tree['a.c'].hexsha)
+        self.assertEqual(changes['a.c']['a_blob'],
+                         commit.parents[0].tree['a.c'].hexsha)
+
+    # renames aren't detected, as they aren't by commit.stats, so that the
+    # files and changes of a commit are the same for every kind of clone;
+    # only the line counts are unknown within partial clones
+    def testRenames(self):
+        repo = self.repo.repository()
+        repo.index.move(["src/b c.c", "src/d.c"])
+        repo.index.commit("fix bug by renaming b")
+        head = repo.head.commit.hexsha
+
+        fix = Scanner(None).describe(self.repo, head)
+        self.assertEqual(sorted(fix['files']), ["src/b c.c", "src/d.c"])
+        self.assertEqual(sorted(fix['files']), sorted(repo.commit(head).stats.files.keys()))
+        self.assertEqual(sorted((c['change_type'], c['a_path'], c['b_path'], c['insertions'])\
+                                for c in fix['changes']),
+                         [('A', "src/d.c", "src/d.c", 1), ('D', "src/b c.c", "src/b c.c", 0)])
+
+        with unittest.mock.patch.object(Scanner, 'partial', lambda g: True):
+            partial = Scanner(None).describe(self.repo, head)
+        self.assertEqual(partial['files'], fix['files'])
+        for c in fix['changes']:
+            c.update(insertions=None, deletions=None)
+        self.assertEqual(partial['changes'], fix['changes'])
+
+    # commits are described in batches, each by a single git log process
+    def testDescribeAll(self):
+        commits = [c.hexsha for c in self.repo.repository().iter_commits()]
+        described = Scanner(None).describe_all(self.repo, commits, batch=3)
+        self.assertEqual(sorted(described), sorted(commits))
+        for sha in commits:
+            self.assertEqual(described[sha], Scanner(None).describe(self.repo, sha))
+
+    def testConsistency(self):
+        scanner = Scanner(None)
+        expected = [c for c in self.repo.repository().iter_commits()
+                    if scanner.is_fix(c)]
+        fixes = list(scanner.stream(self.repo))
+        self.assertEqual([f['id'] for f in fixes], [c.hexsha for c in expected])
+        for (f, c) in zip(fixes, expected):
+            self.assertEqual(f['date'], c.committed_date)
+            self.assertEqual(sorted(f['files']), sorted(c.stats.files.keys()))
+
+if __name__ == "__main__":
+    unittest.main()
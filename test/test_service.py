@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+import asyncio
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import unittest
+import unittest.mock
+import bughunter.service as service
+from bughunter.service import ParserService, ParserError
+
+# A stand-in for a parser service, which replies to every job, and records
+# the identifier of each job that it receives, unless the job asks it to
+# crash, in which case it exits without replying
+STUB = """
+import json, sys
+for line in sys.stdin:
+    job = json.loads(line)
+    if job.get('crash'):
+        sys.exit(1)
+    with open(sys.argv[1], 'a') as f:
+        f.write("%d\\n" % job['id'])
+    print(json.dumps({'id': job['id'], 'ok': True}), flush=True)
+"""
+
+class TestParserService(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "log")
+        script = os.path.join(self.dir, "stub.py")
+        with open(script, 'w') as f:
+            f.write(STUB)
+        self.service = ParserService("%s %s %s" % (sys.executable, script, self.log))
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.dir)
+
+    def received(self):
+        with open(self.log, 'r') as f:
+            return [int(l) for l in f]
+
+    # jobs are sent in windows, and their replies are returned in order
+    def testWindows(self):
+        with unittest.mock.patch.object(ParserService, 'WINDOW', 2):
+            replies = self.service.batch([{'op': 'noop'} for _ in range(5)])
+        self.assertEqual([r['id'] for r in replies], [1, 2, 3, 4, 5])
+        self.assertTrue(all(r['ok'] for r in replies))
+        self.assertEqual(self.received(), [1, 2, 3, 4, 5])
+
+    # should the service crash, its jobs are executed within this process (where
+    # the stub's 'noop' jobs are unrecognised), and the service is restarted for
+    # the next batch
+    def testRestart(self):
+        self.service.batch([{'op': 'noop'}])
+        replies = self.service.batch([{'op': 'noop', 'crash': True}], check=False)
+        self.assertFalse(replies[0]['ok'])
+        self.assertIn("unrecognised job type", replies[0]['error'])
+        self.assertRaises(ParserError, self.service.batch, [{'op': 'noop', 'crash': True}])
+        self.service.batch([{'op': 'noop'}])
+        self.assertEqual(self.received(), [1, 4])
+
+    # once the service has been restarted too many times, every job is
+    # executed within this process
+    def testFallback(self):
+        for _ in range(ParserService.RESTARTS + 1):
+            self.service.batch([{'op': 'noop', 'crash': True}], check=False)
+        replies = self.service.batch([{'op': 'noop'}], check=False)
+        self.assertFalse(replies[0]['ok'])
+        self.assertFalse(os.path.exists(self.log))
+
+        # as they are when there's no service at all
+        replies = ParserService().batch([{'op': 'noop'}], check=False)
+        self.assertIn("unrecognised job type", replies[0]['error'])
+
+# Stands in for the execution layer, recording each command that it runs
+class StubExecutor(object):
+    def __init__(self):
+        self.commands = []
+
+    async def run_async(self, cmd, **kwargs):
+        self.commands.append(cmd)
+        return self
+
+    def ok(self):
+        return True
+
+class TestExecute(unittest.TestCase):
+    # the paths given to GumTree are quoted, rather than interpreted by the
+    # shell
+    def testQuoting(self):
+        d = tempfile.mkdtemp()
+        try:
+            (before, after) = (os.path.join(d, "a b.c"), os.path.join(d, "$(touch x);.c"))
+            job = {'op': 'jsondiff', 'before': before, 'after': after,\
+                   'output': os.path.join(d, "diff.json")}
+            executor = StubExecutor()
+            asyncio.run(service.execute_async(job, executor))
+            self.assertEqual(shlex.split(executor.commands[0]),\
+                             ["gumtree", "jsondiff", before, after])
+        finally:
+            shutil.rmtree(d)
+
+if __name__ == "__main__":
+    unittest.main()
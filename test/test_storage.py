@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+import cgum.program
+import git
+import bughunter.diff as diff
+import bughunter.execution as execution
+import bughunter.service as service
+import bughunter.storage as storage
+import bughunter.utility as utility
+from bughunter.bughunter import BugHunter
+from bughunter.scanner import Scanner
+from bughunter.storage import Storage
+
+# Stand-ins for the repository, fix, version and source file objects that
+# storage is given by BugHunter
+class StubRepository(object):
+    def id(self):
+        return "a" * 40
+
+class StubFix(object):
+    def identifier(self):
+        return "f" * 40
+    def repository(self):
+        return StubRepository()
+
+class StubVersion(object):
+    def fix(self):
+        return StubFix()
+    def is_fixed(self):
+        return False
+
+class StubSource(object):
+    def __init__(self, blob):
+        self.__blob = blob
+    def blob(self):
+        return self.__blob
+    def version(self):
+        return StubVersion()
+    def clean_name(self):
+        return "src-main.c"
+    def path(self):
+        return "%s.c" % self.__blob
+
+class StubMaster(object):
+    def __init__(self, storage):
+        self.__storage = storage
+    def storage(self):
+        return self.__storage
+
+class StubDiff(object):
+    def __init__(self, before=None, after=None):
+        (self.__before, self.__after) = (before, after)
+    def fix(self):
+        return StubFix()
+    def clean_name(self):
+        return "src-main.c"
+    def key(self):
+        return "%s/src-main.c.diff.json" % StubFix().identifier()
+    def before(self):
+        return self.__before
+    def after(self):
+        return self.__after
+
+class TestStorage(unittest.TestCase):
+    DOCUMENT = {'type': 'Program', 'pos': 0, 'children': [{'type': 'Id', 'label': 'main'}]}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = unittest.mock.patch.dict(os.environ, {'BUGHUNTER': self.dir})
+        self.env.start()
+        self.storage = Storage(None)
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.dir)
+
+    # stored ASTs are shared through the cache, unless a private copy is
+    # requested, and are linked to from the directory for their fix
+    def testAST(self):
+        sha = "b" * 40
+        key = "%s/%s.ast.json" % (sha[:2], sha)
+        self.storage.asts().put(key, json.dumps(TestStorage.DOCUMENT).encode('utf-8'))
+
+        loaded = []
+        def from_json(jsn):
+            loaded.append(jsn)
+            return jsn
+        with unittest.mock.patch.object(cgum.program.Program, 'from_json', from_json):
+            ast = self.storage.ast(StubSource(sha))
+            self.assertIs(self.storage.ast(StubSource(sha)), ast)
+            self.assertIsNot(self.storage.ast(StubSource(sha), copy=True), ast)
+        self.assertEqual(ast, TestStorage.DOCUMENT)
+        self.assertEqual(len(loaded), 2)
+
+        link = self.storage.artefacts(StubRepository()).path(\
+            "%s/src-main.c.before.ast.json" % StubFix().identifier())
+        self.assertTrue(os.path.islink(link))
+        self.assertTrue(os.path.samefile(link, self.storage.asts().path(key)))
+
+    # a cold diff is computed by a single parser job, which also writes the
+    # ASTs of its files that haven't been computed
+    def testColdDiff(self):
+        (before, after) = (StubSource("c" * 40), StubSource("d" * 40))
+        ast_key = lambda src: "%s/%s.ast.json" % (src.blob()[:2], src.blob())
+        self.storage.asts().put(ast_key(before), json.dumps(TestStorage.DOCUMENT).encode('utf-8'))
+
+        jobs = []
+        def batch(parser, js, check=True):
+            for job in js:
+                jobs.append(dict(job))
+                for k in ('output', 'before_ast', 'after_ast'):
+                    if k in job:
+                        with utility.atomic_writer(job[k]) as f:
+                            json.dump({'job': k}, f)
+        df = StubDiff(before, after)
+        with unittest.mock.patch.object(service.ParserService, 'batch', batch):
+            self.storage.compute_diff(df)
+            self.storage.compute_diff(df)
+        self.assertEqual([(j['op'], j['before'], j['after']) for j in jobs],\
+                         [('diff', before.path(), after.path())])
+        self.assertNotIn('before_ast', jobs[0])
+        self.assertTrue(self.storage.artefacts(StubRepository()).exists(df.key()))
+        stored = json.loads(self.storage.asts().get(ast_key(after)).decode('utf-8'))
+        self.assertEqual(stored, {'job': 'after_ast'})
+
+    # failures are ignored once the versions of the tools that recorded them
+    # change, and limits that were exceeded are recorded alongside them
+    def testFailures(self):
+        df = StubDiff()
+        self.assertIsNone(self.storage.failure(df))
+        self.storage.record_failure(df, Exception("boom"), 1.5)
+        failure = self.storage.failure(df)
+        self.assertEqual((failure['type'], failure['error'], failure['duration']),\
+                         ('Exception', "boom", 1.5))
+        self.assertEqual([(ns, key) for (ns, key, _) in self.storage.failures()],\
+                         [("a" * 40, "%s/src-main.c.diff.json" % StubFix().identifier())])
+
+        versions = dict(storage.TOOL_VERSIONS, cgum="other")
+        with unittest.mock.patch.object(storage, 'TOOL_VERSIONS', versions):
+            self.assertIsNone(self.storage.failure(df))
+            self.storage.record_failure(df, execution.LimitExceeded('cpu', "too slow"), 60)
+            failure = self.storage.failure(df)
+        self.assertEqual((failure['type'], failure['limit']), ('LimitExceeded', 'cpu'))
+        self.assertIsNone(self.storage.failure(df))
+
+        self.storage.clear_failure(df)
+        self.assertEqual(list(self.storage.failures()), [])
+
+    # diffs only record the failures that are caused by their files; other
+    # errors are raised, and the diff is tried again by the next call
+    def testTransientFailures(self):
+        df = diff.FileDiff(StubMaster(self.storage), StubFix(), "src/main.c")
+        for error in (OSError("no space left on device"), sqlite3.OperationalError("locked")):
+            with unittest.mock.patch.object(Storage, 'diff', side_effect=error):
+                self.assertRaises(type(error), df.prepare)
+            self.assertIsNone(self.storage.failure(df))
+
+        with unittest.mock.patch.object(Storage, 'diff',\
+                                        side_effect=service.ParserError("syntax error")):
+            self.assertFalse(df.prepare())
+        self.assertEqual(self.storage.failure(df)['type'], 'ParserError')
+
+class TestDatabaseFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.origin = git.Repo.init(os.path.join(self.dir, "origin"))
+        with self.origin.config_writer() as cfg:
+            cfg.set_value("user", "name", "Jane Doe")
+            cfg.set_value("user", "email", "jane@example.com")
+        self.commit({"a.c": "a\n"}, "initial commit")
+        self.commit({"a.c": "b\n"}, "fixed crash")
+
+        self.env = unittest.mock.patch.dict(os.environ,\
+                                            {'BUGHUNTER': os.path.join(self.dir, "bughunter")})
+        self.env.start()
+        self.master = BugHunter()
+        self.repo = self.master.repository(self.origin.working_dir)
+        self.db = self.master.storage().database(self.repo)
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.dir)
+
+    def commit(self, files, message):
+        for (fn, contents) in files.items():
+            with open(os.path.join(self.origin.working_dir, fn), "w") as f:
+                f.write(contents)
+        self.origin.index.add(list(files))
+        return self.origin.index.commit(message).hexsha
+
+    def messages(self):
+        return [fx.message() for fx in self.db.read(self.master.scanner())]
+
+    # refreshing scans only the commits since the last scan, and adds their
+    # fixes to those that were already found
+    def testRefresh(self):
+        self.assertEqual(self.messages(), ["fixed crash"])
+        last = self.db.head()
+        self.assertEqual(last, self.origin.head.commit.hexsha)
+        head = self.commit({"a.c": "c\n"}, "fixed overflow")
+
+        scanned = []
+        stream = Scanner.stream
+        def record(scanner, repo, since=None, until='HEAD'):
+            scanned.append((since, until))
+            return stream(scanner, repo, since=since, until=until)
+        with unittest.mock.patch.object(Scanner, 'stream', record):
+            self.db.refresh(self.master.scanner())
+            self.db.refresh(self.master.scanner())
+        self.assertEqual(scanned, [(last, head)])
+        self.assertEqual(self.db.head(), head)
+        self.assertEqual(self.messages(), ["fixed overflow", "fixed crash"])
+
+    # a clone whose HEAD was detached (e.g., by preprocessing) is brought up
+    # to date with the HEAD of its remote
+    def testDetachedHead(self):
+        self.assertEqual(self.messages(), ["fixed crash"])
+        clone = self.repo.repository()
+        clone.git.checkout(clone.head.commit.parents[0].hexsha)
+        self.assertTrue(clone.head.is_detached)
+
+        head = self.commit({"a.c": "c\n"}, "fixed overflow")
+        self.db.refresh(self.master.scanner())
+        self.assertEqual(clone.head.commit.hexsha, head)
+        self.assertEqual(self.messages(), ["fixed overflow", "fixed crash"])
+
+    # databases written by older versions, as a single JSON document (with or
+    # without the HEAD that they were scanned from, and without the changes
+    # made by each fix), are converted without scanning the repository
+    # again, and the changes of their fixes are recorded as they're converted
+    def testMigrate(self):
+        fixes = [fx.to_json() for fx in self.repo.fixes()]
+        old = [{k: v for (k, v) in fx.items() if k != 'changes'} for fx in fixes]
+        loc = self.master.storage().locator(self.db)
+        legacy = os.path.join(os.path.dirname(loc), "fixes.json")
+        head = self.origin.head.commit.hexsha
+
+        def scan(*args, **kwargs):
+            raise Exception("repository was scanned again")
+        for (jsn, expected) in [(old, None), ({'head': head, 'fixes': old}, head)]:
+            os.remove(loc)
+            with open(legacy, 'w') as f:
+                json.dump(jsn, f)
+            with unittest.mock.patch.object(Scanner, 'stream', scan):
+                self.assertEqual([fx.to_json() for fx in self.repo.iter_fixes()], fixes)
+            self.assertFalse(os.path.exists(legacy))
+            self.assertEqual(self.db.head(), expected)
+
+            # the changes are read from the converted file, rather than Git
+            with unittest.mock.patch.object(Scanner, 'log', scan):
+                self.assertEqual([fx.changes() for fx in self.db.read(self.master.scanner())],\
+                                 [fx['changes'] for fx in fixes])
+
+if __name__ == "__main__":
+    unittest.main()
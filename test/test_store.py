@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import bughunter.store as store
+import bughunter.utility as utility
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = store.DirectoryStore(os.path.join(self.dir, "files"))
+        self.pack = store.PackStore(os.path.join(self.dir, "pack", "artefacts.pack"))
+
+    def tearDown(self):
+        self.pack.close()
+        shutil.rmtree(self.dir)
+
+    def testSemantics(self):
+        for s in (self.files, self.pack):
+            self.assertFalse(s.exists("fix/a.diff.json"))
+            with self.assertRaises(KeyError):
+                s.get("fix/a.diff.json")
+
+            s.put("fix/a.diff.json", b"{}")
+            s.put_many({"fix/b.diff.json": b"[]", "other/c.pool.json": b"\x00\x01"})
+            self.assertTrue(s.exists("fix/a.diff.json"))
+            self.assertEqual(s.get("other/c.pool.json"), b"\x00\x01")
+            self.assertEqual(s.get_many(["fix/a.diff.json", "fix/missing.json"]),\
+                             {"fix/a.diff.json": b"{}"})
+            self.assertEqual(s.keys("fix/"), ["fix/a.diff.json", "fix/b.diff.json"])
+
+            s.delete("fix/a.diff.json")
+            self.assertFalse(s.exists("fix/a.diff.json"))
+
+    def testIngest(self):
+        fn = os.path.join(self.dir, "output.json")
+        for s in (self.files, self.pack):
+            with open(fn, "wb") as f:
+                f.write(b"{}")
+            s.ingest("fix/a.ast.json", fn)
+            self.assertFalse(os.path.exists(fn))
+            self.assertEqual(s.get("fix/a.ast.json"), b"{}")
+
+    def testMigrate(self):
+        os.makedirs(self.files.root())
+        with open(os.path.join(self.files.root(), "fixes.jsonl"), "w") as f:
+            f.write("{}\n")
+        self.files.put_many({"fix/a.diff.json": b"{}", "fix/b.diff.json": b"[]"})
+
+        self.assertEqual(store.migrate(self.files, self.pack), 2)
+        self.assertEqual(self.files.keys(), [])
+        self.assertEqual(self.pack.get("fix/b.diff.json"), b"[]")
+
+        self.files.discard()
+        self.assertEqual(os.listdir(self.files.root()), ["fixes.jsonl"])
+
+    def testCompression(self):
+        codec = lambda key: 'gzip' if key.endswith('.diff.json') else 'none'
+        compressed = store.CompressedStore(self.files, codec)
+        compressed.put("fix/a.diff.json", b"{}" * 100)
+        compressed.put("fix/a.pool.json", b"[]")
+        self.assertEqual(self.files.get("fix/a.diff.json")[:2], b"\x1f\x8b")
+        self.assertEqual(self.files.get("fix/a.pool.json"), b"[]")
+        self.assertEqual(compressed.get("fix/a.diff.json"), b"{}" * 100)
+
+        # artefacts written without compression are still readable
+        self.files.put("fix/b.diff.json", b"{}")
+        self.assertEqual(compressed.get_many(["fix/a.pool.json", "fix/b.diff.json"]),\
+                         {"fix/a.pool.json": b"[]", "fix/b.diff.json": b"{}"})
+
+    def testManifest(self):
+        self.files.put("fix/a.diff.json", b"{}")
+        fn = os.path.join(self.dir, "files.manifest")
+        manifest = store.ManifestStore(self.files, fn, "v1")
+        self.assertTrue(manifest.exists("fix/a.diff.json"))
+        self.assertIsNone(manifest.entry("fix/a.diff.json")['version'])
+
+        manifest.put("fix/b.diff.json", b"[1]")
+        self.assertEqual(manifest.entry("fix/b.diff.json")['version'], "v1")
+        self.assertEqual(manifest.sizes("fix/"), {"fix/a.diff.json": 2, "fix/b.diff.json": 3})
+
+        # changes made behind the manifest's back are picked up by a rebuild;
+        # in the meantime, the manifest is trusted, unless it's asked to
+        # verify an artefact, or the artefact fails to be read
+        self.files.delete("fix/a.diff.json")
+        self.files.put("fix/c.diff.json", b"{}")
+        self.assertTrue(manifest.exists("fix/a.diff.json"))
+        self.assertTrue(manifest.exists("fix/c.diff.json"))
+        self.assertEqual(manifest.keys(), ["fix/a.diff.json", "fix/b.diff.json"])
+        self.assertRaises(KeyError, manifest.get, "fix/a.diff.json")
+        self.assertEqual(manifest.keys(), ["fix/b.diff.json"])
+        self.files.delete("fix/b.diff.json")
+        self.assertFalse(manifest.exists("fix/b.diff.json", verify=True))
+        self.assertEqual(manifest.keys(), [])
+        manifest.rebuild()
+        self.assertEqual(manifest.keys(), ["fix/c.diff.json"])
+        manifest.close()
+
+    # packs and manifests use a rollback journal, rather than a write-ahead
+    # log, so that they may be shared across machines
+    def testJournal(self):
+        fn = os.path.join(self.dir, "artefacts.pack")
+        with sqlite3.connect(fn) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+        pack = store.PackStore(fn)
+        manifest = store.ManifestStore(pack, os.path.join(self.dir, "pack.manifest"), "v1")
+        manifest.put("fix/a.diff.json", b"{}")
+        manifest.close()
+        for path in (fn, os.path.join(self.dir, "pack.manifest")):
+            with sqlite3.connect(path) as db:
+                self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+
+    # links to files elsewhere (e.g., to shared ASTs) aren't listed, and so
+    # aren't counted by manifests, but may still be read
+    def testLinks(self):
+        shared = os.path.join(self.dir, "shared.ast.json")
+        with open(shared, 'wb') as f:
+            f.write(b"{}")
+        self.files.put("fix/a.diff.json", b"[]")
+        utility.link(shared, self.files.path("fix/a.before.ast.json"))
+        self.assertEqual(self.files.sizes(), {"fix/a.diff.json": 2})
+        self.assertEqual(self.files.get("fix/a.before.ast.json"), b"{}")
+
+        manifest = store.ManifestStore(self.files, os.path.join(self.dir, "files.manifest"), "v1")
+        manifest.rebuild()
+        self.assertEqual(manifest.keys(), ["fix/a.diff.json"])
+        manifest.close()
+
+    def testAccessTimes(self):
+        manifest = store.ManifestStore(self.pack, os.path.join(self.dir, "pack.manifest"), "v1")
+        manifest.put_many({"fix/a.diff.json": b"{}", "fix/b.diff.json": b"[]"})
+        written = manifest.entry("fix/a.diff.json")['atime']
+
+        # reads are only recorded once the manifest is flushed
+        manifest.get("fix/a.diff.json")
+        self.assertEqual(manifest.entry("fix/a.diff.json")['atime'], written)
+        manifest.flush()
+        self.assertGreater(manifest.entry("fix/a.diff.json")['atime'], written)
+        self.assertEqual(manifest.entry("fix/b.diff.json")['atime'], written)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import bughunter.utility as utility
+
+# Waits for the lock at a given path, before recording the time at which it
+# was acquired to a given file
+def acquire(path, out):
+    with utility.file_lock(path):
+        with open(out, 'w') as f:
+            f.write(str(time.time()))
+
+# Takes the lock at a given path, and exits without releasing it
+def hold(path):
+    utility.file_lock(path).__enter__()
+    os._exit(0)
+
+class TestFileLock(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "locks", "a.lock")
+        self.out = os.path.join(self.dir, "acquired")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def acquired(self):
+        with open(self.out, 'r') as f:
+            return float(f.read())
+
+    # the lock may be taken again by the thread that holds it, but not by
+    # other threads until it's been released by the outermost context
+    def testReentrant(self):
+        with utility.file_lock(self.path):
+            with utility.file_lock(self.path):
+                pass
+            t = threading.Thread(target=acquire, args=(self.path, self.out))
+            t.start()
+            time.sleep(0.3)
+            self.assertFalse(os.path.exists(self.out))
+            released = time.time()
+        t.join()
+        self.assertGreaterEqual(self.acquired(), released)
+
+    # processes are spawned, rather than forked, since forked processes
+    # share the locks held by their parent
+    def testProcesses(self):
+        spawn = multiprocessing.get_context('spawn')
+        with utility.file_lock(self.path):
+            p = spawn.Process(target=acquire, args=(self.path, self.out))
+            p.start()
+            time.sleep(0.3)
+            self.assertFalse(os.path.exists(self.out))
+            released = time.time()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertGreaterEqual(self.acquired(), released)
+
+        # the lock is released when the process that holds it terminates
+        p = spawn.Process(target=hold, args=(self.path,))
+        p.start()
+        p.join()
+        acquire(self.path, self.out)
+
+if __name__ == "__main__":
+    unittest.main()